@@ -165,6 +165,83 @@ STATICFILES_DIRS = [
 
 CELERY_RESULT_BACKEND = 'django-db'
 
+# The postgres NOTIFY channel used to wake up the dispatcher when a ProcessInput is queued or completed.
+DISPATCHER_NOTIFY_CHANNEL = 'cosmic_processinput'
+
+# The celery queues the dispatcher sends tasks to, and the maximum number of tasks the dispatcher will have running on
+# each queue at once.  Each queue should have a celery worker pool consuming it which is sized to match (see run.sh).
+DISPATCH_QUEUES = {
+    'io': 4,
+    'cpu-heavy': 4,
+    'solver': 1,
+    'light': 4,
+    }
+
+# The queue each process type is sent to (see cosmicapp.dispatch.getQueueForProcess).
+DISPATCH_PROCESS_QUEUES = {
+    'imagestats': 'io',
+    'generateThumbnails': 'io',
+    'generateTiles': 'io',
+    'parseHeaders': 'light',
+    'backgroundMap': 'cpu-heavy',
+    'sextractor': 'cpu-heavy',
+    'image2xy': 'cpu-heavy',
+    'daofind': 'cpu-heavy',
+    'starfind': 'cpu-heavy',
+    'starmatch': 'cpu-heavy',
+    'imageCombine': 'cpu-heavy',
+    'astrometryNet': 'solver',
+    'flagSources': 'light',
+    'calculateUserCostTotals': 'light',
+    }
+
+# Tasks with estCostCPU and estCostIO at or below these values go to the 'light' queue regardless of their type.
+DISPATCH_LIGHT_COST_LIMITS = {
+    'cpu': 1,
+    'io': 10e6,
+    }
+
+# A task sent by the dispatcher has TASK_LEASE_SECONDS to be picked up by a worker, after which the worker running it
+# renews the lease every TASK_HEARTBEAT_SECONDS until it finishes.  A task whose lease runs out is put back in the queue.
+TASK_LEASE_SECONDS = 300
+TASK_HEARTBEAT_SECONDS = 30
+
+# The queue used for the short callbacks which record the result of each finished task.  It has a worker of its own (see
+# run.sh) and is deliberately not in DISPATCH_QUEUES, so a backlog of light tasks can never hold up the callbacks that
+# free up dispatch slots.
+DISPATCH_CALLBACK_QUEUE = 'callbacks'
+
+# The maximum number of tasks of a given process type the dispatcher will have running at once, on top of the per queue
+# limits above.  A limit only has an effect if it is smaller than the size of the queue the process is sent to (or when
+# small tasks of that type are moved to the 'light' queue).  These are only the defaults, the 'dispatchProcessLimits'
+# CosmicVariable overrides them and is re-read on every pass of the dispatcher so limits can be changed without
+# restarting it.  The source finders are each held to half of the queues they run on, so when a batch of images arrives
+# a single finder type can never take every slot and the others still make progress.
+DISPATCH_PROCESS_LIMITS = {
+    'astrometryNet': 1,
+    'generateThumbnails': 2,
+    'sextractor': 2,
+    'image2xy': 2,
+    'daofind': 2,
+    'starfind': 2,
+    }
+
+# The most worker processes cosmicapp.parallel.mapChannels() runs at once for a single task.  The io and cpu-heavy
+# queues, whose tasks are the ones that split their work this way, can all be running at the same moment on one machine
+# (see run.sh), so each of their slots gets an equal share of the cores rather than every task starting one process per
+# core.
+CHANNEL_WORKERS_PER_TASK = max(1, (os.cpu_count() or 1) // (DISPATCH_QUEUES['io'] + DISPATCH_QUEUES['cpu-heavy']))
+
+# Each worker keeps the decoded frames of the images it has worked on in this directory (see
+# cosmicapp.framecache), which should be on fast local storage rather than the shared MEDIA_ROOT.  The least recently
+# used frames are deleted to keep the total size under FRAME_CACHE_MAX_BYTES.
+FRAME_CACHE_ROOT = '/var/cache/cosmic/frames/'
+FRAME_CACHE_MAX_BYTES = 20*1024*1024*1024
+
+# The file format (and extension) of the small, medium, and large thumbnails made by generateThumbnails.  Anything
+# imageio can write works, 'webp' gives noticeably smaller files than 'png' but needs pillow built with webp support.
+THUMBNAIL_FORMAT = 'png'
+
 SUPPORTED_IMAGE_TYPES = [".fit", ".fits", ".fts", ".new"]
 
 # When running parseHeaders these keys are not written into the database at all.
@@ -55,6 +55,7 @@ urlpatterns = [
     url(r'^image/(?P<id>[0-9]+)/$', views.image),
     url(r'^image/(?P<id>[0-9]+)/sources/$', views.imageSources),
     url(r'^image/(?P<id>[0-9]+)/properties/$', views.imageProperties),
+    url(r'^image/(?P<id>[0-9]+)/tiles/(?P<zoom>[0-9]+)/(?P<tileX>[0-9]+)/(?P<tileY>[0-9]+).png$', views.imageTile),
     url(r'^imageProperties/$', views.allImageProperties),
 
     url(r'^query/$', views.query),
@@ -0,0 +1,104 @@
+"""
+A map of the sky background level and noise across an image, so source finding thresholds can follow gradients,
+vignetting, moonlight, etc, rather than using a single value for the whole frame.
+
+The frame is divided into a grid of square boxes and the pixels in each box are sigma clipped to reject the stars in
+it, leaving the median (background) and standard deviation (rms) of what is left.  The grid is small enough to store in
+the database (see ImageBackgroundMap) and is interpolated back up to full resolution when a source finder needs it.
+"""
+import numpy
+import scipy.ndimage
+
+# The default width and height in pixels of the boxes, overridden by the 'backgroundMapBoxSize' CosmicVariable.
+defaultBoxSize = 64
+
+# Boxes with fewer than this fraction of their pixels left after clipping (or lying off the edge of the frame) are
+# treated as unmeasured and filled in from their neighbors.
+minimumBoxFraction = 0.1
+
+def sigmaClipRows(data, sigma=3, maxiters=3):
+    """
+    Sigma clip each row of data independently, setting the rejected values to NaN in place, and return the median and
+    standard deviation of what is left in each row.
+    """
+    with numpy.errstate(invalid='ignore'):
+        for iteration in range(maxiters):
+            median = numpy.nanmedian(data, axis=1)
+            stdDev = numpy.nanstd(data, axis=1)
+            rejected = numpy.abs(data - median[:, numpy.newaxis]) > sigma * stdDev[:, numpy.newaxis]
+            if not rejected.any():
+                break
+
+            data[rejected] = numpy.nan
+
+        return numpy.nanmedian(data, axis=1), numpy.nanstd(data, axis=1)
+
+def fillGrid(grid, filterSize=3):
+    """
+    Replace the unmeasured (NaN) boxes of the grid with the median of the measured ones, then median filter the grid so
+    a single box dominated by a bright star or galaxy does not make a bump in the map.
+    """
+    measured = numpy.isfinite(grid)
+    fillValue = numpy.median(grid[measured]) if measured.any() else 0.0
+    grid = numpy.where(measured, grid, fillValue)
+
+    return scipy.ndimage.median_filter(grid, size=filterSize, mode='nearest')
+
+def measureBackgroundGrid(frame, boxSize=defaultBoxSize, sigma=3, maxiters=3):
+    """
+    Return the (background, rms) grids of the given frame, each with one entry per boxSize by boxSize box.  The frame is
+    read one row of boxes at a time, so it can be a memory mapped array of any size.
+    """
+    numBoxRows = -(-frame.shape[0] // boxSize)
+    numBoxCols = -(-frame.shape[1] // boxSize)
+    paddedWidth = numBoxCols * boxSize
+    minimumPixels = minimumBoxFraction * boxSize * boxSize
+
+    background = numpy.empty((numBoxRows, numBoxCols))
+    rms = numpy.empty((numBoxRows, numBoxCols))
+    for boxRow in range(numBoxRows):
+        block = numpy.full((min(boxSize, frame.shape[0] - boxRow*boxSize), paddedWidth), numpy.nan)
+        block[:, :frame.shape[1]] = frame[boxRow*boxSize:(boxRow + 1)*boxSize]
+
+        # Rearrange the block so each row holds all the pixels of one box.
+        boxes = block.reshape(block.shape[0], numBoxCols, boxSize).transpose(1, 0, 2).reshape(numBoxCols, -1)
+        boxMedian, boxStdDev = sigmaClipRows(boxes, sigma, maxiters)
+
+        tooFew = numpy.count_nonzero(numpy.isfinite(boxes), axis=1) < minimumPixels
+        boxMedian[tooFew] = numpy.nan
+        boxStdDev[tooFew] = numpy.nan
+
+        background[boxRow] = boxMedian
+        rms[boxRow] = boxStdDev
+
+    return fillGrid(background), fillGrid(rms)
+
+def getInterpolation(length, numBoxes, boxSize):
+    """
+    Return the lower box index, upper box index, and weight of the upper box for linear interpolation between box
+    centers at each of the given number of pixels along one axis.
+    """
+    position = ((numpy.arange(length) + 0.5) / boxSize - 0.5).clip(0, numBoxes - 1)
+    lower = numpy.floor(position).astype(numpy.int64)
+    upper = numpy.minimum(lower + 1, numBoxes - 1)
+    return lower, upper, position - lower
+
+def expandBackgroundGrid(grid, boxSize, shape, out=None, maxBlockRows=1024):
+    """
+    Bilinearly interpolate the grid between the box centers up to a full resolution map of the given shape.  The map is
+    written into out if it is given (for example a memory mapped array) a block of rows at a time.
+    """
+    grid = numpy.asarray(grid, dtype=numpy.float64)
+    if out is None:
+        out = numpy.empty(shape, dtype=numpy.float32)
+
+    rowLower, rowUpper, rowWeight = getInterpolation(shape[0], grid.shape[0], boxSize)
+    colLower, colUpper, colWeight = getInterpolation(shape[1], grid.shape[1], boxSize)
+
+    for firstRow in range(0, shape[0], maxBlockRows):
+        rows = slice(firstRow, firstRow + maxBlockRows)
+        weight = rowWeight[rows, numpy.newaxis]
+        blockRows = grid[rowLower[rows]] * (1 - weight) + grid[rowUpper[rows]] * weight
+        out[rows] = blockRows[:, colLower] * (1 - colWeight) + blockRows[:, colUpper] * colWeight
+
+    return out
@@ -1,6 +1,75 @@
-from django.db.models import Func
+import select
+
+import psycopg2
+import psycopg2.extensions
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import Func, F, ExpressionWrapper, FloatField
 
 class Epoch(Func):
     function = 'EXTRACT'
     template = "%(function)s('epoch' from %(expressions)s)"
 
+class UTCEpoch(Func):
+    """
+    The same as Epoch, but the timestamp is converted to UTC first.  Postgres only allows immutable functions in an
+    index, and extracting the epoch from a timestamp with time zone is not immutable, whereas doing it on the plain UTC
+    timestamp is.
+    """
+    function = 'EXTRACT'
+    template = "%(function)s('epoch' from (%(expressions)s AT TIME ZONE 'UTC'))"
+
+def agedPriority():
+    """
+    The ProcessInput priority with the age of the task added on, less the current time.  The time since submission is
+    the same for every task at any given moment apart from this constant, so ordering by this gives the same order as
+    ordering by priority plus age, but unlike that it does not change over time and so can be served from an index.
+    """
+    return ExpressionWrapper(F('priority') - UTCEpoch(F('submittedDateTime')), output_field=FloatField())
+
+def notifyChannel(channel, payload=''):
+    """
+    Send a postgres NOTIFY on the given channel using the default django connection.  If this is called inside a
+    transaction the notification is only delivered to listeners once the transaction commits, so listeners never wake up
+    to look for rows they cannot see yet.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT pg_notify(%s, %s)', [channel, str(payload)])
+
+def listenOnChannel(channel):
+    """
+    Open a dedicated autocommit connection to the database and LISTEN on the given channel.  This is kept separate from
+    the django connection so that django closing or resetting its own connection can never silently drop the LISTEN.
+    """
+    dbSettings = settings.DATABASES['default']
+    listenConnection = psycopg2.connect(
+        dbname = dbSettings['NAME'],
+        user = dbSettings['USER'],
+        password = dbSettings['PASSWORD'],
+        host = dbSettings['HOST'],
+        port = dbSettings['PORT']
+        )
+
+    listenConnection.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+    with listenConnection.cursor() as cursor:
+        cursor.execute('LISTEN ' + channel)
+
+    return listenConnection
+
+def waitForNotify(listenConnection, timeout):
+    """
+    Block for up to 'timeout' seconds waiting for a notification on a connection returned by listenOnChannel().  Returns
+    the list of notifications received (empty if the timeout expired).  Any notifications already queued on the
+    connection are returned immediately without blocking.
+    """
+    listenConnection.poll()
+    if len(listenConnection.notifies) == 0:
+        readable, writable, exceptional = select.select([listenConnection], [], [], timeout)
+        if len(readable) > 0:
+            listenConnection.poll()
+
+    notifies = listenConnection.notifies[:]
+    del listenConnection.notifies[:]
+
+    return notifies
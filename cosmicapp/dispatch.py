@@ -0,0 +1,135 @@
+"""
+Helpers used by dispatcher.py to decide where ProcessInput records get sent to be run.  These are kept out of the
+dispatcher script itself so they can be imported by the models and other scripts without starting up a dispatcher.
+"""
+from django.conf import settings
+
+# The chain of tasks created for every newly uploaded image by createTasksForNewImages(), which simulate_dispatcher.py
+# also replays.  Each entry is the process, the processes earlier in the list it depends on, what it is run on ('file'
+# for the name of the uploaded file on disk, 'image' for the pk of the Image record), and a function returning its cost
+# estimates given the size of the uploaded file in bytes.
+newImagePipeline = [
+    ('imagestats', [], 'file',
+        lambda uploadSize: {'estCostCPU': uploadSize / 1e6, 'estCostBandwidth': 0, 'estCostStorage': 1000,
+            'estCostIO': uploadSize}),
+    ('parseHeaders', ['imagestats'], 'image',
+        lambda uploadSize: {'estCostCPU': .1, 'estCostBandwidth': 0, 'estCostStorage': 1000, 'estCostIO': 2000}),
+    ('generateThumbnails', ['imagestats'], 'file',
+        lambda uploadSize: {'estCostCPU': uploadSize / 1e6, 'estCostBandwidth': 0, 'estCostStorage': uploadSize / 10,
+            'estCostIO': 1.5 * uploadSize}),
+    ('generateTiles', ['generateThumbnails'], 'file',
+        lambda uploadSize: {'estCostCPU': 0.5 * uploadSize / 1e6, 'estCostBandwidth': 0, 'estCostStorage': uploadSize / 2,
+            'estCostIO': uploadSize}),
+    ('sextractor', ['imagestats', 'parseHeaders'], 'file',
+        lambda uploadSize: {'estCostCPU': 0.5 * uploadSize / 1e6, 'estCostBandwidth': 0, 'estCostStorage': 3000,
+            'estCostIO': uploadSize}),
+    ('backgroundMap', ['imagestats'], 'file',
+        lambda uploadSize: {'estCostCPU': 0.2 * uploadSize / 1e6, 'estCostBandwidth': 0, 'estCostStorage': 3000,
+            'estCostIO': uploadSize}),
+    # image2xy does its own background subtraction, only the photutils finders read the background map.
+    ('image2xy', ['imagestats', 'parseHeaders', 'sextractor'], 'file',
+        lambda uploadSize: {'estCostCPU': 0.5 * uploadSize / 1e6, 'estCostBandwidth': 0, 'estCostStorage': 3000,
+            'estCostIO': uploadSize}),
+    ('daofind', ['imagestats', 'parseHeaders', 'sextractor', 'backgroundMap'], 'file',
+        lambda uploadSize: {'estCostCPU': 0.5 * uploadSize / 1e6, 'estCostBandwidth': 0, 'estCostStorage': 3000,
+            'estCostIO': uploadSize}),
+    ('starfind', ['imagestats', 'parseHeaders', 'sextractor', 'backgroundMap'], 'file',
+        lambda uploadSize: {'estCostCPU': 0.5 * uploadSize / 1e6, 'estCostBandwidth': 0, 'estCostStorage': 3000,
+            'estCostIO': uploadSize}),
+    ('flagSources', ['sextractor', 'image2xy', 'daofind', 'starfind'], 'image',
+        lambda uploadSize: {'estCostCPU': 10, 'estCostBandwidth': 0, 'estCostStorage': 3000, 'estCostIO': 10000}),
+    ('starmatch', ['flagSources'], 'file',
+        lambda uploadSize: {'estCostCPU': 10, 'estCostBandwidth': 0, 'estCostStorage': 3000, 'estCostIO': 10000}),
+    #TODO: Do we need to run flag sources here a second time to flag sources created by starmatch?
+    ('astrometryNet', ['starmatch', 'parseHeaders'], 'file',
+        lambda uploadSize: {'estCostCPU': 100, 'estCostBandwidth': 3000, 'estCostStorage': 3000,
+            'estCostIO': 10000000000}),
+    ]
+
+def getQueueForProcess(process, estCostCPU=None, estCostIO=None):
+    """
+    Return the name of the celery queue a task should be sent to.  Known process types are mapped to a queue by
+    settings.DISPATCH_PROCESS_QUEUES, and anything small enough according to its cost estimates is moved to the 'light'
+    queue so it does not wait behind big jobs of the same type.  Unknown process types are placed by their cost
+    estimates alone.  Tasks on the 'solver' queue are never moved since the solver needs its dedicated worker.
+    """
+    lightLimits = settings.DISPATCH_LIGHT_COST_LIMITS
+    isLight = estCostCPU is not None and estCostCPU <= lightLimits['cpu'] and \
+        (estCostIO is None or estCostIO <= lightLimits['io'])
+
+    queue = settings.DISPATCH_PROCESS_QUEUES.get(process, None)
+    if queue == 'solver':
+        return queue
+
+    if isLight:
+        return 'light'
+
+    if queue is not None:
+        return queue
+
+    if estCostCPU is not None and estCostCPU > lightLimits['cpu']:
+        return 'cpu-heavy'
+
+    if estCostIO is not None and estCostIO > lightLimits['io']:
+        return 'io'
+
+    return 'light'
+
+def getQueueForProcessInput(pi):
+    return getQueueForProcess(pi.process, pi.estCostCPU, pi.estCostIO)
+
+def parseProcessLimits(value):
+    """
+    Parse a process limit string of the form "astrometryNet:1,generateThumbnails:2,sextractor:2" into a dict mapping
+    process names to the maximum number of that process allowed to run at once.  Malformed entries are skipped.
+    """
+    limits = {}
+    for entry in value.split(','):
+        if ':' not in entry:
+            continue
+
+        process, limit = entry.split(':', 1)
+        try:
+            limits[process.strip()] = int(limit)
+        except ValueError:
+            continue
+
+    return limits
+
+def getProcessLimits():
+    """
+    Return the current per process type concurrency limits.  Process types not listed are only limited by the size of
+    the queue they are sent to.
+    """
+    from .models import CosmicVariable
+
+    limits = dict(settings.DISPATCH_PROCESS_LIMITS)
+    value = CosmicVariable.getVariable('dispatchProcessLimits')
+    if value is not None:
+        limits.update(parseProcessLimits(value))
+
+    return limits
+
+def getAvailableQueues(runningPerQueue):
+    """
+    Return the list of queues in settings.DISPATCH_QUEUES which have room for another task, given a dict mapping queue
+    names to the number of tasks currently running on them.
+    """
+    availableQueues = []
+    for queue, maxRunning in settings.DISPATCH_QUEUES.items():
+        if runningPerQueue.get(queue, 0) < maxRunning:
+            availableQueues.append(queue)
+
+    return availableQueues
+
+def getSaturatedProcesses(runningPerProcess, processLimits):
+    """
+    Return the list of process types which are already running as many tasks as processLimits allows, given a dict
+    mapping process types to the number of tasks of that type currently running.
+    """
+    saturatedProcesses = []
+    for process, maxRunning in processLimits.items():
+        if runningPerProcess.get(process, 0) >= maxRunning:
+            saturatedProcesses.append(process)
+
+    return saturatedProcesses
@@ -0,0 +1,119 @@
+"""
+A cache on each worker of the decoded frames of the images it has worked on, so the stages of the pipeline after the
+first one to need the pixel data of an image do not each have to open the fits file on MEDIA_ROOT again, apply the
+BSCALE/BZERO scaling, and slice the frame out of a data cube.
+
+Frames are stored as .npy files in settings.FRAME_CACHE_ROOT named by the sha256 of the uploaded file and the hdu and
+frame index of the channel (see ImageChannelInfo), along with the full resolution background maps interpolated from
+each channel's ImageBackgroundMap.  Everything is returned memory mapped so several tasks on the same worker can share
+them without each holding a copy.  A cache hit touches the file, and whenever a new entry is added the least recently
+used ones are deleted until the cache fits in settings.FRAME_CACHE_MAX_BYTES.
+"""
+import os
+import numpy
+
+from django.conf import settings
+from astropy.io import fits
+
+from .background import expandBackgroundGrid
+
+def getCacheFilename(name):
+    return os.path.join(settings.FRAME_CACHE_ROOT, name + '.npy')
+
+def decodeFrame(filename, hduIndex=0, frameIndex=0):
+    """
+    Read the given frame of the given fits file into memory, scaled to physical values.  The frameIndex is ignored for a
+    hdu that is not a data cube.
+    """
+    with fits.open(filename) as hdulist:
+        data = hdulist[hduIndex].data
+        if len(data.shape) == 3:
+            data = data[frameIndex]
+
+        return numpy.array(data)
+
+def evictFrames():
+    """
+    Delete the least recently used frames until the cache is no larger than settings.FRAME_CACHE_MAX_BYTES.
+    """
+    entries = []
+    for entry in os.scandir(settings.FRAME_CACHE_ROOT):
+        if entry.name.endswith('.npy'):
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+    totalBytes = sum(size for mtime, size, path in entries)
+    for mtime, size, path in sorted(entries):
+        if totalBytes <= settings.FRAME_CACHE_MAX_BYTES:
+            break
+
+        # Another worker process may have deleted it already.  Any task which still has the file memory mapped keeps
+        # its copy until it is done with it.
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+        totalBytes -= size
+
+def loadCached(name, makeArray):
+    """
+    Return the array cached under the given name read only and memory mapped, or if it is not in the cache call
+    makeArray() to make it, add it to the cache, and return it.
+    """
+    cacheFilename = getCacheFilename(name)
+    try:
+        data = numpy.load(cacheFilename, mmap_mode='r')
+        os.utime(cacheFilename)
+        return data
+    except (OSError, ValueError):
+        # Either not cached yet or a truncated entry, in which case it is made again and replaced.
+        pass
+
+    data = makeArray()
+
+    # Write to a temporary file and rename it into place, so other worker processes never see a partially written array.
+    os.makedirs(settings.FRAME_CACHE_ROOT, exist_ok=True)
+    tempFilename = '{}.{}.tmp'.format(cacheFilename, os.getpid())
+    with open(tempFilename, 'wb') as tempFile:
+        numpy.save(tempFile, data)
+
+    os.replace(tempFilename, cacheFilename)
+    evictFrames()
+
+    return data
+
+def loadFrame(fileRecord, hduIndex=0, frameIndex=0):
+    """
+    Return the decoded frame of the given UploadedFileRecord as a numpy array, by default the first frame of the primary
+    hdu.  A frame already in the cache is returned read only and memory mapped, otherwise it is decoded from the fits
+    file and added to the cache.
+    """
+    filename = settings.MEDIA_ROOT + fileRecord.onDiskFileName
+    if not fileRecord.fileSha256:
+        return decodeFrame(filename, hduIndex, frameIndex)
+
+    return loadCached('{}_{}_{}'.format(fileRecord.fileSha256, hduIndex, frameIndex),
+        lambda: decodeFrame(filename, hduIndex, frameIndex))
+
+def loadBackgroundMaps(fileRecord, hduIndex, frameIndex, backgroundMap):
+    """
+    Return the full resolution (background, rms) maps of the given frame, interpolated from the grids of the given
+    ImageBackgroundMap, as numpy arrays which are cached the same way as the frames themselves.  The cache entries are
+    named by the pk of the backgroundMap, so a map that has been measured again is never confused with the old one.
+    """
+    shape = loadFrame(fileRecord, hduIndex, frameIndex).shape
+    maps = []
+    for name, grid in [('background', backgroundMap.background), ('rms', backgroundMap.rms)]:
+        makeArray = lambda grid=grid: expandBackgroundGrid(grid, backgroundMap.boxSize, shape)
+        if fileRecord.fileSha256:
+            maps.append(loadCached('{}_{}_{}_{}{}'.format(fileRecord.fileSha256, hduIndex, frameIndex, name,
+                backgroundMap.pk), makeArray))
+        else:
+            maps.append(makeArray())
+
+    return tuple(maps)
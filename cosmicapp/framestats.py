@@ -0,0 +1,396 @@
+"""
+Statistics on image frames computed a block of rows (a tile) at a time, so the memory needed does not grow with the size
+of the frame.  The frames are expected to be memory mapped fits data (opened with do_not_scale_image_data=True), so only
+the rows of the tile currently being worked on are ever read into memory, and the BSCALE/BZERO scaling is applied to
+each tile as it is read rather than to a full size copy of the frame.
+
+Everything that depends on the pixel values but not their positions (min/max, mean, median, standard deviation, the
+bathtub counts, etc) is computed from a table of pixel values and their counts built up during the pass, so masking a
+set of values never needs another full size array.  The table has a fixed maximum size (see ValueCounter): integer data
+is counted exactly, one entry per value, as long as its range fits in the table, anything else (float data in
+particular, where nearly every pixel can have a different value) is counted in equal width bins across its range.
+"""
+import numpy
+
+# The default maximum size of a single tile, overridden by the 'imagestatsMaxTileBytes' CosmicVariable.
+defaultMaxTileBytes = 64*1024*1024
+
+# The number of float64 sized working arrays that exist for a tile at once while it is being processed.
+tileCopies = 4
+
+# The maximum number of entries in the table of pixel values and counts, see ValueCounter.
+maxHistogramBins = 2**20
+
+def getTileRows(frame, maxTileBytes):
+    """
+    Return the number of rows of the given frame to process at a time to stay within maxTileBytes.
+    """
+    rowBytes = frame.shape[1] * 8 * tileCopies
+    return max(1, int(maxTileBytes // rowBytes))
+
+def scalesToIntegers(dtype, bscale=1, bzero=0):
+    """
+    Return True if raw fits data of the given dtype stays as integers once it is scaled by scaleTile().
+    """
+    return dtype.kind in 'iu' and bscale == 1 and float(bzero).is_integer()
+
+def scaleTile(raw, bscale=1, bzero=0):
+    """
+    Convert a block of raw fits data to physical values.  Integer data with an integer offset and no scaling stays as
+    integers so it can be counted exactly, anything else is converted to float64.
+    """
+    if scalesToIntegers(raw.dtype, bscale, bzero):
+        tile = raw.astype(numpy.int64)
+        if bzero != 0:
+            tile += int(bzero)
+
+        return tile
+
+    tile = raw.astype(numpy.float64)
+    if bscale != 1:
+        tile *= bscale
+
+    if bzero != 0:
+        tile += bzero
+
+    return tile
+
+def iterateTiles(frame, maxTileBytes, bscale=1, bzero=0):
+    """
+    Yield (firstRow, tile) pairs covering the whole frame, where tile is the scaled data for a block of rows.
+    """
+    tileRows = getTileRows(frame, maxTileBytes)
+    for firstRow in range(0, frame.shape[0], tileRows):
+        yield firstRow, scaleTile(frame[firstRow:firstRow+tileRows], bscale, bzero)
+
+def findValueRange(frame, maxTileBytes=defaultMaxTileBytes, bscale=1, bzero=0):
+    """
+    Return the (min, max) of the finite pixel values in the frame, or None if it has none.  For 8 and 16 bit integer
+    data this is just the range of the data type, without reading the frame at all.
+    """
+    if scalesToIntegers(frame.dtype, bscale, bzero) and frame.dtype.itemsize <= 2:
+        info = numpy.iinfo(frame.dtype)
+        return int(info.min) + int(bzero), int(info.max) + int(bzero)
+
+    minValue = None
+    maxValue = None
+    for firstRow, tile in iterateTiles(frame, maxTileBytes, bscale, bzero):
+        if tile.dtype.kind == 'f':
+            tile = tile[numpy.isfinite(tile)]
+
+        if tile.size == 0:
+            continue
+
+        tileMin = tile.min()
+        tileMax = tile.max()
+        minValue = tileMin if minValue is None else min(minValue, tileMin)
+        maxValue = tileMax if maxValue is None else max(maxValue, tileMax)
+
+    if minValue is None:
+        return None
+
+    return minValue, maxValue
+
+class ValueCounter:
+    """
+    A table of the number of pixels with each value in a frame, added to a tile at a time, whose size is fixed by the
+    range of values in the frame rather than the number of pixels in it.
+
+    Integer data whose range fits in maxHistogramBins entries is counted exactly, with one entry per value.  Anything
+    else is counted in maxHistogramBins equal width bins from minValue to maxValue, and each bin records the mean of the
+    values which fell in it as well as the count.  So a bin holding a single repeated value (a saturation level, say)
+    still reports that exact value, and the first and last bins report the true minimum and maximum when they hold a
+    single pixel.  NaN and infinite values are not counted.
+    """
+    def __init__(self, minValue, maxValue, isInteger):
+        self.minValue = minValue
+        self.isExact = isInteger and int(maxValue) - int(minValue) + 1 <= maxHistogramBins
+        if self.isExact:
+            self.minValue = int(minValue)
+            self.numBins = int(maxValue) - self.minValue + 1
+            self.sums = None
+        else:
+            self.numBins = maxHistogramBins
+            self.binsPerValue = self.numBins / (maxValue - minValue) if maxValue > minValue else 0.0
+            self.sums = numpy.zeros(self.numBins)
+
+        self.counts = numpy.zeros(self.numBins, dtype=numpy.int64)
+
+    def add(self, tile):
+        values = tile.ravel()
+        if self.isExact:
+            self.counts += numpy.bincount(values - self.minValue, minlength=self.numBins)
+            return
+
+        values = values[numpy.isfinite(values)]
+        binIndex = ((values - self.minValue) * self.binsPerValue).astype(numpy.int64)
+        numpy.clip(binIndex, 0, self.numBins - 1, out=binIndex)
+
+        self.counts += numpy.bincount(binIndex, minlength=self.numBins)
+        self.sums += numpy.bincount(binIndex, weights=values, minlength=self.numBins)
+
+    def getValueFrequency(self):
+        """
+        Return a two column array of the pixel values (or bin means) with at least one pixel, in increasing order, and
+        the number of pixels with each one.
+        """
+        present = numpy.flatnonzero(self.counts)
+        counts = self.counts[present]
+        if self.isExact:
+            values = (present + self.minValue).astype(numpy.float64)
+        else:
+            values = self.sums[present] / counts
+
+        return numpy.column_stack((values, counts))
+
+class FrameStatistics:
+    """
+    The results of a pass over a frame.  After compute() has been called this holds the row and column means of the
+    frame, and valueFrequency, a two column array of the sorted pixel values in the frame and the number of pixels with
+    each value (the same layout scipy.stats.itemfreq produces).  For frames which can not be counted exactly the values
+    are the means of the bins of a ValueCounter rather than individual values.  NaN pixels are left out of everything,
+    and infinite pixels out of valueFrequency.
+
+    Frames of more than 16 bit integers or of float data take an extra pass to find the range of values to count.
+    """
+    def __init__(self, frame, maxTileBytes=defaultMaxTileBytes, bscale=1, bzero=0):
+        self.frame = frame
+        self.maxTileBytes = maxTileBytes
+        self.bscale = bscale
+        self.bzero = bzero
+
+    def compute(self):
+        numRows, numCols = self.frame.shape
+        self.rowMeans = numpy.empty(numRows)
+        colSums = numpy.zeros(numCols)
+        colCounts = numpy.zeros(numCols, dtype=numpy.int64)
+
+        valueRange = findValueRange(self.frame, self.maxTileBytes, self.bscale, self.bzero)
+        valueCounter = None
+        if valueRange is not None:
+            valueCounter = ValueCounter(valueRange[0], valueRange[1],
+                scalesToIntegers(self.frame.dtype, self.bscale, self.bzero))
+
+        for firstRow, tile in iterateTiles(self.frame, self.maxTileBytes, self.bscale, self.bzero):
+            if tile.dtype.kind == 'f':
+                notNan = ~numpy.isnan(tile)
+                with numpy.errstate(invalid='ignore', divide='ignore'):
+                    self.rowMeans[firstRow:firstRow+tile.shape[0]] = numpy.nansum(tile, axis=1) / notNan.sum(axis=1)
+
+                colSums += numpy.nansum(tile, axis=0)
+                colCounts += notNan.sum(axis=0)
+            else:
+                self.rowMeans[firstRow:firstRow+tile.shape[0]] = tile.mean(axis=1)
+                colSums += tile.sum(axis=0)
+                colCounts += tile.shape[0]
+
+            if valueCounter is not None:
+                valueCounter.add(tile)
+
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            self.colMeans = colSums / colCounts
+
+        if valueCounter is None:
+            self.valueFrequency = numpy.empty((0, 2))
+        else:
+            self.valueFrequency = valueCounter.getValueFrequency()
+
+        return self
+
+def digitizeFrame(frame, bins, maxTileBytes=defaultMaxTileBytes, bscale=1, bzero=0, flip=True):
+    """
+    Return an 8 bit image of the frame with each pixel set to the index of the bin it falls into, out of the given
+    sorted list of bin edges (values below the first edge go into bin 0 and above the last edge into the last bin).  The
+    image is flipped vertically by default since fits images are stored bottom row first.
+    """
+    numRows = frame.shape[0]
+    output = numpy.empty(frame.shape, dtype=numpy.uint8)
+    maxBin = min(len(bins) - 1, 255)
+
+    for firstRow, tile in iterateTiles(frame, maxTileBytes, bscale, bzero):
+        binIndex = numpy.digitize(tile, bins) - 1
+        numpy.clip(binIndex, 0, maxBin, out=binIndex)
+
+        if flip:
+            output[numRows-firstRow-tile.shape[0]:numRows-firstRow] = binIndex[::-1]
+        else:
+            output[firstRow:firstRow+tile.shape[0]] = binIndex
+
+    return output
+
+def weightedMedian(values, counts):
+    """
+    The median of the pixels described by a sorted table of values and counts, with the same definition as numpy.median.
+    """
+    cumulativeCounts = numpy.cumsum(counts)
+    total = cumulativeCounts[-1]
+    lower = values[numpy.searchsorted(cumulativeCounts, (total - 1)//2, side='right')]
+    upper = values[numpy.searchsorted(cumulativeCounts, total//2, side='right')]
+
+    return (lower + upper) / 2.0
+
+def histogramStats(values, counts):
+    """
+    Return the (mean, median, stdDev) of the pixels described by a sorted table of values and counts.
+    """
+    counts = numpy.asarray(counts, dtype=numpy.float64)
+    total = counts.sum()
+    if total == 0:
+        return numpy.nan, numpy.nan, numpy.nan
+
+    mean = (values * counts).sum() / total
+    stdDev = numpy.sqrt((counts * (values - mean)**2).sum() / total)
+
+    return mean, weightedMedian(values, counts), stdDev
+
+def histogramDescribe(values, counts):
+    """
+    The equivalent of scipy.stats.describe for the pixels described by a sorted table of values and counts.  Returns
+    (number, (min, max), mean, variance, skewness, kurtosis) with the same (default) definitions scipy uses.
+    """
+    counts = numpy.asarray(counts, dtype=numpy.float64)
+    total = counts.sum()
+    mean = (values * counts).sum() / total
+    deviations = values - mean
+    m2 = (counts * deviations**2).sum() / total
+    m3 = (counts * deviations**3).sum() / total
+    m4 = (counts * deviations**4).sum() / total
+
+    variance = m2 * total / (total - 1) if total > 1 else numpy.nan
+    skewness = m3 / m2**1.5 if m2 > 0 else 0.0
+    kurtosis = m4 / m2**2 - 3.0 if m2 > 0 else -3.0
+
+    return int(total), (values[0], values[-1]), mean, variance, skewness, kurtosis
+
+def histogramSigmaClippedStats(values, counts, sigma=3, maxiters=3):
+    """
+    The equivalent of astropy's sigma_clipped_stats for the pixels described by a sorted table of values and counts,
+    returning the (mean, median, stdDev) of the pixels left after clipping.
+    """
+    keep = numpy.asarray(counts) > 0
+    for iteration in range(maxiters):
+        mean, median, stdDev = histogramStats(values[keep], counts[keep])
+        newKeep = keep & (numpy.abs(values - median) <= sigma * stdDev)
+        if numpy.array_equal(newKeep, keep):
+            break
+
+        keep = newKeep
+
+    return histogramStats(values[keep], counts[keep])
+
+def takeBathtubRun(counts, first, step, maxTake, remainingPixels, bathtubLimit):
+    """
+    Return the number of entries of counts, starting at index first and moving by step, that the bathtub search strips
+    off in a row, along with the number of pixels in them.  Each entry is stripped if it holds more than bathtubLimit of
+    the pixels remaining once the entries before it have been stripped, and at most maxTake entries are stripped.  The
+    counts are checked in blocks of growing size since the runs are usually only a few entries long.
+    """
+    taken = 0
+    takenPixels = 0
+    blockSize = 16
+    while taken < maxTake:
+        size = min(blockSize, maxTake - taken)
+        start = first + step*taken
+        if step > 0:
+            block = counts[start:start+size]
+        else:
+            block = counts[start-size+1:start+1][::-1]
+
+        strippedBefore = numpy.cumsum(block) - block
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            stripped = block / (remainingPixels - takenPixels - strippedBefore) > bathtubLimit
+
+        if not stripped.all():
+            runLength = int(numpy.argmin(stripped))
+            return taken + runLength, takenPixels + block[:runLength].sum()
+
+        taken += size
+        takenPixels += block.sum()
+        blockSize *= 2
+
+    return taken, takenPixels
+
+def findBathtub(valueFrequency, pixelNumber, bathtubLimit):
+    """
+    Strip off the 'bathtub' values at either end of the histogram, i.e. values at the very bottom or top of the range
+    which hold a suspiciously large fraction of the pixels (saturated pixels, zeroed pixels, etc).  Values are stripped
+    from the bottom and then the top, repeating until neither end has any left to strip, and the search fails if the two
+    ends meet.
+
+    Returns (minIndex, maxIndex, remainingPixels, bathtubIndices, bathtubLow, bathtubHigh, bathtubFail), where minIndex
+    and maxIndex are the first and last entries of valueFrequency left and bathtubIndices lists the stripped entries.
+    """
+    counts = valueFrequency[:, 1]
+    values = valueFrequency[:, 0]
+    minIndex = 0
+    maxIndex = len(counts) - 1
+    remainingPixels = pixelNumber
+    bathtubIndices = []
+    bathtubLow = None
+    bathtubHigh = None
+    bathtubFound = True
+    bathtubFail = False
+
+    while bathtubFound:
+        bathtubFound = False
+
+        runLength, runPixels = takeBathtubRun(counts, minIndex, 1, maxIndex - minIndex, remainingPixels, bathtubLimit)
+        if runLength > 0:
+            bathtubIndices.extend(range(minIndex, minIndex + runLength))
+            minIndex += runLength
+            remainingPixels -= runPixels
+            bathtubLow = values[minIndex - 1]
+            bathtubFound = True
+            if minIndex >= maxIndex:
+                bathtubFail = True
+                bathtubFound = False
+
+        # Once the two ends have met, the top end can still strip one more value before the search gives up.
+        runLength, runPixels = takeBathtubRun(counts, maxIndex, -1, max(maxIndex - minIndex, 1), remainingPixels, bathtubLimit)
+        if runLength > 0:
+            bathtubIndices.extend(range(maxIndex, maxIndex - runLength, -1))
+            maxIndex -= runLength
+            remainingPixels -= runPixels
+            bathtubHigh = values[maxIndex + 1]
+            bathtubFound = True
+            if maxIndex <= minIndex:
+                bathtubFail = True
+                bathtubFound = False
+
+    return minIndex, maxIndex, remainingPixels, bathtubIndices, bathtubLow, bathtubHigh, bathtubFail
+
+def findBlackPoint(valueFrequency, minIndex, ignoredPixels):
+    """
+    Return (blackPoint, index, pixels), where blackPoint is the pixel value below which ignoredPixels of the pixels
+    from minIndex upwards fall (interpolated within the value it lands in), index is the entry it lands in, and pixels
+    is the number of pixels up to and including that entry.
+    """
+    values = valueFrequency[:, 0]
+    cumulativeCounts = numpy.cumsum(valueFrequency[minIndex:, 1])
+    offset = min(int(numpy.searchsorted(cumulativeCounts, ignoredPixels, side='left')), len(cumulativeCounts) - 1)
+    index = minIndex + offset
+
+    if offset == 0 or cumulativeCounts[offset] <= ignoredPixels:
+        blackPoint = values[index]
+    else:
+        includeFraction = (ignoredPixels - cumulativeCounts[offset-1]) / valueFrequency[index, 1]
+        blackPoint = (1.0-includeFraction)*values[index-1] + includeFraction*values[index]
+
+    return blackPoint, index, cumulativeCounts[offset]
+
+def findWhitePoint(valueFrequency, maxIndex, ignoredPixels):
+    """
+    The same as findBlackPoint, but counting down from maxIndex to find the value above which ignoredPixels fall.
+    """
+    values = valueFrequency[:, 0]
+    cumulativeCounts = numpy.cumsum(valueFrequency[maxIndex::-1, 1])
+    offset = min(int(numpy.searchsorted(cumulativeCounts, ignoredPixels, side='left')), len(cumulativeCounts) - 1)
+    index = maxIndex - offset
+
+    if offset == 0 or cumulativeCounts[offset] <= ignoredPixels:
+        whitePoint = values[index]
+    else:
+        includeFraction = (ignoredPixels - cumulativeCounts[offset-1]) / valueFrequency[index, 1]
+        whitePoint = includeFraction*values[index] + (1.0-includeFraction)*values[index+1]
+
+    return whitePoint, index, cumulativeCounts[offset]
@@ -3,11 +3,14 @@ import sqlparse
 import ephem
 import astropy
 
+from django.conf import settings
 from django.contrib.gis.geos import GEOSGeometry, Point
 from photutils.datasets import make_gaussian_sources_image
 from photutils.datasets import make_noise_image
 
 from cosmicapp import models
+from .db import notifyChannel
+from .dispatch import getQueueForProcessInput, newImagePipeline
 from .tasks import *
 from .templatetags.cosmicapp_extras import formatRA, formatDec
 
@@ -353,176 +356,84 @@ def formulateObservingPlan(user, observatory, targets, includeOtherTargets, star
     return observingPlan
 
 def createTasksForNewImage(fileRecord, user, priorityMod=0):
-    with transaction.atomic():
-        imageRecord = models.Image(
-            fileRecord = fileRecord
-            )
-
-        imageRecord.save()
-
-        piImagestats = models.ProcessInput(
-            process = "imagestats",
-            requestor = user,
-            priority = priorityMod + models.ProcessPriority.getPriorityForProcess("imagestats", "batch", user),
-            estCostCPU = fileRecord.uploadSize / 1e6,
-            estCostBandwidth = 0,
-            estCostStorage = 1000,
-            estCostIO = fileRecord.uploadSize
-            )
-
-        piImagestats.save()
-        piImagestats.addArguments([fileRecord.onDiskFileName])
-        piImagestats.images.add(imageRecord)
-
-        piHeaders = models.ProcessInput(
-            process = "parseHeaders",
-            requestor = user,
-            priority = priorityMod + models.ProcessPriority.getPriorityForProcess("parseHeaders", "batch", user),
-            estCostCPU = .1,
-            estCostBandwidth = 0,
-            estCostStorage = 1000,
-            estCostIO = 2000,
-            )
-
-        piHeaders.save()
-        piHeaders.addArguments([imageRecord.pk])
-        piHeaders.prerequisites.add(piImagestats)
-        piHeaders.images.add(imageRecord)
-
-        piThumbnails = models.ProcessInput(
-            process = "generateThumbnails",
-            requestor = user,
-            priority = priorityMod + models.ProcessPriority.getPriorityForProcess("generateThumbnails", "batch", user),
-            estCostCPU = fileRecord.uploadSize / 1e6,
-            estCostBandwidth = 0,
-            estCostStorage = fileRecord.uploadSize / 10,
-            estCostIO = 1.5 * fileRecord.uploadSize
-            )
-
-        piThumbnails.save()
-        piThumbnails.addArguments([fileRecord.onDiskFileName])
-        piThumbnails.images.add(imageRecord)
-        piThumbnails.prerequisites.add(piImagestats)
-
-        piSextractor = models.ProcessInput(
-            process = "sextractor",
+    return createTasksForNewImages([fileRecord], user, priorityMod)[0]
+
+def createTasksForNewImages(fileRecords, user, priorityMod=0, priorityStep=0):
+    """
+    Create an Image record for each of the given uploaded files along with the full chain of processing tasks for it
+    (see cosmicapp.dispatch.newImagePipeline), and return the list of Image records in the same order as the files.  The
+    priority of each successive file's tasks is shifted by priorityStep, so passing a negative step processes the files
+    in the order they were given.
+
+    Everything for every file is built in memory first and then written with a handful of bulk inserts, so the number of
+    queries does not depend on the number of files.  Since bulk_create does not call save() or send any signals, the
+    queue and unmetPrerequisites fields which would normally be filled in by them are set here directly, as is the
+    dedupKey normally set by coalesce(), and the dispatcher is notified once at the end.
+    """
+    processInputs = []
+    processArguments = []
+    imageLinks = []
+    prerequisiteLinks = []
+
+    priorities = {}
+    def addTask(process, imageRecord, priority, argList, prerequisites, **estCosts):
+        if process not in priorities:
+            priorities[process] = models.ProcessPriority.getPriorityForProcess(process, "batch", user)
+
+        pi = models.ProcessInput(
+            process = process,
             requestor = user,
-            priority = priorityMod + models.ProcessPriority.getPriorityForProcess("sextractor", "batch", user),
-            estCostCPU = 0.5 * fileRecord.uploadSize / 1e6,
-            estCostBandwidth = 0,
-            estCostStorage = 3000,
-            estCostIO = fileRecord.uploadSize
+            priority = priority + priorities[process],
+            unmetPrerequisites = len(prerequisites),
+            **estCosts
             )
 
-        piSextractor.save()
-        piSextractor.addArguments([fileRecord.onDiskFileName])
-        piSextractor.images.add(imageRecord)
-        piSextractor.prerequisites.add(piImagestats)
-        piSextractor.prerequisites.add(piHeaders)
-
-        piImage2xy = models.ProcessInput(
-            process = "image2xy",
-            requestor = user,
-            priority = priorityMod + models.ProcessPriority.getPriorityForProcess("image2xy", "batch", user),
-            estCostCPU = 0.5 * fileRecord.uploadSize / 1e6,
-            estCostBandwidth = 0,
-            estCostStorage = 3000,
-            estCostIO = fileRecord.uploadSize
-            )
+        pi.queue = getQueueForProcessInput(pi)
 
-        piImage2xy.save()
-        piImage2xy.addArguments([fileRecord.onDiskFileName])
-        piImage2xy.images.add(imageRecord)
-        piImage2xy.prerequisites.add(piImagestats)
-        piImage2xy.prerequisites.add(piHeaders)
-        piImage2xy.prerequisites.add(piSextractor)
+        # Later submissions of the same job (e.g. from the feedback page) are coalesced into this one.
+        pi.dedupKey = models.ProcessInput.makeDedupKey(process, [str(arg) for arg in argList], [imageRecord.pk])
 
-        piDaofind = models.ProcessInput(
-            process = "daofind",
-            requestor = user,
-            priority = priorityMod + models.ProcessPriority.getPriorityForProcess("daofind", "batch", user),
-            estCostCPU = 0.5 * fileRecord.uploadSize / 1e6,
-            estCostBandwidth = 0,
-            estCostStorage = 3000,
-            estCostIO = fileRecord.uploadSize
-            )
+        processInputs.append(pi)
+        processArguments.append((pi, argList))
+        imageLinks.append((pi, imageRecord))
+        for prerequisite in prerequisites:
+            prerequisiteLinks.append((pi, prerequisite))
 
-        piDaofind.save()
-        piDaofind.addArguments([fileRecord.onDiskFileName])
-        piDaofind.images.add(imageRecord)
-        piDaofind.prerequisites.add(piImagestats)
-        piDaofind.prerequisites.add(piHeaders)
-        piDaofind.prerequisites.add(piSextractor)
+        return pi
 
-        piStarfind = models.ProcessInput(
-            process = "starfind",
-            requestor = user,
-            priority = priorityMod + models.ProcessPriority.getPriorityForProcess("starfind", "batch", user),
-            estCostCPU = 0.5 * fileRecord.uploadSize / 1e6,
-            estCostBandwidth = 0,
-            estCostStorage = 3000,
-            estCostIO = fileRecord.uploadSize
-            )
+    with transaction.atomic():
+        imageRecords = models.Image.objects.bulk_create([models.Image(fileRecord=fileRecord) for fileRecord in fileRecords])
 
-        piStarfind.save()
-        piStarfind.addArguments([fileRecord.onDiskFileName])
-        piStarfind.images.add(imageRecord)
-        piStarfind.prerequisites.add(piImagestats)
-        piStarfind.prerequisites.add(piHeaders)
-        piStarfind.prerequisites.add(piSextractor)
+        for index, (fileRecord, imageRecord) in enumerate(zip(fileRecords, imageRecords)):
+            priority = priorityMod + index*priorityStep
 
-        piFlagSources = models.ProcessInput(
-            process = "flagSources",
-            requestor = user,
-            priority = priorityMod + models.ProcessPriority.getPriorityForProcess("flagSources", "batch", user),
-            estCostCPU = 10,
-            estCostBandwidth = 0,
-            estCostStorage = 3000,
-            estCostIO = 10000
-            )
+            imageTasks = {}
+            for process, prerequisites, argument, estimateCosts in newImagePipeline:
+                arg = fileRecord.onDiskFileName if argument == 'file' else imageRecord.pk
+                imageTasks[process] = addTask(process, imageRecord, priority, [arg],
+                    [imageTasks[prerequisite] for prerequisite in prerequisites], **estimateCosts(fileRecord.uploadSize))
 
-        piFlagSources.save()
-        piFlagSources.addArguments([imageRecord.pk])
-        piFlagSources.images.add(imageRecord)
-        piFlagSources.prerequisites.add(piSextractor)
-        piFlagSources.prerequisites.add(piImage2xy)
-        piFlagSources.prerequisites.add(piDaofind)
-        piFlagSources.prerequisites.add(piStarfind)
+        # Postgres fills in the primary keys on bulk_create, so the tasks can be linked up once they are all written.
+        models.ProcessInput.objects.bulk_create(processInputs)
 
-        piStarmatch = models.ProcessInput(
-            process = "starmatch",
-            requestor = user,
-            priority = priorityMod + models.ProcessPriority.getPriorityForProcess("starmatch", "batch", user),
-            estCostCPU = 10,
-            estCostBandwidth = 0,
-            estCostStorage = 3000,
-            estCostIO = 10000
-            )
+        argumentRecords = []
+        for pi, argList in processArguments:
+            for index, arg in enumerate(argList):
+                argumentRecords.append(models.ProcessArgument(processInput=pi, argIndex=index+1, arg=str(arg)))
 
-        piStarmatch.save()
-        piStarmatch.addArguments([fileRecord.onDiskFileName])
-        piStarmatch.prerequisites.add(piFlagSources)
-        piStarmatch.images.add(imageRecord)
+        models.ProcessArgument.objects.bulk_create(argumentRecords)
 
-        #TODO: Do we need to run flag sources here a second time to flag sources created by starmatch?
+        ImageThrough = models.ProcessInput.images.through
+        ImageThrough.objects.bulk_create([ImageThrough(processinput_id=pi.pk, image_id=imageRecord.pk)
+            for pi, imageRecord in imageLinks])
 
-        piAstrometryNet = models.ProcessInput(
-            process = "astrometryNet",
-            requestor = user,
-            priority = priorityMod + models.ProcessPriority.getPriorityForProcess("astrometryNet", "batch", user),
-            estCostCPU = 100,
-            estCostBandwidth = 3000,
-            estCostStorage = 3000,
-            estCostIO = 10000000000
-            )
+        PrerequisiteThrough = models.ProcessInput.prerequisites.through
+        PrerequisiteThrough.objects.bulk_create([PrerequisiteThrough(from_processinput_id=pi.pk, to_processinput_id=prerequisite.pk)
+            for pi, prerequisite in prerequisiteLinks])
 
-        piAstrometryNet.save()
-        piAstrometryNet.addArguments([fileRecord.onDiskFileName])
-        piAstrometryNet.prerequisites.add(piStarmatch)
-        piAstrometryNet.prerequisites.add(piHeaders)
-        piAstrometryNet.images.add(imageRecord)
+        notifyChannel(settings.DISPATCHER_NOTIFY_CHANNEL)
 
-    return imageRecord
+    return imageRecords
 
 def computeSingleEphemeris(asteroid, ephemTime):
     ephemTimeObject = ephem.Date(ephemTime)
@@ -1,4 +1,6 @@
 import math
+import json
+import hashlib
 from datetime import date, datetime, timedelta, tzinfo
 import pytz
 import ephem
@@ -6,10 +8,12 @@ import numpy
 from astropy import wcs
 import markdown
 
-from django.db import transaction
+from django.db import transaction, connection, IntegrityError
 from django.contrib.gis.db import models
+from django.contrib.postgres.fields import ArrayField
+from django.db.models.functions import Coalesce
 from django.contrib.auth.models import User
-from django.db.models.signals import post_save
+from django.db.models.signals import post_save, m2m_changed
 from django.dispatch import receiver
 from django.contrib.staticfiles.storage import staticfiles_storage
 from django.contrib.staticfiles import finders
@@ -17,8 +21,11 @@ from django.contrib.contenttypes.fields import GenericForeignKey
 from django.contrib.contenttypes.fields import GenericRelation
 from django.contrib.contenttypes.models import ContentType
 from django.utils import timezone
+from django.conf import settings
 
 from .tasks import computeSingleEphemeris
+from .db import notifyChannel, agedPriority
+from .dispatch import getQueueForProcessInput
 
 #TODO:  Need to review the on_delete behaviour of all foreign keys to guarantee references remain intact as needed.
 
@@ -564,8 +571,8 @@ class Image(models.Model, SkyObject, BookmarkableItem):
     def getUrl(self):
         return "/image/" + str(self.pk)
 
-    #TODO: Include image channel in the thumbnail selection.  Make this a pipe char separated list to allow multiple
-    # channels to be returned at once to save on requests.
+    #TODO: Include image channel in the thumbnail selection, only the first channel is returned for now.  Make this a pipe
+    # char separated list to allow multiple channels to be returned at once to save on requests.
     def getThumbnailUrl(self, sizeString, hintWidth=-1, hintHeight=-1, stretch='false'):
         """
         Returns the URL (relative to the website root) of a thumbnail for an image on the site.  If called with just a size
@@ -586,7 +593,7 @@ class Image(models.Model, SkyObject, BookmarkableItem):
 
         # Select a list of all the thumbnails for this image and return the error image if no thumbnails have been generated yet.
         try:
-            records = ImageThumbnail.objects.filter(image__pk=self.pk).order_by('width')
+            records = ImageThumbnail.objects.filter(image__pk=self.pk, channel=0).order_by('width')
         except:
             return thumbnailNotFound
 
@@ -741,9 +748,8 @@ class ImageHeaderField(models.Model):
     (like 'comment' for example) are often long enough to require splitting over multiple lines and thus the order
     should be preserved when displayed.
 
-    #TODO:  Some checking needs to be done on the index field.  I am storing them in the order that image magic spits them
-    out, however the order it gives (at least for fits files) differs from other tools to list headers.  So this index
-    number may not be trustworthy without changing to a different tool for the actual reading of the headers.
+    Headers of fits files are read with astropy, so the index is the order of the cards in the file.  For other image
+    formats the headers come from image magick and the index is the order it lists them in.
     """
     image = models.ForeignKey(Image, db_index=True, on_delete=models.CASCADE)
     index = models.IntegerField(null=True)
@@ -818,16 +824,61 @@ class ImageChannelInfo(models.Model):
     def getColMeanUrl(self):
         return '/static/images/colMeanData_{}_{}.gnuplot.svg'.format(self.image.pk, self.index)
 
-class ImageHistogramBin(models.Model):
-    image = models.ForeignKey(Image, on_delete=models.CASCADE)
-    binCenter = models.FloatField()
-    binCount = models.FloatField()
+    def getRowMeans(self):
+        return ImageSliceMeans.getMeans(self, 'r')
 
-class ImageSliceMean(models.Model):
-    channelInfo = models.ForeignKey(ImageChannelInfo, on_delete=models.CASCADE)
+    def getColMeans(self):
+        return ImageSliceMeans.getMeans(self, 'c')
+
+    def getHistogram(self):
+        """
+        Return the (binCenters, binCounts) numpy arrays of the stored histogram for this channel, or None if there is none.
+        """
+        histogram = ImageHistogram.objects.filter(channelInfo=self).first()
+        if histogram is None:
+            return None
+
+        return numpy.array(histogram.binCenters), numpy.array(histogram.binCounts)
+
+class ImageHistogram(models.Model):
+    """
+    The histogram of a single channel of an image.  The bins are stored as a pair of arrays in a single record, since
+    they are only ever read back all together.
+    """
+    channelInfo = models.ForeignKey(ImageChannelInfo, db_index=True, on_delete=models.CASCADE)
+    binCenters = ArrayField(models.FloatField())
+    binCounts = ArrayField(models.FloatField())
+
+class ImageSliceMeans(models.Model):
+    """
+    The mean pixel value of every row (direction 'r') or every column (direction 'c') of a single channel of an image,
+    stored as a single array indexed by the row or column number.  Use getMeans() to read them back as a numpy array.
+    """
+    channelInfo = models.ForeignKey(ImageChannelInfo, db_index=True, on_delete=models.CASCADE)
     direction = models.CharField(max_length=1)
-    index = models.IntegerField()
-    mean = models.FloatField()
+    means = ArrayField(models.FloatField(null=True))
+
+    class Meta:
+        unique_together = ('channelInfo', 'direction')
+
+    @staticmethod
+    def getMeans(channelInfo, direction):
+        sliceMeans = ImageSliceMeans.objects.filter(channelInfo=channelInfo, direction=direction).first()
+        if sliceMeans is None:
+            return None
+
+        return numpy.array(sliceMeans.means, dtype=numpy.float64)
+
+class ImageBackgroundMap(models.Model):
+    """
+    The sky background level and noise (rms) across a single channel of an image, measured by the backgroundMap task.
+    Each one is stored as a 2D array with one entry per boxSize by boxSize pixel box, indexed [boxRow][boxColumn].  Use
+    framecache.loadBackgroundMaps() to get them interpolated up to the full size of the image.
+    """
+    channelInfo = models.ForeignKey(ImageChannelInfo, db_index=True, on_delete=models.CASCADE)
+    boxSize = models.IntegerField()
+    background = ArrayField(ArrayField(models.FloatField()))
+    rms = ArrayField(ArrayField(models.FloatField()))
 
 class ImageTransform(models.Model):
     """
@@ -952,8 +1003,30 @@ class ProcessInput(models.Model):
     'order of magnitude' estimates, only for task segregation, not for estimating exact runtimes beyond very rough
     estimates (again order of magnitude).
 
+    The queue field is the celery queue the task will be sent to, it is filled in from the process type and the cost
+    estimates when the record is first saved (see cosmicapp.dispatch.getQueueForProcess).
+
+    The taskId field is the celery task id the dispatcher sent the task under, and workerId and leaseExpiry record which
+    celery worker process is running it and until when.  The dispatcher gives the task a short lease to be picked up by
+    a worker, after that the running task itself keeps renewing it (see cosmicapp.tasks.LeasedTask).  Any task whose
+    lease runs out, because the message was lost or the worker running it died, is put back in the queue by whichever
+    dispatcher notices it first, and a late or stale copy of the old celery task is ignored since its id no longer
+    matches taskId.
+
+    The unmetPrerequisites field is a denormalized count of the prerequisites which have not completed yet.  It is
+    incremented when prerequisites are added and decremented in the same transaction that marks a prerequisite completed
+    (see markCompleted()), so the dispatcher can find runnable tasks by just looking for a count of 0 rather than walking
+    the prerequisite tree.  If a prerequisite fails, every task depending on it (directly or indirectly) is marked
+    'failed_prerequisite' instead.
+
+    The dedupKey field is a hash of the process, arguments, and images of a task which is waiting to be run, set by
+    coalesce() (or directly by createTasksForNewImages()).  Submitting the same job again while an identical one is
+    still waiting merges the two instead of running the same thing twice.
+
     #TODO: Document how negative priorities will be handled by the dispatcher, i.e. how do we want to use this.
     """
+    failureStates = ('failure', 'failed_prerequisite')
+
     prerequisites = models.ManyToManyField('self', db_index=True, symmetrical=False)
     process = models.CharField(max_length=32)
     requestor = models.ForeignKey(User, db_index=True, null=True, on_delete=models.CASCADE)
@@ -965,13 +1038,38 @@ class ProcessInput(models.Model):
     estCostStorage = models.BigIntegerField(null=True)
     estCostIO = models.BigIntegerField(null=True)
     completed = models.TextField(db_index=True, null=True, default=None)
-    #NOTE: We may want to add a field or an auto computed field for whether the process can be run now or not.  I.E.
-    # whether it has any unmet prerequisites.
+    unmetPrerequisites = models.IntegerField(default=0)
+    queue = models.CharField(max_length=32, null=True)
+    taskId = models.CharField(max_length=64, null=True)
+    workerId = models.CharField(max_length=128, null=True)
+    leaseExpiry = models.DateTimeField(db_index=True, null=True)
+    dedupKey = models.CharField(max_length=64, null=True)
 
     images = models.ManyToManyField('Image', symmetrical=False, related_name='processInputs')
 
     class Meta:
         ordering = ['-priority', 'submittedDateTime']
+        indexes = [
+            # Only the tasks ready to be dispatched are in this index, so it stays small no matter how large the
+            # backlog of blocked or finished tasks gets.  It is ordered by agedPriority() so the dispatcher can read
+            # the head of the queue straight from the index without sorting.
+            models.Index(agedPriority().desc(), name='processinput_ready_idx',
+                condition=models.Q(completed=None, startedDateTime=None, unmetPrerequisites=0)),
+            # The same ordering over every uncompleted task, used by the process queue page.
+            models.Index(agedPriority().desc(), name='processinput_pending_idx',
+                condition=models.Q(completed=None)),
+            ]
+        constraints = [
+            # At most one identical task can be waiting to be run at a time (see coalesce()).
+            models.UniqueConstraint(fields=['dedupKey'], name='processinput_dedup_unique',
+                condition=models.Q(completed=None, startedDateTime=None)),
+            ]
+
+    def save(self, *args, **kwargs):
+        if self.queue is None:
+            self.queue = getQueueForProcessInput(self)
+
+        super().save(*args, **kwargs)
 
     def addArguments(self, argList):
         index = 1
@@ -985,6 +1083,217 @@ class ProcessInput(models.Model):
             pa.save()
             index += 1
 
+    @staticmethod
+    def makeDedupKey(process, args, imageIds):
+        """
+        Return a hash identifying the job run by a task of the given process with the given argument strings (in order)
+        and image pks.
+        """
+        keyString = json.dumps([process, list(args), sorted(imageIds)])
+        return hashlib.sha256(keyString.encode()).hexdigest()
+
+    def computeDedupKey(self):
+        """
+        Return a hash identifying the job this task will run, i.e. its process, arguments, and images.  The prerequisites
+        are deliberately left out, so the same job submitted from two places with different prerequisites (e.g. a
+        finder re-run from the feedback page and the one still waiting in an image's upload chain) is recognized as the
+        same job.
+        """
+        args = self.arguments.order_by('argIndex').values_list('arg', flat=True)
+        images = self.images.values_list('pk', flat=True)
+
+        return ProcessInput.makeDedupKey(self.process, args, images)
+
+    def getLinkedTaskIds(self, dependents):
+        """
+        Return the set of pks of every task which depends on this one if dependents is True, or which this one depends on
+        if it is False, directly or through any number of intermediate tasks.
+        """
+        field = ProcessInput.prerequisites.field
+        throughTable = field.remote_field.through._meta.db_table
+        if dependents:
+            linkedColumn, matchColumn = field.m2m_column_name(), field.m2m_reverse_name()
+        else:
+            linkedColumn, matchColumn = field.m2m_reverse_name(), field.m2m_column_name()
+
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'WITH RECURSIVE linked(id) AS ( ' +
+                '    SELECT "{0}" FROM "{2}" WHERE "{1}" = %s '.format(linkedColumn, matchColumn, throughTable) +
+                '    UNION ' +
+                '    SELECT t."{0}" FROM "{2}" t JOIN linked l ON t."{1}" = l.id '.format(linkedColumn, matchColumn, throughTable) +
+                ') ' +
+                'SELECT id FROM linked',
+                [self.pk]
+                )
+
+            return set(row[0] for row in cursor.fetchall())
+
+    def coalesce(self):
+        """
+        Merge this task into an identical one which is already waiting to be run, if there is one, and return whichever
+        task is left.  This should be called once the arguments, images, and prerequisites of a newly created task have
+        all been added, and the returned task used in its place from then on.
+
+        When a duplicate is found the surviving task gets the higher of the two priorities and the union of the two sets
+        of prerequisites (leaving out any of this task's prerequisites which have already completed), any tasks
+        depending on this one are moved over to depend on it instead, and this task is deleted.  Since the key does not
+        include the prerequisites, the dependents keep their keys when they are moved over.  If merging would create a
+        cycle, because one of this task's prerequisites depends on the existing task or the existing task depends on one
+        of this task's dependents, the two are left as separate tasks.
+        """
+        with transaction.atomic():
+            key = self.computeDedupKey()
+            existing = ProcessInput.objects.select_for_update()\
+                .filter(dedupKey=key, completed=None, startedDateTime=None)\
+                .exclude(pk=self.pk)\
+                .first()
+
+            if existing is not None:
+                prerequisiteIds = set(self.prerequisites.values_list('pk', flat=True))
+                dependentIds = set(ProcessInput.objects.filter(prerequisites=self).values_list('pk', flat=True))
+                if (prerequisiteIds & (existing.getLinkedTaskIds(True) | {existing.pk})) or \
+                        (dependentIds & existing.getLinkedTaskIds(False)):
+                    existing = None
+                    key = None
+
+            if existing is None:
+                self.dedupKey = key
+                try:
+                    with transaction.atomic():
+                        self.save()
+                except IntegrityError:
+                    # An identical task was coalesced by someone else at the same moment, merge into that one.
+                    self.dedupKey = None
+                    return self.coalesce()
+
+                return self
+
+            if self.priority is not None and (existing.priority is None or self.priority > existing.priority):
+                existing.priority = self.priority
+                existing.save()
+
+            # Adding the prerequisites through the related manager keeps existing.unmetPrerequisites up to date (see
+            # updateUnmetPrerequisites()).
+            newPrerequisites = ProcessInput.objects.filter(pk__in=prerequisiteIds, completed=None)\
+                .exclude(pk__in=existing.prerequisites.values('pk'))
+            existing.prerequisites.add(*newPrerequisites)
+
+            # Move the dependents of this task over to the existing one.  Dependents which already depend on both just
+            # lose the link to this one, which also means one less unmet prerequisite for them.
+            through = ProcessInput.prerequisites.through
+            duplicateLinks = through.objects.filter(to_processinput=self,
+                from_processinput__in=through.objects.filter(to_processinput=existing).values('from_processinput'))
+
+            ProcessInput.objects.filter(pk__in=duplicateLinks.values('from_processinput'), completed=None)\
+                .update(unmetPrerequisites=models.F('unmetPrerequisites') - 1)
+
+            duplicateLinks.delete()
+            through.objects.filter(to_processinput=self).update(to_processinput=existing)
+
+            self.delete()
+            return existing
+
+    def markCompleted(self, completed):
+        """
+        Record the result of running this task and update the tasks depending on it, all in a single transaction.  On
+        success the unmet prerequisite count of each direct dependent is decremented, on failure the failure is cascaded
+        to all of the dependents.
+        """
+        with transaction.atomic():
+            self.completed = completed
+            self.save()
+
+            if completed in ProcessInput.failureStates:
+                self.cascadeFailure()
+            else:
+                ProcessInput.objects.filter(prerequisites=self, completed=None)\
+                    .update(unmetPrerequisites=models.F('unmetPrerequisites') - 1)
+
+    def cascadeFailure(self):
+        """
+        Mark every uncompleted task which depends on this one, directly or through any number of intermediate tasks, as
+        'failed_prerequisite' using a single recursive query.
+        """
+        field = ProcessInput.prerequisites.field
+        throughTable = field.remote_field.through._meta.db_table
+        dependentColumn = field.m2m_column_name()
+        prerequisiteColumn = field.m2m_reverse_name()
+
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'WITH RECURSIVE dependents(id) AS ( ' +
+                '    SELECT "{0}" FROM "{2}" WHERE "{1}" = %s '.format(dependentColumn, prerequisiteColumn, throughTable) +
+                '    UNION ' +
+                '    SELECT t."{0}" FROM "{2}" t JOIN dependents d ON t."{1}" = d.id '.format(dependentColumn, prerequisiteColumn, throughTable) +
+                ') ' +
+                'UPDATE "{0}" SET "completed" = %s, "startedDateTime" = %s '.format(ProcessInput._meta.db_table) +
+                'WHERE "id" IN (SELECT id FROM dependents) AND "completed" IS NULL',
+                [self.pk, 'failed_prerequisite', timezone.now()]
+                )
+
+    @staticmethod
+    def recomputeUnmetPrerequisites():
+        """
+        Rebuild the unmetPrerequisites counts for all uncompleted tasks from the prerequisite table, and cascade any
+        failures which have not been propagated yet.  This is only needed to repair the counts (e.g. after the column is
+        first added), normal operation keeps them up to date incrementally.
+        """
+        through = ProcessInput.prerequisites.through
+        unmetCount = through.objects\
+            .filter(from_processinput=models.OuterRef('pk'), to_processinput__completed=None)\
+            .order_by()\
+            .values('from_processinput')\
+            .annotate(count=models.Count('pk'))\
+            .values('count')
+
+        with transaction.atomic():
+            ProcessInput.objects.filter(completed=None)\
+                .update(unmetPrerequisites=Coalesce(models.Subquery(unmetCount), 0))
+
+            failedPrerequisites = ProcessInput.objects\
+                .filter(completed__in=ProcessInput.failureStates, processinput__completed=None)\
+                .distinct()
+
+            for pi in failedPrerequisites:
+                pi.cascadeFailure()
+
+@receiver(m2m_changed, sender=ProcessInput.prerequisites.through)
+def updateUnmetPrerequisites(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    Keep ProcessInput.unmetPrerequisites in sync when prerequisites are added or removed with the standard related
+    manager methods.  The prerequisite rows are locked while they are counted so that a prerequisite completing at the
+    same moment is either counted here as completed, or sees the new link when it decrements its dependents.
+    """
+    if action not in ('post_add', 'post_remove') or not pk_set:
+        return
+
+    if reverse:
+        links = [(dependentId, instance.pk) for dependentId in pk_set]
+    else:
+        links = [(instance.pk, prerequisiteId) for prerequisiteId in pk_set]
+
+    sign = 1 if action == 'post_add' else -1
+    for dependentId, prerequisiteId in links:
+        prerequisite = ProcessInput.objects.select_for_update().get(pk=prerequisiteId)
+        if prerequisite.completed is None:
+            ProcessInput.objects.filter(pk=dependentId)\
+                .update(unmetPrerequisites=models.F('unmetPrerequisites') + sign)
+        elif prerequisite.completed in ProcessInput.failureStates and action == 'post_add':
+            prerequisite.cascadeFailure()
+
+    if not reverse:
+        instance.refresh_from_db(fields=['unmetPrerequisites', 'completed'])
+
+@receiver(post_save, sender='cosmicapp.ProcessInput')
+def notifyDispatcher(sender, instance, created, **kwargs):
+    """
+    Wake up any dispatchers listening for queue changes whenever a ProcessInput is queued or completed.  The notification
+    is sent through postgres so it is only delivered once the surrounding transaction (if any) commits.
+    """
+    if created or instance.completed is not None:
+        notifyChannel(settings.DISPATCHER_NOTIFY_CHANNEL, instance.pk)
+
 class ProcessOutput(models.Model):
     processInput = models.ForeignKey(ProcessInput, db_index=True, on_delete=models.CASCADE, related_name='processOutput')
     finishedDateTime = models.DateTimeField(auto_now_add=True, null=True)
@@ -1064,12 +1373,23 @@ class SextractorResult(SourceFindResult, BookmarkableItem):
     A record storing a single source detected in an image by the Source Extractor program.
     """
     image = models.ForeignKey(Image, db_index=True, on_delete=models.CASCADE, related_name="sextractorResults")
-    #TODO: Add in a bunch more fields here.
     fluxAuto = models.FloatField(null=True)
     fluxAutoErr = models.FloatField(null=True)
+    magAuto = models.FloatField(null=True)
+    magAutoErr = models.FloatField(null=True)
+    fluxIso = models.FloatField(null=True)
+    fluxIsoErr = models.FloatField(null=True)
+    magIso = models.FloatField(null=True)
+    magIsoErr = models.FloatField(null=True)
+    fluxMax = models.FloatField(null=True)
+    threshold = models.FloatField(null=True)
+    isoArea = models.IntegerField(null=True)
+    fluxRadius = models.FloatField(null=True)
     fwhm = models.FloatField(null=True)
     ellipticity = models.FloatField(null=True)
     flags = models.IntegerField(null=True)
+    xPeak = models.IntegerField(null=True)
+    yPeak = models.IntegerField(null=True)
     boxXMin = models.FloatField(null=True)
     boxYMin = models.FloatField(null=True)
     boxXMax = models.FloatField(null=True)
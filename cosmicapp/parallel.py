@@ -0,0 +1,30 @@
+"""
+Helpers for running the per channel work of a task (statistics, source finding, etc) on several cores of the machine,
+so colour and multi-chip images do not take several times longer to process than single channel ones.
+"""
+import billiard
+
+from django.conf import settings
+
+def getNumChannelWorkers(numChannels):
+    """
+    Return the number of channels mapChannels() will process at once, at most settings.CHANNEL_WORKERS_PER_TASK.
+    """
+    return max(1, min(numChannels, settings.CHANNEL_WORKERS_PER_TASK))
+
+def mapChannels(function, argumentLists):
+    """
+    Call function once for each tuple of arguments in argumentLists and return the results in the same order.  The calls
+    are run in a pool of processes, so function must be a module level function which does not use the database, and
+    its arguments and return value must be picklable.
+
+    The pool is a billiard (celery's fork of multiprocessing) pool rather than a multiprocessing one, since celery's
+    prefork workers are daemonic processes and multiprocessing does not allow those to start processes of their own.
+    Billiard has no such restriction, so the calls run in separate processes both inside a worker and outside of celery.
+    """
+    numWorkers = getNumChannelWorkers(len(argumentLists))
+    if numWorkers == 1:
+        return [function(*arguments) for arguments in argumentLists]
+
+    with billiard.Pool(numWorkers) as pool:
+        return pool.starmap(function, argumentLists)
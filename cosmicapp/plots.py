@@ -0,0 +1,95 @@
+"""
+Simple line plots written straight to SVG files from numpy arrays, used for the small plots on the image pages (row and
+column means, histograms) so that producing them does not need temporary data files or a gnuplot subprocess.
+"""
+import math
+import numpy
+
+def scaleToPixels(data, dataRange, pixelRange, log=False):
+    """
+    Map data values in dataRange linearly (or logarithmically) onto pixelRange.
+    """
+    low, high = dataRange
+    data = numpy.asarray(data, dtype=numpy.float64)
+    if log:
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            data = numpy.log10(data)
+
+        low, high = math.log10(low), math.log10(high)
+
+    if high == low:
+        high = low + 1
+
+    return pixelRange[0] + (data - low) * (pixelRange[1] - pixelRange[0]) / (high - low)
+
+def getRange(data, log=False):
+    data = numpy.asarray(data, dtype=numpy.float64)
+    data = data[numpy.isfinite(data)]
+    if log:
+        data = data[data > 0]
+
+    if len(data) == 0:
+        return (1, 10) if log else (0, 1)
+
+    return data.min(), data.max()
+
+def polylines(xs, ys):
+    """
+    Return the SVG points strings for the line through the given pixel coordinates, split wherever a point is missing
+    (NaN or not plottable on a log scale).
+    """
+    lines = []
+    points = []
+    for x, y in zip(xs, ys):
+        if math.isfinite(x) and math.isfinite(y):
+            points.append('{:.2f},{:.2f}'.format(x, y))
+        elif len(points) > 0:
+            lines.append(' '.join(points))
+            points = []
+
+    if len(points) > 0:
+        lines.append(' '.join(points))
+
+    return lines
+
+def writeLinePlot(filename, series, width, height, xRange=None, yRange=None, logY=False, axes=True):
+    """
+    Write an SVG line plot of one or more series to filename.  Each series is a tuple of (xValues, yValues, color,
+    lineWidth).  The ranges default to the extent of the data.  If axes is False the plot has no border, labels, or
+    margins at all, which is used for the thin row and column mean plots drawn alongside an image.
+    """
+    if xRange is None:
+        xRange = getRange(numpy.concatenate([numpy.asarray(s[0], dtype=numpy.float64) for s in series]))
+
+    if yRange is None:
+        yRange = getRange(numpy.concatenate([numpy.asarray(s[1], dtype=numpy.float64) for s in series]), logY)
+
+    if axes:
+        left, right, top, bottom = 60, width - 10, 10, height - 25
+    else:
+        left, right, top, bottom = 0, width, 0, height
+
+    elements = []
+    for xValues, yValues, color, lineWidth in series:
+        xPixels = scaleToPixels(xValues, xRange, (left, right))
+        yPixels = scaleToPixels(yValues, yRange, (bottom, top), logY)
+        for points in polylines(xPixels, yPixels):
+            elements.append('<polyline fill="none" stroke="{}" stroke-width="{}" points="{}"/>'.format(color, lineWidth, points))
+
+    if axes:
+        elements.append('<rect x="{}" y="{}" width="{}" height="{}" fill="none" stroke="black"/>'.format(
+            left, top, right - left, bottom - top))
+
+        textStyle = 'font-family="Arial" font-size="11"'
+        elements.append('<text x="{}" y="{}" {}>{:.6g}</text>'.format(left, height - 8, textStyle, xRange[0]))
+        elements.append('<text x="{}" y="{}" text-anchor="end" {}>{:.6g}</text>'.format(right, height - 8, textStyle, xRange[1]))
+        elements.append('<text x="{}" y="{}" text-anchor="end" {}>{:.6g}</text>'.format(left - 4, bottom, textStyle, yRange[0]))
+        elements.append('<text x="{}" y="{}" text-anchor="end" {}>{:.6g}</text>'.format(left - 4, top + 10, textStyle, yRange[1]))
+
+    with open(filename, 'w') as outputFile:
+        outputFile.write('<?xml version="1.0" encoding="utf-8" standalone="yes"?>\n')
+        outputFile.write('<svg xmlns="http://www.w3.org/2000/svg" width="{0:.0f}" height="{1:.0f}" viewBox="0 0 {0:.0f} {1:.0f}">\n'.format(width, height))
+        for element in elements:
+            outputFile.write(element + '\n')
+
+        outputFile.write('</svg>\n')
@@ -0,0 +1,125 @@
+"""
+The pure numpy parts of running the photutils star finders (daofind and starfind) on an image: splitting a frame into
+overlapping tiles which can be searched independently, searching a single tile, and counting the peaks in the data at a
+ladder of detection thresholds so the threshold can be tuned in one step.  Nothing here touches the database, so the
+tiles can be searched in separate processes (see findSourcesInChannels in cosmicapp.tasks).
+"""
+import math
+import numpy
+import scipy.ndimage
+
+# The default width and height in pixels of the tiles daofind and starfind split frames into, overridden by the
+# 'sourcefindTileSize' CosmicVariable.
+defaultSourcefindTileSize = 4096
+
+# The detection threshold multipliers (in standard deviations above background) the number of peaks in an image is
+# counted at, see countPeaksAtThresholds().
+thresholdLadder = numpy.arange(0.25, 20.25, 0.25)
+
+def countPeaksAtThresholds(data, fwhm, thresholds, core=(slice(None), slice(None))):
+    """
+    Return the number of local maxima in the background subtracted data above each of the given thresholds, only
+    counting the ones inside the core (a tuple of row and column slices) if it is given.  The data is smoothed by a
+    gaussian the size of a star and the peaks found once, so counting them at any number of thresholds only costs a sort
+    and a binary search rather than running a source finder at each one.
+    """
+    smoothed = scipy.ndimage.gaussian_filter(numpy.asarray(data, dtype=numpy.float32), fwhm / 2.3548)
+    isPeak = smoothed == scipy.ndimage.maximum_filter(smoothed, size=max(3, 2*int(fwhm) + 1))
+    isPeak &= smoothed > numpy.min(thresholds)
+    smoothed = smoothed[core]
+    isPeak = isPeak[core]
+
+    peakValues = numpy.sort(smoothed[isPeak])
+    return len(peakValues) - numpy.searchsorted(peakValues, thresholds, side='right')
+
+def getMultiplierFromThresholdCurve(thresholdCurve, previousMultiplier, previousNumFound, targetNumFound):
+    """
+    Return the detection threshold multiplier expected to make a source finder find targetNumFound sources, given the
+    number it found last time and the (multiplier, number of peaks) thresholdCurve measured on the same run, or None if
+    the curve can not be used.
+
+    The peaks counted by countPeaksAtThresholds() are not exactly the sources the finder reports, so the curve is
+    calibrated by the ratio between the multiplier the finder was run at and the point on the curve where the number of
+    peaks matches what it found.
+    """
+    multipliers, counts = numpy.array(thresholdCurve, dtype=numpy.float64).T
+    if previousNumFound <= 0 or counts.max() <= 0:
+        return None
+
+    # The counts fall as the threshold rises, so they are reversed to interpolate the multiplier as a function of count.
+    logCounts = numpy.log(counts[::-1] + 1)
+    previousCurveMultiplier = numpy.interp(numpy.log(previousNumFound + 1), logCounts, multipliers[::-1])
+    targetCurveMultiplier = numpy.interp(numpy.log(targetNumFound + 1), logCounts, multipliers[::-1])
+
+    return float(previousMultiplier * targetCurveMultiplier / previousCurveMultiplier)
+
+def getSourcefindTiles(width, height, tileSize):
+    """
+    Return a list of (top, bottom, left, right) bounds of the tiles a frame of the given size is split into for source
+    finding, covering the frame without overlapping.  If the size is not known the whole frame is a single tile, with
+    None for the bottom and right edges.
+    """
+    if width is None or height is None:
+        return [(0, None, 0, None)]
+
+    width = int(width)
+    height = int(height)
+    tiles = []
+    for top in range(0, height, tileSize):
+        for left in range(0, width, tileSize):
+            tiles.append((top, min(top + tileSize, height), left, min(left + tileSize, width)))
+
+    return tiles
+
+def getSourcefindTileMargin(fwhm):
+    """
+    Return the number of pixels each tile is extended by on every side when it is passed to the source finder.  This has
+    to cover everything the finder looks at around a source (the convolution kernel, the minimum separation between
+    peaks, and the cutout the centroid and shape are measured from) so that the sources in the core of the tile come out
+    exactly as they would from a run on the whole frame.
+    """
+    return int(math.ceil(4*fwhm)) + 8
+
+def findSourcesInTile(finderClass, data, background, rms, origin, tile, fwhm, detectThresholdMultiplier, noise, bgMedian,
+        typicalRms, countPeaks=False):
+    """
+    Run the given photutils star finder class on a single tile of a single channel of an image with a threshold of
+    detectThresholdMultiplier times noise, and return a tuple of the table of sources found with their centroid in the
+    tile (in whole frame coordinates) and, if countPeaks is True, the number of peaks in the tile at each multiplier in
+    thresholdLadder (otherwise None).  The data is the slice of the frame covering the tile plus a margin overlapping the
+    tiles around it (see getSourcefindTileMargin()) with its top left corner at origin, and the sources found in the
+    margin are left for the tile they are centered in.
+
+    Without a background map (background and rms are None) the single bgMedian is subtracted and the threshold is used
+    as is.  With one, background and rms are the matching slices of the full resolution maps.  The background is
+    subtracted instead and the data is scaled by the local noise relative to typicalRms, the median rms of the map, so
+    the threshold (which was worked out from the median rms) is the same number of standard deviations above the
+    background everywhere in the frame while fluxes stay in roughly the original units.
+    """
+    top, bottom, left, right = tile
+    originY, originX = origin
+
+    if background is None:
+        data = data - bgMedian
+    else:
+        data = (data - background) * (typicalRms / numpy.maximum(rms, 1e-3*typicalRms))
+
+    finder = finderClass(fwhm = fwhm, threshold = detectThresholdMultiplier*noise)
+    sources = finder(data)
+
+    if sources is not None:
+        sources['xcentroid'] += originX
+        sources['ycentroid'] += originY
+
+        # Each source is kept by the one tile containing the pixel its centroid falls in, so the sources found twice in
+        # the overlap between two tiles are only kept once.
+        pixelX = numpy.floor(numpy.asarray(sources['xcentroid']) + 0.5)
+        pixelY = numpy.floor(numpy.asarray(sources['ycentroid']) + 0.5)
+        sources = sources[(pixelX >= left) & (pixelX < right) & (pixelY >= top) & (pixelY < bottom)]
+
+    peakCounts = None
+    if countPeaks:
+        core = (slice(top - originY, bottom - originY), slice(left - originX, right - originX))
+        peakCounts = countPeaksAtThresholds(data, fwhm, thresholdLadder*noise, core)
+
+    return (sources, peakCounts)
@@ -1,22 +1,21 @@
 from __future__ import absolute_import, unicode_literals
-from celery import shared_task
-from django.db import transaction
+from celery import shared_task, Task
+from celery.exceptions import Ignore
+from django.db import transaction, connection, DatabaseError
 from django.conf import settings
-from django.db.models import Avg, StdDev
 from django.contrib.gis.geos import GEOSGeometry
 from django.core.files.storage import FileSystemStorage
 from django.db.models import Sum, Max
 from django.utils import timezone
 
 import subprocess
+import threading
 import json
 import sys
 import os
 import time
-import re
 import itertools
 import math
-import random
 import dateparser
 import scipy
 import imageio
@@ -27,20 +26,27 @@ from datetime import timedelta
 import julian
 import time
 import hashlib
+import shutil
 
 from astropy import wcs
 from astropy import units as u
 from astropy.io import fits
-from astropy.stats import sigma_clipped_stats
-from astropy.table import Table
+from astropy.table import Table, vstack
 from astropy.nddata import CCDData
 from photutils import make_source_mask, DAOStarFinder, IRAFStarFinder
 from ccdproc import Combiner, wcs_project
-from collections import Counter
-from sortedcontainers import SortedList, SortedDict, SortedListWithKey
+from sortedcontainers import SortedDict, SortedListWithKey
 
 from cosmicapp import models
 from .functions import *
+from .framestats import *
+from .plots import writeLinePlot
+from .framecache import loadFrame, loadBackgroundMaps
+from .background import defaultBoxSize, measureBackgroundGrid
+from .sourcefind import defaultSourcefindTileSize, thresholdLadder, getMultiplierFromThresholdCurve, getSourcefindTiles, \
+    getSourcefindTileMargin, findSourcesInTile
+from .parallel import getNumChannelWorkers, mapChannels
+from .thumbnails import makeThumbnailPyramid, makeTileLevels, getTileFolder, getTileLevelFilename
 
 def longestCommonPrefix(string1, string2):
     length = 0
@@ -52,8 +58,30 @@ def longestCommonPrefix(string1, string2):
 
     return str(string1)[0:length]
 
-def sigmoid(x):
-    return 1 / (1 + math.exp(-x))
+def getConfidences(values):
+    """
+    Return an array of the confidence of each of the given source brightness values, the sigmoid of how many standard
+    deviations each one is above the mean of all of them, so bright sources get a confidence near 1.  Values which are
+    NaN are left out of the mean and get a confidence of NaN, and if every value is the same they all get 0.5.
+    """
+    values = numpy.asarray(values, dtype=numpy.float64)
+    if numpy.count_nonzero(numpy.isfinite(values)) == 0:
+        return numpy.full(len(values), numpy.nan)
+
+    stdDev = numpy.nanstd(values)
+    if not stdDev > 0:
+        return numpy.where(numpy.isnan(values), numpy.nan, 0.5)
+
+    with numpy.errstate(over='ignore'):
+        return 1 / (1 + numpy.exp(-(values - numpy.nanmean(values)) / stdDev))
+
+def setConfidences(results, values):
+    """
+    Set the confidence of each of the given (unsaved) source find results from the matching entry in values, see
+    getConfidences().
+    """
+    for result, confidence in zip(results, getConfidences(values)):
+        result.confidence = None if numpy.isnan(confidence) else float(confidence)
 
 def constructProcessOutput(outputText, errorText, executionTime=None):
     """ A Simple convenience function to construct a ProcessOutput object to be returned to the dispatcher. """
@@ -65,7 +93,186 @@ def constructProcessOutput(outputText, errorText, executionTime=None):
 
     return processOutput
 
+def renewLease(processInputId, taskId, workerId):
+    """
+    Extend the lease on the given ProcessInput for the worker running it, as long as it is still waiting on the celery
+    task with the given id.  Returns False if it is not, because the lease ran out and the task was put back in the
+    queue, or it has already been completed.
+    """
+    leaseExpiry = timezone.now() + timedelta(seconds=settings.TASK_LEASE_SECONDS)
+    return models.ProcessInput.objects\
+        .filter(pk=processInputId, taskId=taskId, completed=None)\
+        .update(workerId=workerId, leaseExpiry=leaseExpiry) > 0
+
+class LeaseHeartbeat(threading.Thread):
+    """
+    A thread which renews the lease on a ProcessInput every settings.TASK_HEARTBEAT_SECONDS until it is stopped.
+    """
+    def __init__(self, processInputId, taskId, workerId):
+        super().__init__(daemon=True)
+        self.processInputId = processInputId
+        self.taskId = taskId
+        self.workerId = workerId
+        self.stopped = threading.Event()
+
+    def run(self):
+        try:
+            while not self.stopped.wait(settings.TASK_HEARTBEAT_SECONDS):
+                try:
+                    renewLease(self.processInputId, self.taskId, self.workerId)
+                except DatabaseError as e:
+                    # Try again on the next beat with a fresh connection, the lease has some slack to cover this.
+                    print('Failed to renew lease on process input {}: {}'.format(self.processInputId, e))
+                    sys.stdout.flush()
+                    connection.close()
+        finally:
+            connection.close()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+class LeasedTask(Task):
+    """
+    The base class of the tasks sent by the dispatcher, which ties the lease on the ProcessInput being run to the worker
+    process actually running it.  The lease is taken over from the dispatcher when the task starts and renewed by a
+    heartbeat thread until it finishes, so the task is only put back in the queue if the worker stops running it.  A
+    task whose ProcessInput has already been put back in the queue (or completed) under a different celery task id is
+    ignored rather than run a second time.
+
+    The tasks take the pk of their ProcessInput as their last argument, when one is called directly rather than through
+    celery there is no lease to keep and it is just run.
+    """
+    def __call__(self, *args, **kwargs):
+        processInputId = kwargs.get('processInputId', args[-1] if len(args) > 0 else None)
+        if self.request.id is None or processInputId is None:
+            return super().__call__(*args, **kwargs)
+
+        workerId = '{}:{}'.format(self.request.hostname, os.getpid())
+        if not renewLease(processInputId, self.request.id, workerId):
+            print('Process input {} is no longer waiting on task {}, ignoring it.'.format(processInputId, self.request.id))
+            sys.stdout.flush()
+            raise Ignore()
+
+        heartbeat = LeaseHeartbeat(processInputId, self.request.id, workerId)
+        heartbeat.start()
+        try:
+            return super().__call__(*args, **kwargs)
+        finally:
+            heartbeat.stop()
+
+def recordProcessResult(processInputId, result, taskId=None):
+    """
+    Write the value returned by a finished task back to the database, either success, failure, or error (early exit).
+    Tasks which return a ProcessOutput dict also get a ProcessOutput and a SiteCost record for the cpu time they used.
+    Everything is written in one transaction together with the completion status so the dependents of the task are
+    released at the same moment it is marked completed.  If taskId is given the result is only recorded if the
+    ProcessInput is still waiting on that celery task, not if it was put back in the queue and sent out again since.
+    """
+    with transaction.atomic():
+        processInput = models.ProcessInput.objects.select_for_update().get(pk=processInputId)
+        if processInput.completed is not None:
+            return processInput.completed
+
+        if taskId is not None and processInput.taskId != taskId:
+            return None
+
+        if isinstance(result, dict):
+            cost = result['executionTime'] * models.CosmicVariable.getVariable('cpuCostPerSecond')
+            processOutput = models.ProcessOutput(
+                processInput = processInput,
+                outputText = result['outputText'],
+                outputErrorText = result['outputErrorText'],
+                actualCostCPU = result['executionTime'],
+                actualCost = cost
+                )
+
+            processOutput.save()
+
+            siteCost = models.SiteCost(
+                user = processInput.requestor,
+                dateTime = timezone.now(),
+                text = 'Process input ' + str(processInput.pk),
+                cost = cost
+                )
+
+            siteCost.save()
+
+            completed = 'success.'
+        elif result == True:
+            completed = 'success'
+        elif result == False:
+            completed = 'failure'
+        else:
+            completed = str(result)
+
+        processInput.markCompleted(completed)
+
+    return completed
+
+@shared_task
+def processInputCompleted(result, processInputId, taskId=None):
+    """
+    A celery callback linked to every task sent by the dispatcher.  Celery runs it with the return value of the task as
+    soon as the task finishes, so nothing has to sit and poll for the result.
+    """
+    return recordProcessResult(processInputId, result, taskId)
+
 @shared_task
+def processInputFailed(request, exc, traceback, processInputId):
+    """
+    The error callback linked to every task sent by the dispatcher, called by celery if the task raises an exception.
+    """
+    return recordProcessResult(processInputId, exc, request.id)
+
+def readFitsHeaders(filename):
+    """
+    Read the structure and header cards of a fits file using astropy, without reading any of the pixel data.  Returns a
+    list of frames in the same form as the JSON imagestats builds from the output of 'identify' (one entry per image
+    plane, each with a width, height, depth, and channels), and a list of (key, value) pairs for the header cards, named
+    the same way 'identify' names them (e.g. 'fits:bitpix') so they are interchangeable with its output.
+    """
+    frames = []
+    headerPairs = []
+    with fits.open(filename, memmap=True) as hdulist:
+        for hdu in hdulist:
+            header = hdu.header
+            naxis = header.get('NAXIS', 0)
+
+            # Tables and empty primary HDUs have no image data, they still have headers worth recording though.
+            if not hdu.is_image or naxis < 2:
+                numPlanes = 0
+            elif naxis == 2:
+                numPlanes = 1
+            else:
+                numPlanes = header.get('NAXIS3', 1)
+
+            for plane in range(numPlanes):
+                frames.append({
+                    'width': header['NAXIS1'],
+                    'height': header['NAXIS2'],
+                    'depth': abs(header['BITPIX']),
+                    'channels': 'gray'
+                    })
+
+            for card in header.cards:
+                key = 'fits:' + card.keyword.lower()
+                if card.keyword in ['COMMENT', 'HISTORY', '']:
+                    value = str(card.value)
+                elif len(card.image) == 80:
+                    # Keep the value and comment exactly as written in the file.
+                    value = card.image[10:]
+                else:
+                    # Long string values continued over several cards.
+                    value = "'{}'".format(card.value)
+                    if card.comment != '':
+                        value += ' / ' + card.comment
+
+                headerPairs.append((key, value.strip()))
+
+    return frames, headerPairs
+
+@shared_task(base=LeasedTask)
 def imagestats(filename, processInputId):
     """
     A celery task to read an image file and record stats about the basic structure of the
@@ -81,29 +288,41 @@ def imagestats(filename, processInputId):
     errorText = ""
     taskStartTime = time.time()
 
-    # Run the command line tool 'identify' (part of image magick) with a format string
-    # given to it, causing it to return JSON formatted output which we then parse with the
-    # standard JSON parsing library.
-    formatString = '{"width" : %w, "height" : %h, "depth" : %z, "channels" : "%[channels]"},'
-    proc = subprocess.Popen(['identify', '-format', formatString, settings.MEDIA_ROOT + filename],
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE)
+    isFits = os.path.splitext(filename)[-1].lower() in settings.SUPPORTED_IMAGE_TYPES
 
-    output, error = proc.communicate()
-    output = output.decode('utf-8')
-    error = error.decode('utf-8')
+    if isFits:
+        # Fits files have everything we need in their headers, which astropy can read without decoding any of the
+        # pixel data the way 'identify' does.
+        jsonObject, headerPairs = readFitsHeaders(settings.MEDIA_ROOT + filename)
+        error = ""
 
-    proc.wait()
+        outputText += json.dumps(jsonObject)
+        outputText += '\n ==================== End of fits header output ====================\n\n'
 
-    output = output.rstrip().rstrip(',')
-    output = '[' + output + ']'
+    else:
+        # Run the command line tool 'identify' (part of image magick) with a format string
+        # given to it, causing it to return JSON formatted output which we then parse with the
+        # standard JSON parsing library.
+        formatString = '{"width" : %w, "height" : %h, "depth" : %z, "channels" : "%[channels]"},'
+        proc = subprocess.Popen(['identify', '-format', formatString, settings.MEDIA_ROOT + filename],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE)
 
-    outputText += output
-    errorText += error
-    outputText += '\n ==================== End of process output ====================\n\n'
-    errorText += '\n ==================== End of process error =====================\n\n'
+        output, error = proc.communicate()
+        output = output.decode('utf-8')
+        error = error.decode('utf-8')
+
+        proc.wait()
 
-    jsonObject = json.loads(output)
+        output = output.rstrip().rstrip(',')
+        output = '[' + output + ']'
+
+        outputText += output
+        errorText += error
+        outputText += '\n ==================== End of process output ====================\n\n'
+        errorText += '\n ==================== End of process error =====================\n\n'
+
+        jsonObject = json.loads(output)
 
     # Loop over the channels that image magick found and for each one, record what kind of
     # color channel image magick thought it was.  We also handle multicolor entries like
@@ -157,32 +376,28 @@ def imagestats(filename, processInputId):
         else:
             image.save()
 
-    # Run the command line tool 'identify' (part of image magick) with a format string to
-    # print all key-value metadata pairs in the image header.
-    formatString = '%[*]'
-    proc = subprocess.Popen(['identify', '-format', formatString, settings.MEDIA_ROOT + filename],
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE)
-
-    output2, error2 = proc.communicate()
-    output2 = output2.decode('utf-8')
-    error2 = error2.decode('utf-8')
-
-    proc.wait()
+    if not isFits:
+        # Run the command line tool 'identify' (part of image magick) with a format string to
+        # print all key-value metadata pairs in the image header.
+        formatString = '%[*]'
+        proc = subprocess.Popen(['identify', '-format', formatString, settings.MEDIA_ROOT + filename],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE)
 
-    outputText += '\n ===============================================================\n\n'
-    outputText += output2
-    outputText += '\n ==================== End of process output ====================\n\n'
-    errorText += '\n ===============================================================\n\n'
-    errorText += error2
-    errorText += '\n ==================== End of process error =====================\n\n'
+        output2, error2 = proc.communicate()
+        output2 = output2.decode('utf-8')
+        error2 = error2.decode('utf-8')
 
+        proc.wait()
 
-    outputText += "imagestats:tags: " + filename + "\n"
+        outputText += '\n ===============================================================\n\n'
+        outputText += output2
+        outputText += '\n ==================== End of process output ====================\n\n'
+        errorText += '\n ===============================================================\n\n'
+        errorText += error2
+        errorText += '\n ==================== End of process error =====================\n\n'
 
-    with transaction.atomic():
-        i = 0
-        #TODO: Long lines starting with 'HISTORY' in the fits headers do not seem to be output by ImageMagick in the same way that 'COMMENT' lines are.  We may need to submit a ticket about this or something.
+        headerPairs = []
         for line in output2.splitlines():
             split = line.split('=', 1)
             key = ''
@@ -204,6 +419,14 @@ def imagestats(filename, processInputId):
                 #TODO: Throw an error or something.
                 continue
 
+            headerPairs.append((key, value))
+
+
+    outputText += "imagestats:tags: " + filename + "\n"
+
+    with transaction.atomic():
+        i = 0
+        for key, value in headerPairs:
             if key == "" or value == "" or key in settings.IGNORED_KEYS:
                 continue
 
@@ -236,7 +459,7 @@ def imagestats(filename, processInputId):
             models.ImageHeaderField.objects.bulk_create(headerFields)
 
     outputText += "imagestats:wcs: " + filename + "\n"
-    if os.path.splitext(filename)[-1].lower() in settings.SUPPORTED_IMAGE_TYPES:
+    if isFits:
         # FIXME: Bug with image from DSLR with astronomy.net plate solution
         """FITS WCS distortion paper lookup tables and SIP distortions only work in 2
         dimensions. However, WCSLIB has detected 3 dimensions in the core WCS keywords. To
@@ -275,726 +498,240 @@ def imagestats(filename, processInputId):
     #   3: Detect haze and clouds
 
     outputText += "imagestats:histogram: " + filename + "\n"
-    if os.path.splitext(filename)[-1].lower() in settings.SUPPORTED_IMAGE_TYPES:
-        hdulist = fits.open(settings.MEDIA_ROOT + filename)
-        with transaction.atomic():
+    if isFits:
+        # The data is memory mapped and left unscaled, the frame statistics read and scale it a few rows at a time so
+        # the memory used stays under maxTileBytes no matter how large the frame is.  The channels are analyzed in
+        # parallel by imagestatsChannel(), so the limit is split between the channels being worked on at once.
+        maxTileBytes = models.CosmicVariable.getVariable('imagestatsMaxTileBytes')
+        if maxTileBytes is None:
+            maxTileBytes = defaultMaxTileBytes
+
+        ignoreLower = models.CosmicVariable.getVariable('histogramIgnoreLower') / 100.0
+        ignoreUpper = models.CosmicVariable.getVariable('histogramIgnoreUpper') / 100.0
+
+        channelInfos = {}
+        for channelInfo in models.ImageChannelInfo.objects.filter(image=image):
+            channelInfos[channelInfo.index] = channelInfo
+
+        # Work out which hdu and frame each channel comes from.
+        channelFrames = []
+        with fits.open(settings.MEDIA_ROOT + filename, memmap=True, do_not_scale_image_data=True) as hdulist:
             channelIndex = 0
             hduIndex = 0
             for hdu in hdulist:
-                frames = []
-                #TODO: Check that this is really image data and not a table, etc.
+                if not hdu.is_image or hdu.data is None:
+                    hduIndex += 1
+                    continue
+
                 if len(hdu.data.shape) == 2:
-                    frames.append(hdu.data)
+                    numFrames = 1
 
                 elif len(hdu.data.shape) == 3:
-                    for i in range(hdu.data.shape[0]):
-                        frames.append(hdu.data[channelIndex+i])
+                    numFrames = hdu.data.shape[0]
 
                 else:
                     #TODO: Throw an error.
-                    pass
-
-                frameIndex = 0
-                for frame in frames:
-                    try:
-                        channelInfo = models.ImageChannelInfo.objects.get(image=image, index=channelIndex)
-                    except:
-                        outputText += '\n\nERROR: continuing loop because channel info not found. id: {} index: {}\n\n\n'.format(image.pk, channelIndex)
-                        continue
+                    numFrames = 0
 
-                    outputText += "Starting analysis of channel: {}\n\n".format(channelIndex)
-                    startms = int(1000 * time.time())
-                    # TODO: Need to filter all non-data pixels
-                    #   NOTE: now finds and removes bathtub pixels
-
-                    # Compute and store the row and column averages for the image frame.
-                    outputText += "Computing row and column mean values ... "
-                    msec = int(1000 * time.time())
-                    rowMeans = numpy.nanmean(frame, axis=1)
-                    colMeans = numpy.nanmean(frame, axis=0)
-
-                    imageSliceMeans = []
-                    for direction, means in [('r', rowMeans), ('c', colMeans)]:
-                        for mean, index in zip(means, range(len(means))):
-                            imageSliceMean = models.ImageSliceMean(
-                                channelInfo = channelInfo,
-                                direction = direction,
-                                index = index,
-                                mean = mean
-                                )
-
-                            imageSliceMeans.append(imageSliceMean)
-
-                    models.ImageSliceMean.objects.bulk_create(imageSliceMeans)
-
-                    msec = int(1000 * time.time()) - msec
-                    outputText += "completed: {}ms\n".format(msec)
-
-                    for direction, means, xsize, ysize, rangeString, usingString in [
-                            ('row', rowMeans, 75, 900*(frame.shape[0]/frame.shape[1]), 'set yrange [0:{}]'.format(frame.shape[0]), 'using 1:0'),
-                            ('col', colMeans, 900, 75, 'set xrange [0:{}]'.format(frame.shape[1]), 'using 0:1')
-                            ]:
-                        dataFilename = direction + "MeanData_{}_{}.txt".format(image.pk, channelIndex)
-                        plotFilename = direction + "MeanData_{}_{}.gnuplot".format(image.pk, channelIndex)
-                        imageFilename = direction + "MeanData_{}_{}.gnuplot.svg".format(image.pk, channelIndex)
-                        with open(settings.MEDIA_ROOT + dataFilename, "w") as outputFile:
-                            for mean in means:
-                                outputFile.write("{}\n".format(mean))
-
-                        with open(settings.MEDIA_ROOT + plotFilename, "w") as outputFile:
-                            outputFile.write("set terminal svg size {},{} dynamic mouse standalone\n".format(xsize, ysize) +
-                                             "set output '{}'\n".format(settings.COSMIC_STATIC + "images/" + imageFilename) +
-                                             "set lmargin 0\n" +
-                                             "set rmargin 0\n" +
-                                             "set tmargin 0\n" +
-                                             "set bmargin 0\n" +
-                                             "set key off\n" +
-                                             rangeString + "\n" +
-                                             "set format x \"\"\n" +
-                                             "set format y \"\"\n" +
-                                             "plot '{}' {} with lines".format(settings.MEDIA_ROOT + dataFilename, usingString))
-
-                        outputText += "Generating {} mean image ... ".format(direction)
-                        msec = int(1000 * time.time())
-                        proc = subprocess.Popen(['gnuplot', settings.MEDIA_ROOT + plotFilename],
-                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-                        output, error = proc.communicate()
-                        output = output.decode('utf-8')
-                        error = error.decode('utf-8')
-                        proc.wait()
-                        msec = int(1000 * time.time()) - msec
-                        errorText += '==================== start process error ====================\n'
-                        errorText += error
-                        errorText += '===================== end process error =====================\n'
-                        outputText += "completed: {}ms\n".format(msec)
-                        outputText += '==================== start process output ====================\n'
-                        outputText += output
-                        outputText += '===================== end process output =====================\n'
-
-                    # Count all pixel values into a 2D numpy array. Column 1 contains
-                    # sorted, unique values from the frame, and column 2 contains the
-                    # respective count.
-                    outputText += "Counting pixel values ... "
-                    msec = int(1000 * time.time())
-                    # FIXME: More sophisticated pixel count than xdim * ydim
-                    # NOTE: Partially implemented with masking below
-                    pixelNumber = frame.shape[0]*frame.shape[1]
-                    valueFrequency = scipy.stats.itemfreq(frame)
-                    pixelValues = valueFrequency.take(0, axis=1)
-                    pixelCounts = valueFrequency.take(1, axis=1)
-                    uniquePixelValues = valueFrequency.shape[0]
-                    approximateBitDepth = round(math.log(uniquePixelValues, 2),2)
-                    minIndex = 0
-                    maxIndex = uniquePixelValues - 1
-                    minValue = valueFrequency[minIndex][0]
-                    maxValue = valueFrequency[maxIndex][0]
-                    msec = int(1000 * time.time()) - msec
-                    outputText += "completed: {}ms\n".format(msec)
-                    outputText += "pixel number: {}\n".format(pixelNumber)
-                    outputText += "minValue: {}\n".format(minValue)
-                    outputText += "maxValue: {}\n".format(maxValue)
-                    outputText += "unique values: {}\n".format(uniquePixelValues)
-                    outputText += "approximate bits/pixel: {}\n".format(approximateBitDepth)
-                    outputText += "\n"
-
-                    # Now we will do some trimming
-                    currentPixelNumber = pixelNumber
-                    outputText += "Searching for bathtub pixel values ... "
-                    msec = int(1000 * time.time())
-                    currentPixelValueNumber = uniquePixelValues
-                    bathtubLimit = 0.25 / 100 / 2
-                    bathtubValues = SortedDict()
-                    bathtubValueNumber = 0
-                    bathtubPixelNumber = 0
-                    bathtubLow = None
-                    bathtubHigh = None
-                    bathtubFound = True
-                    bathtubFail = False
-                    while bathtubFound :
-                        bathtubFound = False
-                        while valueFrequency[minIndex][1] / currentPixelNumber > bathtubLimit :
-                            value, count = valueFrequency[minIndex]
-                            bathtubValues[value] = int(count)
-                            minIndex += 1
-                            currentPixelNumber -= count
-                            bathtubPixelNumber += count
-                            bathtubLow = value
-                            currentPixelValueNumber -= 1
-                            bathtubValueNumber += 1
-                            bathtubFound = True
-                            if minIndex >= maxIndex :
-                                bathtubFail = True
-                                bathtubFound = False
-                                break
-                        while valueFrequency[maxIndex][1] / currentPixelNumber > bathtubLimit :
-                            value, count = valueFrequency[maxIndex]
-                            bathtubValues[value] = int(count)
-                            maxIndex -= 1
-                            currentPixelNumber -= count
-                            bathtubPixelNumber += count
-                            bathtubHigh = value
-                            currentPixelValueNumber -= 1
-                            bathtubValueNumber += 1
-                            bathtubFound = True
-                            if maxIndex <= minIndex :
-                                bathtubFail = True
-                                bathtubFound = False
-                                break
-                    if bathtubPixelNumber / currentPixelNumber > 1./3 :
-                        outputText += "\nToo many suspect bathtub pixels found!\n"
-                        outputText += "Recording bathtub values, but resetting min and max values.\n"
-                        minIndex = 0
-                        maxIndex = uniquePixelValues - 1
-                        currentPixelNumber += bathtubPixelNumber
-                        currentPixelValueNumber += bathtubValueNumber
-                        bathtubFail = True
-                    minValue = valueFrequency[minIndex][0]
-                    maxValue = valueFrequency[maxIndex][0]
-                    msec = int(1000 * time.time()) - msec
-                    outputText += "completed: {}ms\n".format(msec)
-                    outputText += "bathtub limit: {}%\n".format(100*bathtubLimit)
-                    outputText += "total bathtub values: {}, {}%\n".format( bathtubValueNumber,
-                        round(100*bathtubValueNumber/(bathtubValueNumber + currentPixelValueNumber),4))
-                    outputText += "total bathtub pixels: {}, {}%\n".format(bathtubPixelNumber,
-                        round(100*bathtubPixelNumber/(bathtubPixelNumber + currentPixelNumber),4))
-                    outputText += "bathtub (value,pixels): " + str(list(bathtubValues.items())) + "\n"
-                    outputText += "highest low bathtub value: {}\n".format(bathtubLow)
-                    outputText += "lowest high bathtub value: {}\n".format(bathtubHigh)
-                    outputText += "remaining values: {}, {}%\n".format( currentPixelValueNumber,
-                        round(100*currentPixelValueNumber/(bathtubValueNumber + currentPixelValueNumber),4))
-                    outputText += "remaining pixels: {}, {}%\n".format(currentPixelNumber,
-                        round(100*currentPixelNumber/(bathtubPixelNumber + currentPixelNumber),4))
-                    outputText += "remaining min(Index, Value): ({}, {})\n".format(minIndex, minValue)
-                    outputText += "remaining max(Index, Value): ({}, {})\n".format(maxIndex, maxValue)
-                    outputText += "\n"
-
-
-                    # Get pixel value bounds assuming we will ignore the values for some
-                    # percentage of the brightest and darkest pixels when making thumbnails.
-                    # I can't believe I can't suss out the syntax for a do while loop. I
-                    # guess the internet is sometimes useful ... or maybe I should have
-                    # kept that little python o'rielys pocketbook.  Hmm ... books.
-                    outputText += "Finding dark and light points ... "
-                    msec = int(1000 * time.time())
-                    ignoreLower = models.CosmicVariable.getVariable('histogramIgnoreLower') / 100.0
-                    ignoredLowerValue = valueFrequency[minIndex][0]
-                    ignoredLowerPixels = valueFrequency[minIndex][1]
-                    while ignoredLowerPixels < ignoreLower * currentPixelNumber :
-                        minIndex += 1
-                        peekValue, peekPixels = valueFrequency[minIndex]
-                        if ignoredLowerPixels + peekPixels > ignoreLower * currentPixelNumber :
-                            includeFraction = (ignoreLower * currentPixelNumber - ignoredLowerPixels) / peekPixels
-                            ignoredLowerValue = (1.0-includeFraction)*valueFrequency[minIndex-1][0] + includeFraction*peekValue
-                        else :
-                            ignoredLowerValue = peekValue
-                        ignoredLowerPixels += peekPixels
-                    ignoreUpper = models.CosmicVariable.getVariable('histogramIgnoreUpper') / 100.0
-                    ignoredUpperValue, ignoredUpperPixels = valueFrequency[maxIndex]
-                    while ignoredUpperPixels < ignoreUpper * currentPixelNumber :
-                        maxIndex -= 1
-                        peekValue, peekPixels = valueFrequency[maxIndex]
-                        if ignoredUpperPixels + peekPixels > ignoreUpper * currentPixelNumber :
-                            includeFraction = (ignoreUpper * currentPixelNumber - ignoredUpperPixels) / peekPixels
-                            ignoredUpperValue = includeFraction*peekValue + (1.0-includeFraction)*valueFrequency[maxIndex+1][0]
-                        else :
-                            ignoredUpperValue = peekValue
-                        ignoredUpperPixels += peekPixels
-                    minValue = valueFrequency[minIndex][0]
-                    maxValue = valueFrequency[maxIndex][0]
-                    msec = int(1000 * time.time()) - msec
-                    outputText += "completed: {}ms\n".format(msec)
-                    outputText += "dark point {}, contains {} pixels, {}%, {}% of originial frame\n".format(
-                        ignoredLowerValue, ignoredLowerPixels,
-                        round(100*ignoredLowerPixels / currentPixelNumber, 4),
-                        round(100*ignoredLowerPixels / pixelNumber, 4) )
-                    outputText += "light point {}, contains {} pixels, {}%, {}% of originial frame\n".format(
-                        ignoredUpperValue, ignoredUpperPixels,
-                        round(100*ignoredUpperPixels / currentPixelNumber, 4),
-                        round(100*ignoredUpperPixels / pixelNumber, 4) )
-                    outputText += "min(Index, Value): ({}, {})\n".format(minIndex, minValue)
-                    outputText += "max(Index, Value): ({}, {})\n".format(maxIndex, maxValue)
-                    outputText += "\n"
-
-
-                    # Get the mean value of remaining pixels to calculate gamma correction
-                    outputText += "Finding mean value of clipped pixels ... "
-                    msec = int(1000 * time.time())
-                    unclippedPixelNumber = currentPixelNumber - ignoredLowerPixels - ignoredUpperPixels
-                    meanUnclippedPixels = sum( pixelValues[minIndex:maxIndex] *
-                        pixelCounts[minIndex:maxIndex] ) / unclippedPixelNumber
-                    mean = sum( pixelValues[minIndex:maxIndex] * pixelCounts[minIndex:maxIndex] ) / unclippedPixelNumber
-                    meanFrac = (meanUnclippedPixels - minValue)/(maxValue - minValue)
-                    targetMean = 0.8 * minValue + 0.2 * maxValue
-                    targetMeanFrac = (targetMean - minValue)/(maxValue - minValue)
-                    gammaCorrection = math.log(meanFrac)/math.log(targetMeanFrac)
-                    msec = int(1000 * time.time()) - msec
-                    outputText += "completed: {}ms\n".format(msec)
-                    outputText += "mean: {}, {}%\n".format(meanUnclippedPixels,meanFrac)
-                    outputText += "targetmean: {}, {}%\n".format(targetMean,targetMeanFrac)
-                    outputText += "gamma: {}\n".format(gammaCorrection)
-                    outputText += "\n"
-
-
-                    # Digitize and rebin the the value counts to a histogram
-                    outputText += "Generating histograms from value counts ... "
-                    msec = int(1000 * time.time())
-                    thumbnailBitDepth = 8
-                    binNumber = pow(2, thumbnailBitDepth)
-                    binsLinear = minValue + (maxValue - minValue) * numpy.linspace(0, 1, binNumber)
-                    binsGamma = minValue + (maxValue - minValue) * pow(numpy.linspace(0, 1, binNumber), gammaCorrection)
-                    binAssignLinear = numpy.digitize(pixelValues.clip(minValue, maxValue), binsLinear)
-                    binAssignGamma = numpy.digitize(pixelValues.clip(minValue, maxValue), binsGamma)
-                    histCountLinear = numpy.bincount(binAssignLinear, pixelCounts, binNumber)
-                    histCountGamma = numpy.bincount(binAssignGamma, pixelCounts, binNumber)
-                    histContribLinear = pixelCounts / histCountLinear[binAssignLinear]
-                    histContribGamma = pixelCounts / histCountGamma[binAssignGamma]
-                    histCenterLinear = numpy.bincount(binAssignLinear, pixelValues * histContribLinear, binNumber)
-                    histCenterGamma = numpy.bincount(binAssignGamma, pixelValues * histContribGamma, binNumber)
-                    msec = int(1000 * time.time()) - msec
-                    outputText += "completed: {}ms\n".format(msec)
-                    outputText += "digitized bits/pixel: {}\n".format(thumbnailBitDepth)
-                    outputText += "digitized shades: {}\n".format(binNumber)
-                    outputText += "\n"
-
-
-                    # Generate fast histogram for image info page
-                    outputText += "Writing histograms to file ... "
-                    msec = int(1000 * time.time())
-                    histDataFilename = "histogramData_{}_{}.txt".format(image.pk, channelIndex)
-                    histPlotFilename = "histogramData_{}_{}.gnuplot".format(image.pk, channelIndex)
-                    histImageFilename = "histogramData_{}_{}.gnuplot.svg".format(image.pk, channelIndex)
-                    histDataLongFilename = settings.MEDIA_ROOT + histDataFilename
-                    histPlotLongFilename = settings.MEDIA_ROOT + histPlotFilename
-                    histImageLongFilename = settings.COSMIC_STATIC + "images/" + histImageFilename
-                    with open(histDataLongFilename, "w") as outputFile :
-                        for i in range(binNumber) :
-                            outputFile.write("{} {} {} {}\n".format(
-                                histCenterLinear[i],
-                                histCountLinear[i],
-                                histCenterGamma[i],
-                                histCountGamma[i]
-                            ))
-                    with open(histPlotLongFilename, "w") as outputFile :
-                        outputFile.write("set terminal svg size 400,300 dynamic mouse standalone\n" +
-                                         "set output '{}'\n".format(histImageLongFilename) +
-                                         "set key off\n" +
-                                         "set logscale y\n" +
-                                         "set xrange [{}:{}]\n".format(minValue, maxValue) +
-                                         "set style line 1 linewidth 3 linecolor 'blue'\n" +
-                                         "set style line 2 linewidth 2 linecolor 'red'\n" +
-                                         "plot '{}' using 1:2 with lines linestyle 1, ".format(histDataLongFilename) +
-                                         "'' using 3:4 with lines linestyle 2\n")
-                    msec = int(1000 * time.time()) - msec
-                    outputText += "completed: {}ms\n".format(msec)
-                    outputText += "histogram data file: {}\n".format(histDataFilename)
-                    outputText += "histogram plot file: {}\n".format(histPlotFilename)
-                    outputText += "\n"
-
-
-                    # Run gnuplot
-                    outputText += "Generating histogram image ... "
-                    msec = int(1000 * time.time())
-                    proc = subprocess.Popen(['gnuplot', histPlotLongFilename],
-                        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-                    output, error = proc.communicate()
-                    output = output.decode('utf-8')
-                    error = error.decode('utf-8')
-                    proc.wait()
-                    msec = int(1000 * time.time()) - msec
-                    errorText += '==================== start process error ====================\n'
-                    errorText += error
-                    errorText += '===================== end process error =====================\n'
-                    outputText += "completed: {}ms\n".format(msec)
-                    outputText += '==================== start process output ====================\n'
-                    outputText += output
-                    outputText += '===================== end process output =====================\n'
-                    outputText += "histogram image file: {}\n".format(histImageFilename)
-                    outputText += "\n"
-
-
-                    # Digitize the raw value counts into an image
-                    if channelIndex == 0 :
-                        outputText += "Digitizing the frame to a full size image ... "
-                        msec = int(1000 * time.time())
-                        binNumber = pow(2, thumbnailBitDepth)
-                        binsGamma = minValue + (maxValue - minValue) * pow(numpy.linspace(0, 1, binNumber), gammaCorrection)
-                        binAssignment = numpy.digitize(frame.clip(minValue, maxValue), binsGamma)
-                        msec = int(1000 * time.time()) - msec
-                        outputText += "completed: {}ms\n".format(msec)
-                        outputText += "\n"
-
-
-                    # Write the gamma corrected png full size thumbnail.
-                    outputText += "Writing full size png thumbnail ... "
-                    pngImageFilename = os.path.splitext(filename)[0] + "_thumb_full.png"
-                    ydim, xdim = binAssignment.shape
-                    msec = int(1000 * time.time())
-                    imageio.imwrite(settings.COSMIC_STATIC + "images/" + pngImageFilename, numpy.flip(binAssignment, axis=0), optimize=True, bits=8)
-                    msec = int(1000 * time.time()) - msec
-                    outputText += "completed: {}ms\n\n".format(msec)
-
-                    # Create a database record for the thumbnail.
-                    if channelIndex == 0:
-                        record = models.ImageThumbnail(
-                            image = image,
-                            width = xdim,
-                            height = ydim,
-                            size = 'full',
-                            channel = channelIndex,
-                            filename = pngImageFilename
-                            )
+                for frameIndex in range(numFrames):
+                    if channelIndex in channelInfos:
+                        channelFrames.append((hduIndex, frameIndex, channelIndex))
+                    else:
+                        outputText += '\n\nERROR: skipping channel because channel info not found. id: {} index: {}\n\n\n'.format(image.pk, channelIndex)
 
-                        record.save()
-
-                    #TODO: Look into this masking and potentially record the masked pixel
-                    # data as a stored thing which can be accessed later on.
-                    # Create frame mask
-                    outputText += "Generating frame mask ... "
-                    msec = int(1000 * time.time())
-                    # mask = make_source_mask(frame, snr=10, npixels=5, dilate_size=11)
-                    rejectValues = numpy.array([])
-                    rejectPixelNumber = 0
-                    bathtubRejects = numpy.array(bathtubValues.keys())
-                    bathtubPixelCounts = numpy.array(bathtubValues.values())
-                    if not bathtubFail and bathtubRejects.shape[0] > 0 :
-                        rejectValues = numpy.union1d(rejectValues, bathtubRejects)
-                        rejectPixelNumber += sum(bathtubPixelCounts)
-                    otherRejects = numpy.array([])
-                    if otherRejects.shape[0] > 0 :
-                        rejectValues = numpy.union1d(rejectValues, otherRejects)
-                    moreRejects = numpy.array([])
-                    if moreRejects.shape[0] > 0 :
-                        rejectValues = numpy.union1d(rejectValues, moreRejects)
-                    rejectValueNumber = rejectValues.shape[0]
-                    mask = numpy.ma.in1d(frame.ravel(), rejectValues).reshape(frame.shape)
-                    maskedFrame = numpy.ma.masked_array(frame, mask)
-                    msec = int(1000 * time.time()) - msec
-                    outputText += "completed: {}ms\n".format(msec)
-                    outputText += "masked values: {}\n".format(rejectValueNumber)
-                    outputText += "masked pixels: {}\n".format(rejectPixelNumber)
-                    outputText += "\n"
-
-
-                    # Get statistics on unmasked frame
-                    outputText += "Non-masked frame statistics ... "
-                    msec = int(1000 * time.time())
-                    ( nonmaskedNumber, (nonmaskedMin, nonmaskedMax),
-                      nonmaskedMean, nonmaskedVariance,
-                      nonmaskedSkewness, nonmaskedKurtosis ) = scipy.stats.describe(frame.ravel(), nan_policy='omit')
-                    msec = int(1000 * time.time()) - msec
-                    outputText += "completed: {}ms\n".format(msec)
-                    outputText += "pixels: {}\n".format(nonmaskedNumber)
-                    outputText += "min: {}\n".format(nonmaskedMin)
-                    outputText += "max: {}\n".format(nonmaskedMax)
-                    outputText += "mean: {}\n".format(nonmaskedMean)
-                    outputText += "variance: {}\n".format(nonmaskedVariance)
-                    outputText += "skewness: {}\n".format(nonmaskedSkewness)
-                    outputText += "kurtosis: {}\n".format(nonmaskedKurtosis)
-                    outputText += "\n"
-
-
-                    # Get statistics on masked frame
-                    outputText += "Getting statistics on masked frame ... "
-                    msec = int(1000 * time.time())
-                    maskedMean = numpy.nanmean(maskedFrame)
-                    maskedMedian = numpy.nanmedian(maskedFrame)
-                    maskedStdDev = numpy.nanstd(maskedFrame)
-                    # Converges well with 3 iterations.  Half as much time as maxiters=None
-                    bgMean, bgMedian, bgStdDev = sigma_clipped_stats(maskedFrame, sigma=3, maxiters=3)
-                    msec = int(1000 * time.time()) - msec
-                    outputText += "completed: {}ms\n".format(msec)
-                    outputText += "mean: {}\n".format(maskedMean)
-                    outputText += "median: {}\n".format(maskedMedian)
-                    outputText += "stdDev: {}\n".format(maskedStdDev)
-                    outputText += "background mean: {}\n".format(bgMean)
-                    outputText += "background median: {}\n".format(bgMedian)
-                    outputText += "background stdDev: {}\n".format(bgStdDev)
-                    outputText += "\n"
-
-                    channelInfo.hduIndex = hduIndex
-                    channelInfo.frameIndex = frameIndex
-                    channelInfo.mean = maskedMean
-                    channelInfo.median = maskedMedian
-                    channelInfo.stdDev = maskedStdDev
-                    channelInfo.bgMean = bgMean
-                    channelInfo.bgMedian = bgMedian
-                    channelInfo.bgStdDev = bgStdDev
-                    channelInfo.pixelNumber = pixelNumber
-                    channelInfo.minValue = nonmaskedMin
-                    channelInfo.maxValue = nonmaskedMax
-                    channelInfo.uniqueValues = uniquePixelValues
-                    channelInfo.approximateBits = approximateBitDepth
-                    channelInfo.bathtubLimit = bathtubLimit
-                    channelInfo.bathtubValueNumber = bathtubValueNumber
-                    channelInfo.bathtubPixelNumber = bathtubPixelNumber
-                    channelInfo.bathtubLow = bathtubLow
-                    channelInfo.bathtubHigh = bathtubHigh
-                    channelInfo.thumbnailBlackPoint = ignoredLowerValue
-                    channelInfo.thumbnailWhitePoint = ignoredUpperValue
-                    channelInfo.thumbnailGamma = gammaCorrection
-                    channelInfo.maskedValues = rejectValueNumber
-                    channelInfo.maskedPixels = rejectPixelNumber
-
-                    channelInfo.save()
-
-                    frameIndex += 1
                     channelIndex += 1
 
-            hduIndex += 1
+                hduIndex += 1
+
+        channelMaxTileBytes = max(1, maxTileBytes // getNumChannelWorkers(len(channelFrames)))
+        argumentLists = []
+        for hduIndex, frameIndex, channelIndex in channelFrames:
+            argumentLists.append((filename, image.pk, hduIndex, frameIndex, channelIndex, channelMaxTileBytes,
+                ignoreLower, ignoreUpper))
+
+        results = mapChannels(imagestatsChannel, argumentLists)
+
+        with transaction.atomic():
+            imageSliceMeans = []
+            imageHistograms = []
+            imageThumbnails = []
+            for (hduIndex, frameIndex, channelIndex), result in zip(channelFrames, results):
+                outputText += result['outputText']
+                channelInfo = channelInfos[channelIndex]
+
+                for direction, means in result['sliceMeans'].items():
+                    imageSliceMeans.append(models.ImageSliceMeans(
+                        channelInfo = channelInfo,
+                        direction = direction,
+                        means = means
+                        ))
+
+                imageHistograms.append(models.ImageHistogram(
+                    channelInfo = channelInfo,
+                    binCenters = result['histogramCenters'],
+                    binCounts = result['histogramCounts']
+                    ))
+
+                thumbnailFilename, xdim, ydim = result['thumbnail']
+                imageThumbnails.append(models.ImageThumbnail(
+                    image = image,
+                    width = xdim,
+                    height = ydim,
+                    size = 'full',
+                    channel = channelIndex,
+                    filename = thumbnailFilename
+                    ))
+
+                channelInfo.hduIndex = hduIndex
+                channelInfo.frameIndex = frameIndex
+                for key, value in result['stats'].items():
+                    setattr(channelInfo, key, value)
+
+                channelInfo.save()
 
-        hdulist.close()
+            models.ImageSliceMeans.objects.bulk_create(imageSliceMeans)
+            models.ImageHistogram.objects.bulk_create(imageHistograms)
+            models.ImageThumbnail.objects.bulk_create(imageThumbnails)
 
         numChannels = models.ImageChannelInfo.objects.filter(image=image).count()
         image.addImageProperty('totalNumChannels', numChannels)
 
     return constructProcessOutput(outputText, errorText, time.time() - taskStartTime)
 
-# TODO: Histogram of FITS data (count vs adu) in linear and logarithmic (if possible?).
-# Needs to be high resolution, but deal efficiently with large swaths of 0-count.  Must
-# ignore non-data pixels properly. Design as per discussion.
+def imagestatsChannel(filename, imageId, hduIndex, frameIndex, channelIndex, maxTileBytes, ignoreLower, ignoreUpper):
+    """
+    Compute the statistics, plots, and full size thumbnail of one channel of a fits image for imagestats.  This is run
+    for each channel in parallel by mapChannels(), so rather than touching the database it returns a dict of everything
+    to be stored for the channel along with its part of the task output.
+    """
+    outputText = ""
 
-# TODO: Fit a gaussian curve to the dark pixels in the histogram.
-#   Histogram area used for fitting should start at the darkest populated pixel and extend
-#   to include at least * 10% of the total data pixels and as many further bins as
-#   improves + fitting metric.
-# NOTE: Extending past the * 10% may be tricky.  Though we are assumed to be in a dense
-# region there may be empty bins or features that result in the addition of * one bin to be
-# detrimental to the fitting metric, but adding * two bins improves the fit.
-#   Step by a minimum number of pixels rather than by number of bins.  Set number of pixels
-#   as some percentage of the total pixels * 1%, or as a percentage of the pixels used in the
-#   fitting so far * 10%.
-# * Arbitrary value
-# + Mimize sum of square of difference, or something more clever.
-#   Maybe too clever: minimize \sum_{i=0}^{b(n)} \frac{w_i^2 (f_i - c_i)^2}{n^a}, where
-#       n = number of pixels used to fit
-#       b(n) = minimum bin number with n cumulative pixels
-#       w_i = width of bin i
-#       f_i = value of functional fit at bin i
-#       c_i = count at bin i
-#       a = coeffecient ... suspect = 1
-#   Now, vary n along with coeffecients of f
+    hdulist = fits.open(settings.MEDIA_ROOT + filename, memmap=True, do_not_scale_image_data=True)
+    hdu = hdulist[hduIndex]
+    bscale = hdu.header.get('BSCALE', 1)
+    bzero = hdu.header.get('BZERO', 0)
+
+    if len(hdu.data.shape) == 2:
+        frame = hdu.data
+    else:
+        frame = hdu.data[frameIndex]
+
+    outputText += "Starting analysis of channel: {}\n\n".format(channelIndex)
+    startms = int(1000 * time.time())
+    # TODO: Need to filter all non-data pixels
+    #   NOTE: now finds and removes bathtub pixels
 
-# Generate a histogram for initial image analysis.
-
-# Due to the nature of the data, naive histogram approaches with even
-# very many fixed width bins often fail to produce satisfactory
-# results.
-
-# Here we count every pixel value.  An individual pixel value count
-# represents samples of the image in the neighborhood of that value.
-# The neighborhood of a pixel value is the interval half way to the
-# next lowest and highest value.
-
-# The histogram is constructed from the counts by dividing the counts
-# by the width of the neighborhood for each pixel value found.
-
-# Compression of the histogram is accomplished by the following process:
-#   1: Select a pixel value at random
-#       1a: Generate a random sequence of the indexes
-#       1b: Subtract from the index the count of deleted indices less
-#       than the generated index to generate an index to the squozen
-#       data.
-#   2: Perform a trial deletion of the pixel value, where the nearest
-#   two values and counts are adjusted minimize distortion of the
-#   histogram and preserve total count.
-#   3: Accept deletion randomly based on percent error of histogram
-#   introduced by the deletion.
-#       3a: Record the index of deleted value/count pairs.
-#   4: Repeat above until all pixel values have been tested exactly
-#   once.  Note that a pixel value and count changed by a deletion
-#   process may still be selected for trial deletion if it had not yet
-#   been selected.
-#   5: If histogram is still too large, loosen acception criteria and
-#   repeat.
-def depricatedHistogram(frame) :
-    def overlapError(x, a):
-        """ Computes the percent overlap of the histogram defined by two
-        sets of bin center / bin count pairs. """
-        aCenters = numpy.array(a.keys())
-        aCounts = numpy.array(a.values())
-        bCenters = numpy.array([ aCenters[0], x[0], x[2], aCenters[4] ])
-        bCounts = numpy.array([ aCounts[0], x[1], x[3], aCounts[4] ])
-        assert( len(bCenters) + 1 == len(aCenters) )
-
-        aLeft = numpy.array([
-            1.5*aCenters[0] - 0.5*aCenters[1],
-            0.5*aCenters[0] + 0.5*aCenters[1],
-            0.5*aCenters[1] + 0.5*aCenters[2],
-            0.5*aCenters[2] + 0.5*aCenters[3],
-            0.5*aCenters[3] + 0.5*aCenters[4]
-            ])
-
-        bLeft = numpy.array([
-            1.5*bCenters[0] - 0.5*bCenters[1],
-            0.5*bCenters[0] + 0.5*bCenters[1],
-            0.5*bCenters[1] + 0.5*bCenters[2],
-            0.5*bCenters[2] + 0.5*bCenters[3]
-            ])
-
-        aRight = numpy.array([
-            0.5*aCenters[0] + 0.5*aCenters[1],
-            0.5*aCenters[1] + 0.5*aCenters[2],
-            0.5*aCenters[2] + 0.5*aCenters[3],
-            0.5*aCenters[3] + 0.5*aCenters[4],
-            1.5*aCenters[4] - 0.5*aCenters[3]
-            ])
-
-        bRight = numpy.array([
-            0.5*bCenters[0] + 0.5*bCenters[1],
-            0.5*bCenters[1] + 0.5*bCenters[2],
-            0.5*bCenters[2] + 0.5*bCenters[3],
-            1.5*bCenters[3] - 0.5*bCenters[2],
-            ])
-
-        aWidth = aRight - aLeft
-        bWidth = bRight - bLeft
-
-        aHistogram = aCounts / aWidth
-        bHistogram = bCounts / bWidth
-
-        overlapHeightMins = numpy.empty([5,4])
-        overlapHeightMins.flat = list( min(x,y) for (x,y) in
-            itertools.product(aHistogram,bHistogram) )
-
-        overlapLeftMaxs = numpy.empty([5,4])
-        overlapLeftMaxs.flat = list( max(x,y) for (x,y) in
-            itertools.product(aLeft,bLeft) )
-
-        overlapRightMins = numpy.empty([5,4])
-        overlapRightMins.flat = list( min(x,y) for (x,y) in
-            itertools.product(aRight,bRight) )
-
-        overlapWidths = overlapRightMins - overlapLeftMaxs
-
-        overlapMask = overlapRightMins > overlapLeftMaxs
-
-        overlapAreas = overlapMask * overlapHeightMins * overlapWidths
-
-        initialArea = sum(aCounts)
-        totalOverlapArea = sum(overlapAreas.flat)
-        # Scale relative to overall contribution
-        fitness = (initialArea - totalOverlapArea) / currentPixelNumber
-        fitness *= fitness
-
-        fitnessJacobian = numpy.zeros([4])
-
-        return fitness
-
-    def conserveTotalPixelCountConstraint(x, total):
-        return (x[1] + x[3]) - total
-
-    # Perform initial statistics
-    # TODO: prefilter known bad values from frame
-    outputText += "Initial frame statistics ... "
+    # Compute the row and column averages and count the pixel values in a single pass over the frame.
+    outputText += "Computing row and column mean values and counting pixel values ... "
     msec = int(1000 * time.time())
-    ( pixelNumber, (pixelValueMin, pixelValueMax),
-      pixelValueMean, pixelValueVariance,
-      pixelValueSkewness, pixelValueKurtosis ) = scipy.stats.describe(frame.flat)
-    currentPixelNumber = pixelNumber
+    frameStats = FrameStatistics(frame, maxTileBytes, bscale, bzero).compute()
+    rowMeans = frameStats.rowMeans
+    colMeans = frameStats.colMeans
+
+    # NaN means (rows or columns with no data) are stored as nulls.
+    sliceMeans = {}
+    for direction, means in [('r', rowMeans), ('c', colMeans)]:
+        sliceMeans[direction] = [None if math.isnan(mean) else float(mean) for mean in means]
+
     msec = int(1000 * time.time()) - msec
     outputText += "completed: {}ms\n".format(msec)
-    outputText += "data pixels:  " + str(pixelNumber) + "\n"
-    outputText += "min: " + str(pixelValueMin) + "\n"
-    outputText += "max: " + str(pixelValueMax) + "\n"
-    outputText += "mean: " + str(pixelValueMean) + "\n"
-    outputText += "variance: " + str(pixelValueVariance) + "\n"
-    outputText += "skewness: " + str(pixelValueSkewness) + "\n"
-    outputText += "kurtosis:  " + str(pixelValueKurtosis) + "\n"
-    outputText += "\n"
 
+    # The plots keep the '.gnuplot.svg' names the image pages already link to.
+    for direction, means, xsize, ysize in [
+            ('row', rowMeans, 75, 900*(frame.shape[0]/frame.shape[1])),
+            ('col', colMeans, 900, 75)
+            ]:
+        imageFilename = direction + "MeanData_{}_{}.gnuplot.svg".format(imageId, channelIndex)
+        indices = numpy.arange(len(means))
 
-    # Count all pixel values into a sorted dict with key of the pixel
-    # value and the value is the number of pixels with that value.
-    outputText += "Counting pixel values ... "
+        outputText += "Generating {} mean image ... ".format(direction)
+        msec = int(1000 * time.time())
+        if direction == 'row':
+            writeLinePlot(settings.COSMIC_STATIC + "images/" + imageFilename, [(means, indices, 'black', 1)],
+                xsize, ysize, yRange=(0, frame.shape[0]), axes=False)
+        else:
+            writeLinePlot(settings.COSMIC_STATIC + "images/" + imageFilename, [(indices, means, 'black', 1)],
+                xsize, ysize, xRange=(0, frame.shape[1]), axes=False)
+        msec = int(1000 * time.time()) - msec
+        outputText += "completed: {}ms\n".format(msec)
+
+    # The pixel values were counted into a 2D numpy array above. Column 1
+    # contains sorted, unique values from the frame, and column 2 contains
+    # the respective count.
+    outputText += "Reading pixel value counts ... "
     msec = int(1000 * time.time())
-    pixelCounts = SortedDict(Counter(frame.flat))
-    uniquePixelValues = len(pixelCounts)
+    # FIXME: More sophisticated pixel count than xdim * ydim
+    # NOTE: Partially implemented with masking below
+    pixelNumber = frame.shape[0]*frame.shape[1]
+    valueFrequency = frameStats.valueFrequency
+    pixelValues = valueFrequency.take(0, axis=1)
+    pixelCounts = valueFrequency.take(1, axis=1)
+    uniquePixelValues = valueFrequency.shape[0]
     approximateBitDepth = round(math.log(uniquePixelValues, 2),2)
+    minIndex = 0
+    maxIndex = uniquePixelValues - 1
+    minValue = valueFrequency[minIndex][0]
+    maxValue = valueFrequency[maxIndex][0]
     msec = int(1000 * time.time()) - msec
     outputText += "completed: {}ms\n".format(msec)
-    outputText += "unique values: " + str(uniquePixelValues) + "\n"
-    outputText += "approximate bit depth:" + str(approximateBitDepth) + "\n"
+    outputText += "pixel number: {}\n".format(pixelNumber)
+    outputText += "minValue: {}\n".format(minValue)
+    outputText += "maxValue: {}\n".format(maxValue)
+    outputText += "unique values: {}\n".format(uniquePixelValues)
+    outputText += "approximate bits/pixel: {}\n".format(approximateBitDepth)
     outputText += "\n"
 
-
-    # Look for and remove from histogram bathtub values that might
-    # indicate over-or-under-exposed pixels.
-    bathtubLimit = 0.25 / 100
+    # Now we will do some trimming
     outputText += "Searching for bathtub pixel values ... "
     msec = int(1000 * time.time())
-    currentPixelValueNumber = uniquePixelValues
+    bathtubLimit = 0.25 / 100 / 2
+    minIndex, maxIndex, currentPixelNumber, bathtubIndices, bathtubLow, bathtubHigh, bathtubFail = \
+        findBathtub(valueFrequency, pixelNumber, bathtubLimit)
     bathtubValues = SortedDict()
-    bathtubValueNumber = 0
-    bathtubPixelNumber = 0
-    bathtubFound = True
-    while bathtubFound :
-        bathtubFound = False
-        while pixelCounts.peekitem(index=0)[1] / currentPixelNumber > bathtubLimit :
-            popKey, popCount = pixelCounts.popitem(last=False)
-            bathtubValues[popKey] = popCount
-            currentPixelNumber -= popCount
-            bathtubPixelNumber += popCount
-            currentPixelValueNumber -= 1
-            bathtubValueNumber += 1
-            bathtubFound = True
-        while pixelCounts.peekitem(index=-1)[1] / currentPixelNumber > bathtubLimit :
-            popKey, popCount = pixelCounts.popitem(last=True)
-            bathtubValues[popKey] = popCount
-            currentPixelNumber -= popCount
-            bathtubPixelNumber += popCount
-            currentPixelValueNumber -= 1
-            bathtubValueNumber += 1
-            bathtubFound = True
-        if bathtubFound :
-            outputText += ". "
-
+    for index in bathtubIndices:
+        bathtubValues[pixelValues[index]] = int(pixelCounts[index])
+    bathtubValueNumber = len(bathtubIndices)
+    bathtubPixelNumber = pixelNumber - currentPixelNumber
+    currentPixelValueNumber = uniquePixelValues - bathtubValueNumber
+    if bathtubPixelNumber / currentPixelNumber > 1./3 :
+        outputText += "\nToo many suspect bathtub pixels found!\n"
+        outputText += "Recording bathtub values, but resetting min and max values.\n"
+        minIndex = 0
+        maxIndex = uniquePixelValues - 1
+        currentPixelNumber += bathtubPixelNumber
+        currentPixelValueNumber += bathtubValueNumber
+        bathtubFail = True
+    minValue = valueFrequency[minIndex][0]
+    maxValue = valueFrequency[maxIndex][0]
     msec = int(1000 * time.time()) - msec
     outputText += "completed: {}ms\n".format(msec)
-    if bathtubPixelNumber / currentPixelNumber > 1.0 / 3.0 :
-        outputText += "Too many suspect bathtub pixels found!\n"
-        outputText += "\tRestoring bathtub values to histogram ... "
-        pixelCounts.update = bathtubValues
-        currentPixelNumber += bathtubPixelNumber
-        bathtubFailure = True
-    else :
-        bathtubFailure = False
+    outputText += "bathtub limit: {}%\n".format(100*bathtubLimit)
     outputText += "total bathtub values: {}, {}%\n".format( bathtubValueNumber,
         round(100*bathtubValueNumber/(bathtubValueNumber + currentPixelValueNumber),4))
+    outputText += "total bathtub pixels: {}, {}%\n".format(bathtubPixelNumber,
+        round(100*bathtubPixelNumber/(bathtubPixelNumber + currentPixelNumber),4))
+    outputText += "bathtub (value,pixels): " + str(list(bathtubValues.items())) + "\n"
+    outputText += "highest low bathtub value: {}\n".format(bathtubLow)
+    outputText += "lowest high bathtub value: {}\n".format(bathtubHigh)
     outputText += "remaining values: {}, {}%\n".format( currentPixelValueNumber,
         round(100*currentPixelValueNumber/(bathtubValueNumber + currentPixelValueNumber),4))
-    outputText += "total bathtub pixels: {}, {}%\n".format(bathtubPixelNumber,
-        round(100*bathtubPixelNumber/(bathtubPixelNumber +
-        currentPixelNumber),4))
     outputText += "remaining pixels: {}, {}%\n".format(currentPixelNumber,
-        round(100*currentPixelNumber/(bathtubPixelNumber +
-        currentPixelNumber),4))
-    outputText += "bathtub (value,pixels): " + str(list(bathtubValues.items())) + "\n"
+        round(100*currentPixelNumber/(bathtubPixelNumber + currentPixelNumber),4))
+    outputText += "remaining min(Index, Value): ({}, {})\n".format(minIndex, minValue)
+    outputText += "remaining max(Index, Value): ({}, {})\n".format(maxIndex, maxValue)
     outputText += "\n"
 
 
     # Get pixel value bounds assuming we will ignore the values for some
     # percentage of the brightest and darkest pixels when making thumbnails.
-    # I can't believe I can't suss out the syntax for a do while loop. I
-    # guess the internet is sometimes useful ... or maybe I should have
-    # kept that little python o'rielys pocketbook.  Hmm ... books.
     outputText += "Finding dark and light points ... "
     msec = int(1000 * time.time())
-    ignoreLower = models.CosmicVariable.getVariable('histogramIgnoreLower') / 100.0
-    i = 0
-    ignoredLowerValue, ignoredLowerPixels = pixelCounts.peekitem(index=i)
-    while ignoredLowerPixels / currentPixelNumber < ignoreLower :
-        i += 1
-        peekValue, peekPixels = pixelCounts.peekitem(index=i)
-        ignoredLowerValue = peekValue
-        ignoredLowerPixels += peekPixels
-    ignoreUpper = models.CosmicVariable.getVariable('histogramIgnoreUpper') / 100.0
-    i = -1
-    ignoredUpperValue, ignoredUpperPixels = pixelCounts.peekitem(index=i)
-    while ignoredUpperPixels / currentPixelNumber < ignoreUpper :
-        i -= 1
-        peekValue, peekPixels = pixelCounts.peekitem(index=i)
-        ignoredUpperValue = peekValue
-        ignoredUpperPixels += peekPixels
+    ignoredLowerValue, minIndex, ignoredLowerPixels = findBlackPoint(valueFrequency, minIndex,
+        ignoreLower * currentPixelNumber)
+    ignoredUpperValue, maxIndex, ignoredUpperPixels = findWhitePoint(valueFrequency, maxIndex,
+        ignoreUpper * currentPixelNumber)
+    minValue = valueFrequency[minIndex][0]
+    maxValue = valueFrequency[maxIndex][0]
     msec = int(1000 * time.time()) - msec
     outputText += "completed: {}ms\n".format(msec)
     outputText += "dark point {}, contains {} pixels, {}%, {}% of originial frame\n".format(
@@ -1005,248 +742,214 @@ def depricatedHistogram(frame) :
         ignoredUpperValue, ignoredUpperPixels,
         round(100*ignoredUpperPixels / currentPixelNumber, 4),
         round(100*ignoredUpperPixels / pixelNumber, 4) )
+    outputText += "min(Index, Value): ({}, {})\n".format(minIndex, minValue)
+    outputText += "max(Index, Value): ({}, {})\n".format(maxIndex, maxValue)
     outputText += "\n"
 
-    currentPixelValueNumber = len(pixelCounts)
-    # If we have way too many values, do some rough binning.
-    uniqueValuesStart = uniqueValuesLimit * 10
-    if currentPixelValueNumber > uniqueValuesStart:
-        outputText += "Beginning rough binning ... "
-        msec = int(1000 * time.time())
-        tempPixelCounts = SortedDict()
-        roughStride = 1 + (currentPixelValueNumber // uniqueValuesStart)
-        roughBins = currentPixelValueNumber // roughStride
-        outputText += "Performing initial rough binning.  Goal values: " + str(roughBins) + "\n"
-        for i in range(roughBins):
-            roughKey = 0.0
-            roughValue = 0.0
-            for j in range(roughStride):
-                key, value = pixelCounts.popitem()
-                roughKey += key*value
-                roughValue += value
-            roughKey /= roughValue
-            tempPixelCounts[roughKey] = roughValue
-        # Check for leftovers and throw them in the last key/value
-        if len(pixelCounts) > 0:
-            roughKey = numpy.average(list(pixelCounts.iterkeys()),
-                weights = list(pixelCounts.itervalues()) )
-            roughValue = numpy.sum(list(pixelCounts.itervalues()))
-            tempPixelCounts[roughKey] = roughValue
-        pixelCounts.update(tempPixelCounts)
-        msec = int(1000 * time.time()) - msec
-        outputText += "completed: {}ms\n".format(msec)
-
 
-    outputText += "Beginning adaptive re-binning ... "
+    # Get the mean value of remaining pixels to calculate gamma correction
+    outputText += "Finding mean value of clipped pixels ... "
     msec = int(1000 * time.time())
-    # Replacement rejection exponent, lower this to accept more disruptive
-    # deletions.  This will automatically adjust if one pass is not
-    # sufficient to reduce the number of unique values.
-    rejectionExponent = models.CosmicVariable.getVariable('histogramRejectionExponent')
-
-    currentUniqueValues = len(pixelCounts)
-    while currentUniqueValues > uniqueValuesLimit:
-
-        # Initialize the list of deleted indices
-        deletedIndices = SortedList()
-
-        # Select in random order (almost) all unique pixel values to test
-        # for trial deletion.
-        for rawIndex in random.sample(range(2, currentUniqueValues - 2), currentUniqueValues - 4):
-            # Adjust index to account for any deleted indices
-            index = rawIndex - deletedIndices.bisect_left(rawIndex)
-
-            indexStart = index - 2
-            indexEnd = index + 3
-
-            a = SortedDict(itertools.islice(pixelCounts.items(), indexStart, indexEnd))
-            removedKey = a.peekitem(2)[0]
-            removedCount = a.peekitem(2)[1]
-            newCount1 = a.peekitem(1)[1] + removedCount/2.0
-            newCount2 = a.peekitem(3)[1] + removedCount/2.0
-            conservedCount = newCount1 + newCount2
-
-            x0 = [
-                a.peekitem(1)[0],
-                newCount1,
-                a.peekitem(3)[0],
-                newCount2
-                ]
-
-            bounds = [
-                (0.99*a.peekitem(0)[0] + 0.01*a.peekitem(1)[0],
-                0.01*a.peekitem(1)[0] + 0.99*a.peekitem(2)[0] ),
-                (a.peekitem(1)[1], None),
-                (0.99*a.peekitem(2)[0] + 0.01*a.peekitem(3)[0],
-                0.01*a.peekitem(3)[0] + 0.99*a.peekitem(4)[0]),
-                (a.peekitem(3)[1], None)
-                ]
-
-            constraints = ({
-                'type': 'eq',
-                'fun' : conserveTotalPixelCountConstraint,
-                'args': [conservedCount]
-                })
-
-            # TODO: Jacobian
-            jacobian = False
-
-            result = scipy.optimize.minimize(overlapError, x0, args=(a),
-            bounds=bounds, constraints=constraints, method='SLSQP')
-            if result.success:
-                if result.fun < math.pow(random.uniform(0, 1), rejectionExponent):
-                    deletedIndices.add(rawIndex)
-                    pixelCounts.pop(removedKey)
-                    pixelCounts.pop(x0[0])
-                    pixelCounts.pop(x0[2])
-                    pixelCounts[result.x[0]] = result.x[1]
-                    pixelCounts[result.x[2]] = result.x[3]
-                    if len(pixelCounts) == uniqueValuesLimit:
-                        break
-            else:
-                errorText += 'Minimization failed:\n\n' + str(result) + '\n'
+    unclippedPixelNumber = currentPixelNumber - ignoredLowerPixels - ignoredUpperPixels
+    meanUnclippedPixels = numpy.dot(pixelValues[minIndex:maxIndex], pixelCounts[minIndex:maxIndex]) / unclippedPixelNumber
+    meanFrac = (meanUnclippedPixels - minValue)/(maxValue - minValue)
+    targetMean = 0.8 * minValue + 0.2 * maxValue
+    targetMeanFrac = (targetMean - minValue)/(maxValue - minValue)
+    gammaCorrection = math.log(meanFrac)/math.log(targetMeanFrac)
+    msec = int(1000 * time.time()) - msec
+    outputText += "completed: {}ms\n".format(msec)
+    outputText += "mean: {}, {}%\n".format(meanUnclippedPixels,meanFrac)
+    outputText += "targetmean: {}, {}%\n".format(targetMean,targetMeanFrac)
+    outputText += "gamma: {}\n".format(gammaCorrection)
+    outputText += "\n"
 
-        deletionsThisCycle = currentUniqueValues - len(pixelCounts)
-        deletionsNeeded = len(pixelCounts) - uniqueValuesLimit
 
-        outputText += "Reduction step complete." +\
-            " deletions: " + str(deletionsThisCycle) +\
-            " , values: " + str(len(pixelCounts)) +\
-            " , bits: " + str(round(math.log(len(pixelCounts),2),2)) +\
-            " , rejection exponent: " + str(round(rejectionExponent,2)) +\
-            " , deletions needed: " + str(deletionsNeeded) + "\n"
+    # Digitize and rebin the the value counts to a histogram
+    outputText += "Generating histograms from value counts ... "
+    msec = int(1000 * time.time())
+    thumbnailBitDepth = 8
+    binNumber = pow(2, thumbnailBitDepth)
+    binsLinear = minValue + (maxValue - minValue) * numpy.linspace(0, 1, binNumber)
+    binsGamma = minValue + (maxValue - minValue) * pow(numpy.linspace(0, 1, binNumber), gammaCorrection)
+    binAssignLinear = numpy.digitize(pixelValues.clip(minValue, maxValue), binsLinear)
+    binAssignGamma = numpy.digitize(pixelValues.clip(minValue, maxValue), binsGamma)
+    histCountLinear = numpy.bincount(binAssignLinear, pixelCounts, binNumber)
+    histCountGamma = numpy.bincount(binAssignGamma, pixelCounts, binNumber)
+    histContribLinear = pixelCounts / histCountLinear[binAssignLinear]
+    histContribGamma = pixelCounts / histCountGamma[binAssignGamma]
+    histCenterLinear = numpy.bincount(binAssignLinear, pixelValues * histContribLinear, binNumber)
+    histCenterGamma = numpy.bincount(binAssignGamma, pixelValues * histContribGamma, binNumber)
+    msec = int(1000 * time.time()) - msec
+    outputText += "completed: {}ms\n".format(msec)
+    outputText += "digitized bits/pixel: {}\n".format(thumbnailBitDepth)
+    outputText += "digitized shades: {}\n".format(binNumber)
+    outputText += "\n"
 
-        # Adjust rejection exponent based on results
-        if deletionsNeeded > 0:
-            if deletionsThisCycle > 0:
-                try:
-                    rejectionExponent *= 0.5 + 1.5*math.exp( -1.0*deletionsNeeded/deletionsThisCycle )
-                except ValueError:
-                    outputText += '\nValueError exception in math.log(deletionsNeeded / deletionsThisCycle, rejectionExponent):\n' +\
-                        'deletionsNeeded = ' + str(deletionsNeeded) +\
-                        ', deletionsThisCycle = ' + str(deletionsThisCycle) +\
-                        ', rejectionExponent = ' + str(rejectionExponent) + '\n'
-            else:
-                rejectionExponent /= 2.0
 
-        currentUniqueValues = len(pixelCounts)
-    # end of while
+    # Generate fast histogram for image info page
+    outputText += "Generating histogram image ... "
+    msec = int(1000 * time.time())
+    histImageFilename = "histogramData_{}_{}.gnuplot.svg".format(imageId, channelIndex)
+    writeLinePlot(settings.COSMIC_STATIC + "images/" + histImageFilename, [
+            (histCenterLinear, histCountLinear, 'blue', 3),
+            (histCenterGamma, histCountGamma, 'red', 2)
+            ], 400, 300, xRange=(minValue, maxValue), logY=True)
     msec = int(1000 * time.time()) - msec
     outputText += "completed: {}ms\n".format(msec)
+    outputText += "histogram image file: {}\n".format(histImageFilename)
+    outputText += "\n"
 
+    # Digitize the raw value counts into an image
+    outputText += "Digitizing the frame to a full size image ... "
+    msec = int(1000 * time.time())
+    binNumber = pow(2, thumbnailBitDepth)
+    binsGamma = minValue + (maxValue - minValue) * pow(numpy.linspace(0, 1, binNumber), gammaCorrection)
+    binAssignment = digitizeFrame(frame, binsGamma, maxTileBytes, bscale, bzero)
+    msec = int(1000 * time.time()) - msec
+    outputText += "completed: {}ms\n".format(msec)
+    outputText += "\n"
 
-    # This will injest the pixel count and histogram dicts into some numpy arrays
-    histogramLength = len(pixelCounts)
-    binCenters = numpy.empty([histogramLength])
-    histPixels = numpy.empty([histogramLength])
-    cumulativePixels = numpy.empty([histogramLength])
-    totalCount = 0
-    for i in range(histogramLength):
-        (binCenters[i], histPixels[i]) = pixelCounts.popitem(last=False)
-        totalCount += histPixels[i]
-        cumulativePixels[i] = totalCount
-
-    assert(totalCount == sum(histPixels))
-
-    binLefts = numpy.empty([histogramLength])
-    binRights = numpy.empty([histogramLength])
-    binLefts[0] = 1.5 * binCenters[0] - 0.5 * binCenters[1]
-    for i in range(1,histogramLength):
-        binLefts[i] = 0.5 * (binCenters[i-1] + binCenters[i])
-        binRights[i-1] = binLefts[i]
-    binRights[histogramLength-1] = 1.5 * binCenters[histogramLength-1] - 0.5 * binCenters[histogramLength-2]
-
-    histCounts = numpy.empty([histogramLength])
-    for i in range(histogramLength):
-        histCounts[i] = histPixels[i] / (1.0*binRights[i] - 1.0*binLefts[i])
-
-    histogramBins = []
-    errorText += 'histogram length is: ' + str(histogramLength)
-    for i in range(histogramLength):
-        histogramBin = models.ImageHistogramBin(
-            image = image,
-            binCenter = binCenters[i],
-            binCount = histCounts[i]
-            )
 
-        histogramBins.append(histogramBin)
+    # Write the gamma corrected png full size thumbnail.  The first channel keeps the plain name generateThumbnails
+    # makes the smaller thumbnails from.
+    outputText += "Writing full size png thumbnail ... "
+    if channelIndex == 0:
+        pngImageFilename = os.path.splitext(filename)[0] + "_thumb_full.png"
+    else:
+        pngImageFilename = os.path.splitext(filename)[0] + "_thumb_full_{}.png".format(channelIndex)
+    ydim, xdim = binAssignment.shape
+    msec = int(1000 * time.time())
+    imageio.imwrite(settings.COSMIC_STATIC + "images/" + pngImageFilename, binAssignment, optimize=True, bits=8)
+    msec = int(1000 * time.time()) - msec
+    outputText += "completed: {}ms\n\n".format(msec)
 
-    models.ImageHistogramBin.objects.bulk_create(histogramBins)
+    #TODO: Look into this masking and potentially record the masked pixel
+    # data as a stored thing which can be accessed later on.
+    # Create frame mask
+    outputText += "Generating frame mask ... "
+    msec = int(1000 * time.time())
+    # mask = make_source_mask(frame, snr=10, npixels=5, dilate_size=11)
+    rejectValues = numpy.array([])
+    rejectPixelNumber = 0
+    bathtubRejects = numpy.array(bathtubValues.keys())
+    bathtubPixelCounts = numpy.array(bathtubValues.values())
+    if not bathtubFail and bathtubRejects.shape[0] > 0 :
+        rejectValues = numpy.union1d(rejectValues, bathtubRejects)
+        rejectPixelNumber += sum(bathtubPixelCounts)
+    otherRejects = numpy.array([])
+    if otherRejects.shape[0] > 0 :
+        rejectValues = numpy.union1d(rejectValues, otherRejects)
+    moreRejects = numpy.array([])
+    if moreRejects.shape[0] > 0 :
+        rejectValues = numpy.union1d(rejectValues, moreRejects)
+    rejectValueNumber = rejectValues.shape[0]
+    # The mask is applied to the table of pixel values rather than the frame itself, since the values
+    # are all the statistics below need.
+    unmaskedValues = ~numpy.isin(pixelValues, rejectValues)
+    msec = int(1000 * time.time()) - msec
+    outputText += "completed: {}ms\n".format(msec)
+    outputText += "masked values: {}\n".format(rejectValueNumber)
+    outputText += "masked pixels: {}\n".format(rejectPixelNumber)
+    outputText += "\n"
 
-    plotFilename = "histogramData_{}_{}.gnuplot".format(image.pk, channelIndex)
-    binFilename = "histogramData_{}_{}.txt".format(image.pk, channelIndex)
 
-    # Write the column data to be read in by gnuplot.
-    lowerBound = binLefts[0]
-    upperBound = binRights[histogramLength-1]
-    cumulativeCount = 0.0
-    cumulativeFraction = cumulativeCount / totalCount
-    with open("/cosmicmedia/" + binFilename, "w") as outputFile:
-        ignoreLower = models.CosmicVariable.getVariable('histogramIgnoreLower') / 100.0
-        ignoreUpper = models.CosmicVariable.getVariable('histogramIgnoreUpper') / 100.0
-        for i in range(histogramLength):
-            binCount = histCounts[i]
-            binCenter = binCenters[i]
-            # Skip writing values for up 0.25% of the darkest and
-            # brightest pixels. This is to match the parameters used in
-            # generating thumnails.
-            pixelCount = histPixels[i]
-            pixelCountFraction = histPixels[i] / totalCount
-            if cumulativeFraction < ignoreLower:
-                if cumulativeFraction + pixelCountFraction >= ignoreLower:
-                    overageFraction = cumulativeFraction + pixelCountFraction - ignoreLower
-                    includeFraction = overageFraction / pixelCountFraction
-                    lowerBound = includeFraction*binLefts[i]  + (1.0 - includeFraction)*binRights[i]
-            cumulativeCount += histPixels[i]
-            cumulativeFraction = cumulativeCount / totalCount
-            if cumulativeFraction > 1.0 - ignoreUpper:
-                if binCenter < upperBound:
-                    overageFraction = cumulativeFraction - 1.0 + ignoreUpper
-                    countFraction = histPixels[i] / totalCount
-                    includeFraction = 1.0 - overageFraction / countFraction
-                    upperBound = (1.0 - includeFraction)*binLefts[i] + includeFraction*binRights[i]
-
-            outputFile.write("{} {} {}\n".format(binLefts[i], histCounts[i], (cumulativePixels[i]/totalCount) ) )
-            outputFile.write("{} {} {}\n".format(binRights[i], histCounts[i], (cumulativePixels[i]/totalCount) ) )
-
-    targetMean = 0.8*lowerBound + 0.2*upperBound
-    meanFrac = (mean - lowerBound)/(upperBound - lowerBound)
-    targetMeanFrac = (targetMean - lowerBound)/(upperBound - lowerBound)
-    gammaCorrection = math.log(meanFrac, 10)/math.log(targetMeanFrac, 10)
-
-    # Write the gnuplot script file.
-    with open("/cosmicmedia/" + plotFilename, "w") as outputFile:
-        outputFile.write("set terminal svg size 400,300 dynamic mouse standalone\n" +
-                         "set output '{}/{}.svg'\n".format(settings.COSMIC_STATIC + "images", plotFilename) +
-                         "set key off\n" +
-                         "set logscale y\n" +
-                         "set xrange ["+str(lowerBound)+":"+str(upperBound)+"]\n" +
-                         "set style line 1 linewidth 3 linecolor 'blue'\n" +
-                         "set style line 2 linewidth 2 linecolor 'red'\n" +
-                         "plot '/cosmicmedia/{0}' using 1:2 with lines linestyle 1, ".format(binFilename) +
-                         "'/cosmicmedia/{0}' using ( $1 * {3}**(($1-{1})/({2}-{1})) ):2 with lines linestyle 2\n".format(
-                            binFilename, lowerBound, upperBound, gammaCorrection))
-
-    outputText += "Running gnuplot:\n\n"
-    proc = subprocess.Popen(['gnuplot', "/cosmicmedia/" + plotFilename],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE
-            )
+    # Get statistics on unmasked frame
+    outputText += "Non-masked frame statistics ... "
+    msec = int(1000 * time.time())
+    ( nonmaskedNumber, (nonmaskedMin, nonmaskedMax),
+      nonmaskedMean, nonmaskedVariance,
+      nonmaskedSkewness, nonmaskedKurtosis ) = histogramDescribe(pixelValues, pixelCounts)
+    msec = int(1000 * time.time()) - msec
+    outputText += "completed: {}ms\n".format(msec)
+    outputText += "pixels: {}\n".format(nonmaskedNumber)
+    outputText += "min: {}\n".format(nonmaskedMin)
+    outputText += "max: {}\n".format(nonmaskedMax)
+    outputText += "mean: {}\n".format(nonmaskedMean)
+    outputText += "variance: {}\n".format(nonmaskedVariance)
+    outputText += "skewness: {}\n".format(nonmaskedSkewness)
+    outputText += "kurtosis: {}\n".format(nonmaskedKurtosis)
+    outputText += "\n"
 
-    output, error = proc.communicate()
-    output = output.decode('utf-8')
-    error = error.decode('utf-8')
 
-    proc.wait()
+    # Get statistics on masked frame
+    outputText += "Getting statistics on masked frame ... "
+    msec = int(1000 * time.time())
+    maskedMean, maskedMedian, maskedStdDev = histogramStats(pixelValues[unmaskedValues], pixelCounts[unmaskedValues])
+    # Converges well with 3 iterations.  Half as much time as maxiters=None
+    bgMean, bgMedian, bgStdDev = histogramSigmaClippedStats(pixelValues[unmaskedValues],
+        pixelCounts[unmaskedValues], sigma=3, maxiters=3)
+    msec = int(1000 * time.time()) - msec
+    outputText += "completed: {}ms\n".format(msec)
+    outputText += "mean: {}\n".format(maskedMean)
+    outputText += "median: {}\n".format(maskedMedian)
+    outputText += "stdDev: {}\n".format(maskedStdDev)
+    outputText += "background mean: {}\n".format(bgMean)
+    outputText += "background median: {}\n".format(bgMedian)
+    outputText += "background stdDev: {}\n".format(bgStdDev)
+    outputText += "\n"
 
-    outputText += output
-    errorText += error
+    hdulist.close()
 
-    outputText += '\n ==================== End of process output ====================\n\n'
-    errorText += '\n ==================== End of process error =====================\n\n'
+    # Everything to be stored in the database for this channel, the ImageChannelInfo fields are in 'stats'.
+    return {
+        'outputText': outputText,
+        'sliceMeans': sliceMeans,
+        # The linear histogram is stored so it can be read back without the image file.
+        'histogramCenters': [float(center) for center in numpy.nan_to_num(histCenterLinear)],
+        'histogramCounts': [float(count) for count in histCountLinear],
+        'thumbnail': (pngImageFilename, xdim, ydim),
+        'stats': {
+            'mean': maskedMean,
+            'median': maskedMedian,
+            'stdDev': maskedStdDev,
+            'bgMean': bgMean,
+            'bgMedian': bgMedian,
+            'bgStdDev': bgStdDev,
+            'pixelNumber': pixelNumber,
+            'minValue': nonmaskedMin,
+            'maxValue': nonmaskedMax,
+            'uniqueValues': uniquePixelValues,
+            'approximateBits': approximateBitDepth,
+            'bathtubLimit': bathtubLimit,
+            'bathtubValueNumber': bathtubValueNumber,
+            'bathtubPixelNumber': bathtubPixelNumber,
+            'bathtubLow': bathtubLow,
+            'bathtubHigh': bathtubHigh,
+            'thumbnailBlackPoint': ignoredLowerValue,
+            'thumbnailWhitePoint': ignoredUpperValue,
+            'thumbnailGamma': gammaCorrection,
+            'maskedValues': rejectValueNumber,
+            'maskedPixels': rejectPixelNumber,
+            }
+        }
+
+# TODO: Histogram of FITS data (count vs adu) in linear and logarithmic (if possible?).
+# Needs to be high resolution, but deal efficiently with large swaths of 0-count.  Must
+# ignore non-data pixels properly. Design as per discussion.
 
+# TODO: Fit a gaussian curve to the dark pixels in the histogram.
+#   Histogram area used for fitting should start at the darkest populated pixel and extend
+#   to include at least * 10% of the total data pixels and as many further bins as
+#   improves + fitting metric.
+# NOTE: Extending past the * 10% may be tricky.  Though we are assumed to be in a dense
+# region there may be empty bins or features that result in the addition of * one bin to be
+# detrimental to the fitting metric, but adding * two bins improves the fit.
+#   Step by a minimum number of pixels rather than by number of bins.  Set number of pixels
+#   as some percentage of the total pixels * 1%, or as a percentage of the pixels used in the
+#   fitting so far * 10%.
+# * Arbitrary value
+# + Mimize sum of square of difference, or something more clever.
+#   Maybe too clever: minimize \sum_{i=0}^{b(n)} \frac{w_i^2 (f_i - c_i)^2}{n^a}, where
+#       n = number of pixels used to fit
+#       b(n) = minimum bin number with n cumulative pixels
+#       w_i = width of bin i
+#       f_i = value of functional fit at bin i
+#       c_i = count at bin i
+#       a = coeffecient ... suspect = 1
+#   Now, vary n along with coeffecients of f
 
-@shared_task
+
+@shared_task(base=LeasedTask)
 def generateThumbnails(filename, processInputId):
     """
     A celery task to produce thumbnails of several standard sizes starting from the
@@ -1257,9 +960,6 @@ def generateThumbnails(filename, processInputId):
     taskStartTime = time.time()
 
     filenameFull = os.path.splitext(filename)[0] + "_thumb_full.png"
-    filenameSmall = os.path.splitext(filename)[0] + "_thumb_small.png"
-    filenameMedium = os.path.splitext(filename)[0] + "_thumb_medium.png"
-    filenameLarge = os.path.splitext(filename)[0] + "_thumb_large.png"
 
     image = models.Image.objects.get(fileRecord__onDiskFileName=filename)
 
@@ -1318,68 +1018,133 @@ def generateThumbnails(filename, processInputId):
     
     #TODO: Add some python logic to decide the exact dimensions we want the thumbnails to
     # be to preserve aspect ratio but still respect screen space requirements.
-    for tempFilename, sizeArg, sizeString in [
-        (filenameSmall, "100x100", "small"),
-        (filenameMedium, "300x300", "medium"),
-        (filenameLarge, "900x900", "large") ] :
-
-        #TODO: Small images will actually get thumbnails made which are bigger than the original, should implement
-        # protection against this - will need to test all callers to make sure that is safe.
-        # Consider bad horiz/vert lines, also bad pixels, and finally noise.
-        # For bad lines use low/negative values along the middle row/col in the kernel.
-        proc = subprocess.Popen(['convert', '-verbose', '-strip', '-filter', 'Box', '-resize', sizeArg,
-            settings.COSMIC_STATIC + "images/"+ filenameFull, '-depth', '8', settings.COSMIC_STATIC + "images/" + tempFilename],
-            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        #TODO: Only looking at the first channel here, need to loop and add all channels if it is an RGB image, etc.
 
-        output, error = proc.communicate()
-        output = output.decode('utf-8')
-        error = error.decode('utf-8')
+    #TODO: Small images will actually get thumbnails made which are bigger than the original, should implement
+    # protection against this - will need to test all callers to make sure that is safe.
+    # Consider bad horiz/vert lines, also bad pixels, and finally noise.
+    # For bad lines use low/negative values along the middle row/col in the kernel.
+    #TODO: Only looking at the first channel here, need to loop and add all channels if it is an RGB image, etc.
 
-        proc.wait()
+    # The full size image is read once and each smaller size is made by area averaging the one before it.
+    msec = int(1000 * time.time())
+    fullImage = imageio.imread(settings.COSMIC_STATIC + "images/" + filenameFull)
+    thumbnails = makeThumbnailPyramid(fullImage)
+    msec = int(1000 * time.time()) - msec
+    outputText += "Made {} thumbnails from {}x{} full size image: {}ms\n".format(len(thumbnails), fullImage.shape[1],
+        fullImage.shape[0], msec)
 
-        outputText += output
-        errorText += error
-        outputText += '\n ==================== End of process output ====================\n\n'
-        errorText += '\n ==================== End of process error =====================\n\n'
+    with transaction.atomic():
+        records = []
+        for sizeString, thumbnail in thumbnails:
+            tempFilename = os.path.splitext(filename)[0] + "_thumb_{}.{}".format(sizeString, settings.THUMBNAIL_FORMAT)
+            imageio.imwrite(settings.COSMIC_STATIC + "images/" + tempFilename, thumbnail)
 
-        outputText += "generateThumbnails: " + tempFilename + "\n"
+            h, w = thumbnail.shape[:2]
+            outputText += "generateThumbnails: " + tempFilename + "\n"
+            outputText += 'Thumbnail width: {}      height: {}'.format(w, h) + "\n"
 
-        # Read through the standard error output from image magick and parse the output to
-        # grab the exact sizes and number of thumbnails that were created.  The output
-        # sizes of the thumbnails will not exactly match the requested sizes since in general,
-        # the aspect ratios will be different.  For images with more than one channel
-        # image magick will also sometimes create extra thumbnails for each channel in the input image.
-        with transaction.atomic():
-            for line in error.splitlines():
-                if '=>' in line:
-                    fields = line.split()
-                    outputFilename = fields[0].split('=>')[1]
-                    channelIndicator = re.findall(r'\[\d+\]$', outputFilename)
-
-                    if len(channelIndicator) == 0:
-                        channel = 0
-                    else:
-                        channel = int(channelIndicator[0].strip('[]'))
-                        outputFilename = outputFilename.split('[')[0]
+            records.append(models.ImageThumbnail(
+                image = image,
+                width = w,
+                height = h,
+                size = sizeString,
+                channel = 0,
+                filename = tempFilename
+                ))
+
+        models.ImageThumbnail.objects.bulk_create(records)
+
+    return constructProcessOutput(outputText, errorText, time.time() - taskStartTime)
+
+@shared_task(base=LeasedTask)
+def generateTiles(filename, processInputId):
+    """
+    A celery task to cut the full size png thumbnail into the tile pyramid used by the zoomable image viewer.  Only the
+    zoom levels are written here, each individual tile is cut out and cached the first time it is requested (see
+    views.imageTile), so tiles nobody ever looks at are never made.
+    """
+    outputText = ""
+    errorText = ""
+    taskStartTime = time.time()
+
+    filenameFull = os.path.splitext(filename)[0] + "_thumb_full.png"
+
+    image = models.Image.objects.get(fileRecord__onDiskFileName=filename)
+
+    fullImage = imageio.imread(settings.COSMIC_STATIC + "images/" + filenameFull)
+
+    # Throw away the levels and any cached tiles from a previous run.
+    folder = getTileFolder(image.pk)
+    shutil.rmtree(folder, ignore_errors=True)
+    os.makedirs(folder)
+
+    maxZoom = None
+    for zoom, level in makeTileLevels(fullImage):
+        msec = int(1000 * time.time())
+        numpy.save(getTileLevelFilename(image.pk, zoom), level)
+        msec = int(1000 * time.time()) - msec
+        outputText += "Zoom level {}: {}x{} pixels, {}ms\n".format(zoom, level.shape[1], level.shape[0], msec)
+
+        if maxZoom is None:
+            maxZoom = zoom
+
+    image.addImageProperty('tileMaxZoom', maxZoom)
+
+    return constructProcessOutput(outputText, errorText, time.time() - taskStartTime)
+
+def measureChannelBackground(fileRecord, hduIndex, frameIndex, boxSize):
+    """
+    Return the (background, rms) grids of a single channel of an image as nested lists, for the backgroundMap task.
+    """
+    background, rms = measureBackgroundGrid(loadFrame(fileRecord, hduIndex, frameIndex), boxSize)
+    return background.tolist(), rms.tolist()
+
+@shared_task(base=LeasedTask)
+def backgroundMap(filename, processInputId):
+    """
+    A celery task to measure the sky background level and noise of each channel of an image on a coarse grid (see
+    cosmicapp.background).  The source finders use these maps rather than a single background value for the whole
+    frame, so their detection thresholds follow gradients, vignetting, moonlight, etc, across the image.
+    """
+    outputText = ""
+    errorText = ""
+    taskStartTime = time.time()
 
-                    outputFilename = os.path.basename(outputFilename)
+    image = models.Image.objects.get(fileRecord__onDiskFileName=filename)
+
+    boxSize = models.CosmicVariable.getVariable('backgroundMapBoxSize')
+    if boxSize is None:
+        boxSize = defaultBoxSize
+
+    outputText += "Measuring background in {}x{} pixel boxes.\n".format(boxSize, boxSize)
 
-                    dimensions = fields[3].split('+')[0].split('x')
-                    w = int(dimensions[0])
-                    h = int(dimensions[1])
-                    outputText += 'Thumbnail width: {}      height: {}'.format(w, h) + "\n"
+    channelInfos = list(models.ImageChannelInfo.objects.filter(image=image, hduIndex__isnull=False).order_by('index'))
 
-                    record = models.ImageThumbnail(
-                        image = image,
-                        width = w,
-                        height = h,
-                        size = sizeString,
-                        channel = channel,
-                        filename = outputFilename
-                        )
+    argumentLists = []
+    for channelInfo in channelInfos:
+        argumentLists.append((image.fileRecord, channelInfo.hduIndex, channelInfo.frameIndex, boxSize))
+
+    msec = int(1000 * time.time())
+    grids = mapChannels(measureChannelBackground, argumentLists)
+    msec = int(1000 * time.time()) - msec
+    outputText += "Measured {} channels: {}ms\n".format(len(grids), msec)
 
-                    record.save()
+    with transaction.atomic():
+        models.ImageBackgroundMap.objects.filter(channelInfo__image=image).delete()
+        backgroundMaps = []
+        for channelInfo, (background, rms) in zip(channelInfos, grids):
+            outputText += "Channel {}: {}x{} boxes, background {} to {}, rms {} to {}\n".format(channelInfo.index,
+                len(background[0]), len(background), numpy.min(background), numpy.max(background), numpy.min(rms),
+                numpy.max(rms))
+
+            backgroundMaps.append(models.ImageBackgroundMap(
+                channelInfo = channelInfo,
+                boxSize = boxSize,
+                background = background,
+                rms = rms
+                ))
+
+        models.ImageBackgroundMap.objects.bulk_create(backgroundMaps)
 
     return constructProcessOutput(outputText, errorText, time.time() - taskStartTime)
 
@@ -1430,7 +1195,8 @@ def initSourcefind(method, image):
         outputText += "Last detect threshold was {}.\n".format(detectThresholdMultiplier)
 
         # Check to see if there is a recommendation from a method that got the sourcefind "about right".
-        previousRunNumFound = methodDict[method].objects.filter(image=image).count()
+        # The user feedback is about the number of sources in the image, so only the first channel is counted.
+        previousRunNumFound = methodDict[method].objects.filter(image=image).exclude(pixelZ__gt=0).count()
         outputText += 'Previous run of this method found {} results.\n'.format(previousRunNumFound)
         numExpectedFeedback = image.getImageProperty('userNumExpectedResults', asList=True)
         minValid = 0
@@ -1451,10 +1217,33 @@ def initSourcefind(method, image):
             elif rangeString in ['tooFew', 'wayTooFew']:
                 minValid = max(minValid, numExpected*(1+aboutRightRange))
 
+        # The number of peaks found at a ladder of thresholds on the last run, if this method records one, lets the
+        # threshold be set straight to the one expected to give the right number of results.
+        thresholdCurve = image.getImageProperty(method + 'ThresholdCurve')
+        if thresholdCurve is not None:
+            thresholdCurve = json.loads(thresholdCurve)
+
         #TODO: We should subtract the number of sources found by the previous run which are flagged as hot pixels, etc, before doing this comparison.
         if feedbackFound:
             outputText += "Valid range of results is between {} and {}.\n".format(minValid, maxValid)
-            if previousRunNumFound <= 0.1*minValid:
+
+            if minValid > 0 and maxValid < 1e9:
+                targetNumFound = (minValid + maxValid) / 2
+            elif maxValid < 1e9:
+                targetNumFound = maxValid*(1-aboutRightRange)
+            else:
+                targetNumFound = minValid*(1+aboutRightRange)
+
+            curveMultiplier = None
+            if thresholdCurve is not None and not minValid < previousRunNumFound <= maxValid:
+                curveMultiplier = getMultiplierFromThresholdCurve(thresholdCurve, detectThresholdMultiplier,
+                    previousRunNumFound, targetNumFound)
+
+            if curveMultiplier is not None:
+                detectThresholdMultiplier = curveMultiplier
+                outputText += "Threshold curve of the last run predicts {} results at a multiplier of {}.\n"\
+                    .format(targetNumFound, detectThresholdMultiplier)
+            elif previousRunNumFound <= 0.1*minValid:
                 detectThresholdMultiplier -= 0.7 + 0.3*(.1*minValid)/previousRunNumFound
                 outputText += "Last run was less than 10% of the user submitted range, reducing detection threshold a lot.\n"
             elif previousRunNumFound <= minValid:
@@ -1479,6 +1268,89 @@ def initSourcefind(method, image):
 
     return (detectThresholdMultiplier, shouldReturn, outputText, errorText)
 
+def findSourcesInChannels(finderClass, image, detectThresholdMultiplier):
+    """
+    Run the given photutils star finder class on every channel of the image, each one with a detection threshold based
+    on its own background noise (following the background map from the backgroundMap task if there is one).  Frames
+    larger than the 'sourcefindTileSize' CosmicVariable are split into tiles, and all the tiles of all the channels are
+    run in parallel.  Returns a tuple of the list of (channelInfo, sources) pairs, the threshold curve of the first
+    channel (a list of [multiplier, number of peaks] for each multiplier in thresholdLadder, see initSourcefind), and
+    the output text to append to the output stream of the task.
+    """
+    outputText = ""
+
+    fwhm = parseFloat(image.getImageProperty('fwhmMedian', 2.5))
+    outputText += 'Final multiplier of {} standard deviations.\n'.format(detectThresholdMultiplier)
+    outputText += "Using FWHM of {}\n".format(fwhm)
+
+    tileSize = models.CosmicVariable.getVariable('sourcefindTileSize')
+    if tileSize is None:
+        tileSize = defaultSourcefindTileSize
+
+    tiles = getSourcefindTiles(image.dimX, image.dimY, tileSize)
+    outputText += "Splitting each channel into {} tiles of up to {}x{} pixels.\n".format(len(tiles), tileSize, tileSize)
+
+    # Channels imagestats could not analyze have no background statistics to set a threshold from.
+    channelInfos = models.ImageChannelInfo.objects.filter(image=image, hduIndex__isnull=False).order_by('index')
+
+    backgroundMaps = {}
+    for backgroundMap in models.ImageBackgroundMap.objects.filter(channelInfo__image=image):
+        backgroundMaps[backgroundMap.channelInfo_id] = backgroundMap
+
+    # Each frame and its background maps are loaded once here, rather than by every tile at the same time on a cold
+    # cache, and the tiles are handed slices of them.  The cached arrays are memory mapped, so only the part of the frame
+    # under each tile (plus its margin) is read and sent to the process searching it.
+    margin = getSourcefindTileMargin(fwhm)
+    argumentLists = []
+    for channelNumber, channelInfo in enumerate(channelInfos):
+        frame = loadFrame(image.fileRecord, channelInfo.hduIndex, channelInfo.frameIndex)
+
+        backgroundMap = backgroundMaps.get(channelInfo.pk)
+        if backgroundMap is None:
+            background, rms = None, None
+            noise = channelInfo.bgStdDev
+            typicalRms = None
+            outputText += 'Channel {}: final detect threshold of {} above background.\n'\
+                .format(channelInfo.index, detectThresholdMultiplier*noise)
+        else:
+            background, rms = loadBackgroundMaps(image.fileRecord, channelInfo.hduIndex, channelInfo.frameIndex,
+                backgroundMap)
+            noise = numpy.median(backgroundMap.rms)
+            typicalRms = noise
+            outputText += 'Channel {}: final detect threshold of {} above the background map (at the median rms).\n'\
+                .format(channelInfo.index, detectThresholdMultiplier*noise)
+
+        for top, bottom, left, right in tiles:
+            bottom = frame.shape[0] if bottom is None else bottom
+            right = frame.shape[1] if right is None else right
+            rows = slice(max(0, top - margin), min(frame.shape[0], bottom + margin))
+            cols = slice(max(0, left - margin), min(frame.shape[1], right + margin))
+
+            # The user feedback on the number of sources found is only compared against the first channel.
+            argumentLists.append((finderClass, frame[rows, cols],
+                None if background is None else background[rows, cols], None if rms is None else rms[rows, cols],
+                (rows.start, cols.start), (top, bottom, left, right), fwhm, detectThresholdMultiplier, noise,
+                channelInfo.bgMedian, typicalRms, channelNumber == 0))
+
+    msec = int(1000 * time.time())
+    results = mapChannels(findSourcesInTile, argumentLists)
+    msec = int(1000 * time.time()) - msec
+    outputText += "Searched {} tiles: {}ms\n".format(len(results), msec)
+
+    # Join the tables from the tiles of each channel back together, in the same order the tiles were queued.
+    channelSources = []
+    for channelNumber in range(len(channelInfos)):
+        channelResults = results[channelNumber*len(tiles):(channelNumber + 1)*len(tiles)]
+        tileSources = [sources for sources, peakCounts in channelResults if sources is not None and len(sources) > 0]
+        channelSources.append(vstack(tileSources) if len(tileSources) > 0 else None)
+
+    thresholdCurve = None
+    if len(results) > 0:
+        peakCounts = numpy.sum([peakCounts for sources, peakCounts in results[:len(tiles)]], axis=0)
+        thresholdCurve = [[float(multiplier), int(count)] for multiplier, count in zip(thresholdLadder, peakCounts)]
+
+    return (list(zip(channelInfos, channelSources)), thresholdCurve, outputText)
+
 def checkIfCalibrationImage(image, propertyKeyToSet, propertyValueToSet):
     """
     A simple helper function which returns a tuple whose first entry is True if the image
@@ -1506,7 +1378,37 @@ def checkIfCalibrationImage(image, propertyKeyToSet, propertyValueToSet):
         outputText += "\n\n\nNot returning, image is not known to be a calibration image (bias, dark, flat, etc)\n"
         return (False, outputText)
 
-@shared_task
+# The parameter file passed to source-extractor, which lists the columns it writes to its catalog.
+sextractorParamFilename = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sextractor.param')
+
+# The SextractorResult field each catalog column is stored in, as (field name, column name).
+sextractorColumns = [
+    ('pixelX', 'X_IMAGE_DBL'),
+    ('pixelY', 'Y_IMAGE_DBL'),
+    ('xPeak', 'XPEAK_IMAGE'),
+    ('yPeak', 'YPEAK_IMAGE'),
+    ('boxXMin', 'XMIN_IMAGE'),
+    ('boxYMin', 'YMIN_IMAGE'),
+    ('boxXMax', 'XMAX_IMAGE'),
+    ('boxYMax', 'YMAX_IMAGE'),
+    ('fluxIso', 'FLUX_ISO'),
+    ('fluxIsoErr', 'FLUXERR_ISO'),
+    ('magIso', 'MAG_ISO'),
+    ('magIsoErr', 'MAGERR_ISO'),
+    ('fluxAuto', 'FLUX_AUTO'),
+    ('fluxAutoErr', 'FLUXERR_AUTO'),
+    ('magAuto', 'MAG_AUTO'),
+    ('magAutoErr', 'MAGERR_AUTO'),
+    ('fluxMax', 'FLUX_MAX'),
+    ('threshold', 'THRESHOLD'),
+    ('isoArea', 'ISOAREA_IMAGE'),
+    ('fluxRadius', 'FLUX_RADIUS'),
+    ('fwhm', 'FWHM_IMAGE'),
+    ('ellipticity', 'ELLIPTICITY'),
+    ('flags', 'FLAGS')
+    ]
+
+@shared_task(base=LeasedTask)
 def sextractor(filename, processInputId):
     taskStartTime = time.time()
 
@@ -1532,6 +1434,7 @@ def sextractor(filename, processInputId):
     # they could be independently matched against other detection algorithms.
     catfileName = settings.MEDIA_ROOT + filename + ".cat"
     proc = subprocess.Popen(['source-extractor', '-CATALOG_NAME', catfileName, settings.MEDIA_ROOT + filename,
+    '-CATALOG_TYPE', 'FITS_1.0', '-PARAMETERS_NAME', sextractorParamFilename,
     '-THRESH_TYPE', 'ABSOLUTE', '-DETECT_THRESH', str(detectThreshold)],
         stdout=subprocess.PIPE,
         stderr=subprocess.PIPE,
@@ -1549,178 +1452,88 @@ def sextractor(filename, processInputId):
     outputText += '\n ==================== End of process output ====================\n\n'
     errorText += '\n ==================== End of process error =====================\n\n'
 
-    with open(catfileName, 'r') as catfile:
-        fieldDict = {}
-        with transaction.atomic():
-            models.SextractorResult.objects.filter(image=image).delete()
-            fwhmValues = []
-            ellipticityValues = []
-            sextractorResults = []
-            for line in catfile:
-                # Split the line into fields (space separated) and throw out empty fields caused by multiple spaces in a
-                # row.  I.E. do a "combine consecutive delimeters" operation.
-                fields = line.split()
-
-                # Read the comment lines at the top of the file to record what fields are present and in what order.
-                if line.startswith("#"):
-                    fieldDict[fields[2]] = int(fields[1]) - 1
-
-                #For lines that are not comments, use the fieldDict to determine what fields to read and store in the database.
-                else:
-                    zPos = None   #TODO: Add image layer number if this is a data cube, just leaving null for now.
-                    sextractorResult = models.SextractorResult(
-                        image = image,
-                        pixelX = fields[fieldDict['X_IMAGE_DBL']],
-                        pixelY = fields[fieldDict['Y_IMAGE_DBL']],
-                        pixelZ = zPos,
-                        fluxAuto = fields[fieldDict['FLUX_AUTO']],
-                        fluxAutoErr = fields[fieldDict['FLUXERR_AUTO']],
-                        fwhm = fields[fieldDict['FWHM_IMAGE']],
-                        ellipticity = fields[fieldDict['ELLIPTICITY']],
-                        flags = fields[fieldDict['FLAGS']],
-                        boxXMin = fields[fieldDict['XMIN_IMAGE']],
-                        boxYMin = fields[fieldDict['YMIN_IMAGE']],
-                        boxXMax = fields[fieldDict['XMAX_IMAGE']],
-                        boxYMax = fields[fieldDict['YMAX_IMAGE']]
-                        )
-
-                    sextractorResults.append(sextractorResult)
-
-                    fwhmValues.append(parseFloat(fields[fieldDict['FWHM_IMAGE']]))
-                    ellipticityValues.append(parseFloat(fields[fieldDict['ELLIPTICITY']]))
-
-                    """
-                    fields[fieldDict['NUMBER']]
-                    fields[fieldDict['FLUX_ISO']]
-                    fields[fieldDict['FLUXERR_ISO']]
-                    fields[fieldDict['MAG_ISO']]
-                    fields[fieldDict['MAGERR_ISO']]
-                    fields[fieldDict['MAG_AUTO']]
-                    fields[fieldDict['MAGERR_AUTO']]
-                    fields[fieldDict['FLUX_BEST']]
-                    fields[fieldDict['FLUXERR_BEST']]
-                    fields[fieldDict['MAG_BEST']]
-                    fields[fieldDict['MAGERR_BEST']]
-                    fields[fieldDict['THRESHOLD']]
-                    fields[fieldDict['FLUX_MAX']]
-                    fields[fieldDict['XPEAK_IMAGE']]
-                    fields[fieldDict['YPEAK_IMAGE']]
-                    fields[fieldDict['X_IMAGE']]
-                    fields[fieldDict['Y_IMAGE']]
-                    fields[fieldDict['ISO0']]
-                    fields[fieldDict['ISO1']]
-                    fields[fieldDict['ISO2']]
-                    fields[fieldDict['ISO3']]
-                    fields[fieldDict['ISO4']]
-                    fields[fieldDict['ISO5']]
-                    fields[fieldDict['ISO6']]
-                    fields[fieldDict['ISO7']]
-                    fields[fieldDict['IMAFLAGS_ISO']]
-                    fields[fieldDict['NIMAFLAGS_ISO']]
-                    fields[fieldDict['FLUX_GROWTH']]
-                    fields[fieldDict['FLUX_GROWTHSTEP']]
-                    fields[fieldDict['MAG_GROWTH']]
-                    fields[fieldDict['MAG_GROWTHSTEP']]
-                    fields[fieldDict['FLUX_RADIUS']]
-                    fields[fieldDict['XPSF_IMAGE']]
-                    fields[fieldDict['YPSF_IMAGE']]
-                    fields[fieldDict['FLUX_PSF']]
-                    fields[fieldDict['FLUXERR_PSF']]
-                    fields[fieldDict['MAG_PSF']]
-                    fields[fieldDict['MAGERR_PSF']]
-                    fields[fieldDict['ERRAPSF_IMAGE']]
-                    fields[fieldDict['ERRBPSF_IMAGE']]
-                    fields[fieldDict['FLUX_MODEL']]
-                    fields[fieldDict['FLUXERR_MODEL']]
-                    fields[fieldDict['MAG_MODEL']]
-                    fields[fieldDict['MAGERR_MODEL']]
-                    fields[fieldDict['XMODEL_IMAGE']]
-                    fields[fieldDict['YMODEL_IMAGE']]
-                    fields[fieldDict['FLUX_POINTSOURCE']]
-                    fields[fieldDict['FLUXERR_POINTSOURCE']]
-                    fields[fieldDict['MAG_POINTSOURCE']]
-                    fields[fieldDict['MAGERR_POINTSOURCE']]
-                    """
-
-            models.SextractorResult.objects.bulk_create(sextractorResults)
-
-            fwhmMean = numpy.nanmean(fwhmValues)
-            fwhmMedian = numpy.nanmedian(fwhmValues)
-            fwhmStdDev = numpy.nanstd(fwhmValues)
-
-            ellipticityMean = numpy.nanmean(ellipticityValues)
-            ellipticityMedian = numpy.nanmedian(ellipticityValues)
-            ellipticityStdDev = numpy.nanstd(ellipticityValues)
-
-            outputText += "\n\nBefore removing hot pixels:\n"
-            outputText += "FWHM Mean {:.3f}    Median {:.3f}    StdDev {:.3f}\n".format(fwhmMean, fwhmMedian, fwhmStdDev)
-            outputText += "Ellipticity Mean {:.3f}    Median {:.3f}    StdDev {:.3f}\n".format(ellipticityMean, ellipticityMedian, ellipticityStdDev)
-
-            #TODO: Recode this section to calculate its own local average and standard deviation and then modify the confidence on sextractorResults array before doing the bulk_create.
-            records = models.SextractorResult.objects.filter(image=image)
-            meanFluxAuto = records.aggregate(Avg('fluxAuto'))['fluxAuto__avg']
-            stdDevFluxAuto = records.aggregate(StdDev('fluxAuto'))['fluxAuto__stddev']
-
-            outputText += "Found {} sources.\n".format(records.count())
-            for record in records:
-                # Assign the detected source a confidence based on the detected brightness with bright objects being high confidence.
-                try:
-                    record.confidence = sigmoid((record.fluxAuto-meanFluxAuto)/stdDevFluxAuto)
-                except ZeroDivisionError:
-                    record.confidence = 0.5
-                    outputText += "stdDevFluxAuto was 0 so assigning a confidence of 0.5 to detected source."
-
-                # Check the source to see if it looks like a hot pixel, and if so, add a hot pixel flag for the image.
-
-                # Check to see if the source has near perfect roundness and very high brightness dropoff (HP often have
-                # ellipticity of 0 so score1 ends up at or very near 0)
-                score1 = record.fwhm * record.ellipticity
-
-                #TODO Add score2, score3, ... etc to account for other HP that don't quite fit this form.  Maybe
-                # something along the lines of N standard devs off of the fwhm and ellipticity values.
-
-                if score1 < 0.1:
-                    hotPixel = models.UserSubmittedHotPixel(
-                        image = image,
-                        user = None,
-                        pixelX = record.pixelX,
-                        pixelY = record.pixelY,
-                        pixelZ = record.pixelZ,
-                        )
-
-                    hotPixel.save()
-                    record.flagHotPixel = True
-
-                record.save()
-
-            # Remove entries that were flagged as hot pixels from the fwhm and ellipticity averages for the image.
-            records = models.SextractorResult.objects.filter(image=image)
-            fwhmValues = []
-            ellipticityValues = []
-            for record in records:
-                if not record.flagHotPixel:
-                    fwhmValues.append(record.fwhm)
-                    ellipticityValues.append(record.ellipticity)
-
-            fwhmMean = numpy.nanmean(fwhmValues)
-            fwhmMedian = numpy.nanmedian(fwhmValues)
-            fwhmStdDev = numpy.nanstd(fwhmValues)
-
-            ellipticityMean = numpy.nanmean(ellipticityValues)
-            ellipticityMedian = numpy.nanmedian(ellipticityValues)
-            ellipticityStdDev = numpy.nanstd(ellipticityValues)
-
-            outputText += "\n\nAfter removing hot pixels:\n"
-            outputText += "FWHM Mean {:.3f}    Median {:.3f}    StdDev {:.3f}\n".format(fwhmMean, fwhmMedian, fwhmStdDev)
-            outputText += "Ellipticity Mean {:.3f}    Median {:.3f}    StdDev {:.3f}\n".format(ellipticityMean, ellipticityMedian, ellipticityStdDev)
-
-            image.addImageProperty('fwhmMean', fwhmMean, overwriteValue=True)
-            image.addImageProperty('fwhmMedian', fwhmMedian, overwriteValue=True)
-            image.addImageProperty('fwhmStdDev', fwhmStdDev, overwriteValue=True)
-
-            image.addImageProperty('ellipticityMean', ellipticityMean, overwriteValue=True)
-            image.addImageProperty('ellipticityMedian', ellipticityMedian, overwriteValue=True)
-            image.addImageProperty('ellipticityStdDev', ellipticityStdDev, overwriteValue=True)
+    # The FITS_1.0 catalog is a single binary table in the first extension, with one column per parameter in
+    # sextractorParamFilename.  Each column is read as a whole from the memory mapped table rather than parsing the
+    # catalog a line at a time.
+    with fits.open(catfileName, memmap=True) as hdulist:
+        catalog = hdulist[1].data
+        fieldNames = [fieldName for fieldName, columnName in sextractorColumns]
+        rows = zip(*[catalog[columnName].tolist() for fieldName, columnName in sextractorColumns])
+        sextractorResults = [models.SextractorResult(image=image, pixelZ=None, **dict(zip(fieldNames, row)))
+            for row in rows]
+
+        fwhmValues = numpy.array(catalog['FWHM_IMAGE'], dtype=numpy.float64)
+        ellipticityValues = numpy.array(catalog['ELLIPTICITY'], dtype=numpy.float64)
+        fluxAutoValues = numpy.array(catalog['FLUX_AUTO'], dtype=numpy.float64)
+
+    fwhmMean = numpy.nanmean(fwhmValues)
+    fwhmMedian = numpy.nanmedian(fwhmValues)
+    fwhmStdDev = numpy.nanstd(fwhmValues)
+
+    ellipticityMean = numpy.nanmean(ellipticityValues)
+    ellipticityMedian = numpy.nanmedian(ellipticityValues)
+    ellipticityStdDev = numpy.nanstd(ellipticityValues)
+
+    outputText += "\n\nBefore removing hot pixels:\n"
+    outputText += "FWHM Mean {:.3f}    Median {:.3f}    StdDev {:.3f}\n".format(fwhmMean, fwhmMedian, fwhmStdDev)
+    outputText += "Ellipticity Mean {:.3f}    Median {:.3f}    StdDev {:.3f}\n".format(ellipticityMean, ellipticityMedian, ellipticityStdDev)
+
+    # Assign each detected source a confidence based on the detected brightness with bright objects being high
+    # confidence.
+    outputText += "Found {} sources.\n".format(len(sextractorResults))
+    setConfidences(sextractorResults, fluxAutoValues)
+
+    # Check the sources to see if they look like hot pixels, and if so, add a hot pixel flag for the image.
+
+    # Check to see if the source has near perfect roundness and very high brightness dropoff (HP often have
+    # ellipticity of 0 so score1 ends up at or very near 0)
+    with numpy.errstate(invalid='ignore'):
+        score1 = fwhmValues * ellipticityValues
+        isHotPixel = score1 < 0.1
+
+    #TODO Add score2, score3, ... etc to account for other HP that don't quite fit this form.  Maybe
+    # something along the lines of N standard devs off of the fwhm and ellipticity values.
+
+    hotPixels = []
+    for sextractorResult in itertools.compress(sextractorResults, isHotPixel):
+        sextractorResult.flagHotPixel = True
+        hotPixels.append(models.UserSubmittedHotPixel(
+            image = image,
+            user = None,
+            pixelX = sextractorResult.pixelX,
+            pixelY = sextractorResult.pixelY,
+            pixelZ = sextractorResult.pixelZ,
+            ))
+
+    # Remove entries that were flagged as hot pixels from the fwhm and ellipticity averages for the image.
+    fwhmValues = fwhmValues[~isHotPixel]
+    ellipticityValues = ellipticityValues[~isHotPixel]
+
+    fwhmMean = numpy.nanmean(fwhmValues)
+    fwhmMedian = numpy.nanmedian(fwhmValues)
+    fwhmStdDev = numpy.nanstd(fwhmValues)
+
+    ellipticityMean = numpy.nanmean(ellipticityValues)
+    ellipticityMedian = numpy.nanmedian(ellipticityValues)
+    ellipticityStdDev = numpy.nanstd(ellipticityValues)
+
+    outputText += "\n\nAfter removing hot pixels:\n"
+    outputText += "FWHM Mean {:.3f}    Median {:.3f}    StdDev {:.3f}\n".format(fwhmMean, fwhmMedian, fwhmStdDev)
+    outputText += "Ellipticity Mean {:.3f}    Median {:.3f}    StdDev {:.3f}\n".format(ellipticityMean, ellipticityMedian, ellipticityStdDev)
+
+    with transaction.atomic():
+        models.SextractorResult.objects.filter(image=image).delete()
+        models.SextractorResult.objects.bulk_create(sextractorResults)
+        models.UserSubmittedHotPixel.objects.bulk_create(hotPixels)
+
+        image.addImageProperty('fwhmMean', fwhmMean, overwriteValue=True)
+        image.addImageProperty('fwhmMedian', fwhmMedian, overwriteValue=True)
+        image.addImageProperty('fwhmStdDev', fwhmStdDev, overwriteValue=True)
+
+        image.addImageProperty('ellipticityMean', ellipticityMean, overwriteValue=True)
+        image.addImageProperty('ellipticityMedian', ellipticityMedian, overwriteValue=True)
+        image.addImageProperty('ellipticityStdDev', ellipticityStdDev, overwriteValue=True)
+
     try:
         os.remove(catfileName)
     except OSError:
@@ -1728,7 +1541,7 @@ def sextractor(filename, processInputId):
 
     return constructProcessOutput(outputText, errorText, time.time() - taskStartTime)
 
-@shared_task
+@shared_task(base=LeasedTask)
 def image2xy(filename, processInputId):
     outputText = ""
     errorText = ""
@@ -1804,17 +1617,10 @@ def image2xy(filename, processInputId):
 
             image2xyResults.append(result)
 
-        models.Image2xyResult.objects.bulk_create(image2xyResults)
-
-        #TODO: Recode this section to calculate its own local average and standard deviation and then modify the confidence on sextractorResults array before doing the bulk_create.
-        records = models.Image2xyResult.objects.filter(image=image)
-        meanFlux = records.aggregate(Avg('flux'))['flux__avg']
-        stdDevFlux = records.aggregate(StdDev('flux'))['flux__stddev']
+        outputText += "Found {} sources.\n".format(len(image2xyResults))
+        setConfidences(image2xyResults, [result.flux for result in image2xyResults])
 
-        outputText += "Found {} sources.\n".format(records.count())
-        for record in records:
-            record.confidence = sigmoid((record.flux-meanFlux)/stdDevFlux)
-            record.save()
+        models.Image2xyResult.objects.bulk_create(image2xyResults)
 
     try:
         os.remove(outputFilename)
@@ -1823,137 +1629,102 @@ def image2xy(filename, processInputId):
 
     return constructProcessOutput(outputText, errorText, time.time() - taskStartTime)
 
-@shared_task
+@shared_task(base=LeasedTask)
 def daofind(filename, processInputId):
     taskStartTime = time.time()
 
     #TODO: daofind can only handle .fit files.  Should autoconvert the file to .fit if necessary before running.
     image = models.Image.objects.get(fileRecord__onDiskFileName=filename)
 
-    #TODO: Handle multi-extension fits files.
-    channelInfos = models.ImageChannelInfo.objects.filter(image=image).order_by('index')
-
     detectThresholdMultiplier, shouldReturn, outputText, errorText = initSourcefind('daofind', image)
 
     if shouldReturn:
         return constructProcessOutput(outputText, errorText, time.time() - taskStartTime)
 
-    detectThreshold = detectThresholdMultiplier*channelInfos[0].bgStdDev
-    outputText += 'Final multiplier of {} standard deviations.\n'.format(detectThresholdMultiplier)
-    outputText += 'Final detect threshold of {} above background.\n'.format(detectThreshold)
-
-    hdulist = fits.open(settings.MEDIA_ROOT + filename)
-    data = hdulist[0].data
-
-    if len(data.shape) == 3:
-        data = data[0]
+    channelSources, thresholdCurve, retText = findSourcesInChannels(DAOStarFinder, image, detectThresholdMultiplier)
+    outputText += retText
 
-    fwhm = parseFloat(image.getImageProperty('fwhmMedian', 2.5))
-    outputText += "\nUsing FWHM of {}\n".format(fwhm)
-    daofind = DAOStarFinder(fwhm = fwhm, threshold = detectThreshold)
-    sources = daofind(data - channelInfos[0].bgMedian)
+    if thresholdCurve is not None:
+        image.addImageProperty('daofindThresholdCurve', json.dumps(thresholdCurve), overwriteValue=True)
 
     with transaction.atomic():
         models.DaofindResult.objects.filter(image=image).delete()
         daofindResults = []
-        for source in (sources or []):
-            result = models.DaofindResult(
-                image = image,
-                pixelX = source['xcentroid'],
-                pixelY = source['ycentroid'],
-                pixelZ = None,    #TODO: Handle multi-extension fits files.
-                mag = source['mag'],
-                flux = source['flux'],
-                peak = source['peak'],
-                sharpness = source['sharpness'],
-                sround = source['roundness1'],
-                ground = source['roundness2']
-                )
-
-            daofindResults.append(result)
+        for channelInfo, sources in channelSources:
+            for source in (sources or []):
+                result = models.DaofindResult(
+                    image = image,
+                    pixelX = source['xcentroid'],
+                    pixelY = source['ycentroid'],
+                    pixelZ = channelInfo.index,
+                    mag = source['mag'],
+                    flux = source['flux'],
+                    peak = source['peak'],
+                    sharpness = source['sharpness'],
+                    sround = source['roundness1'],
+                    ground = source['roundness2']
+                    )
 
-        models.DaofindResult.objects.bulk_create(daofindResults)
+                daofindResults.append(result)
 
-        #TODO: Recode this section to calculate its own local average and standard deviation and then modify the confidence on sextractorResults array before doing the bulk_create.
-        records = models.DaofindResult.objects.filter(image=image)
-        meanMag = records.aggregate(Avg('mag'))['mag__avg']
-        stdDevMag = records.aggregate(StdDev('mag'))['mag__stddev']
+        # Magnitudes are smaller for brighter sources, so they are negated to give bright sources high confidence.
+        #TODO: Incorporate sharpness, sround, and ground into the calculation.
+        outputText += "Found {} sources.\n".format(len(daofindResults))
+        setConfidences(daofindResults, [-result.mag for result in daofindResults])
 
-        outputText += "Found {} sources.\n".format(records.count())
-        for record in records:
-            #TODO: Incorporate sharpness, sround, and ground into the calculation.
-            #TODO: Ensure stdDevMag is not zero and check that other sourcefind methods don't have the same issue.
-            record.confidence = sigmoid((meanMag-record.mag)/stdDevMag)
-            record.save()
+        models.DaofindResult.objects.bulk_create(daofindResults)
 
     return constructProcessOutput(outputText, errorText, time.time() - taskStartTime)
 
-@shared_task
+@shared_task(base=LeasedTask)
 def starfind(filename, processInputId):
     taskStartTime = time.time()
 
     #TODO: starfind can only handle .fit files.  Should autoconvert the file to .fit if necessary before running.
     image = models.Image.objects.get(fileRecord__onDiskFileName=filename)
 
-    #TODO: Handle multi-extension fits files.
-    channelInfos = models.ImageChannelInfo.objects.filter(image=image).order_by('index')
-
     detectThresholdMultiplier, shouldReturn, outputText, errorText = initSourcefind('starfind', image)
 
     if shouldReturn:
         return constructProcessOutput(outputText, errorText, time.time() - taskStartTime)
 
-    detectThreshold = detectThresholdMultiplier*channelInfos[0].bgStdDev
-    outputText += 'Final multiplier of {} standard deviations.\n'.format(detectThresholdMultiplier)
-    outputText += 'Final detect threshold of {} above background.\n'.format(detectThreshold)
-
-    hdulist = fits.open(settings.MEDIA_ROOT + filename)
-    data = hdulist[0].data
-
-    if len(data.shape) == 3:
-        data = data[0]
+    channelSources, thresholdCurve, retText = findSourcesInChannels(IRAFStarFinder, image, detectThresholdMultiplier)
+    outputText += retText
 
-    fwhm = parseFloat(image.getImageProperty('fwhmMedian', 2.5))
-    outputText += "\nUsing FWHM of {}\n".format(fwhm)
-    starfinder = IRAFStarFinder(fwhm = fwhm, threshold = detectThreshold)
-    sources = starfinder(data - channelInfos[0].bgMedian)
+    if thresholdCurve is not None:
+        image.addImageProperty('starfindThresholdCurve', json.dumps(thresholdCurve), overwriteValue=True)
 
     with transaction.atomic():
         models.StarfindResult.objects.filter(image=image).delete()
         starfindResults = []
-        for source in (sources or []):
-            result = models.StarfindResult(
-                image = image,
-                pixelX = source['xcentroid'],
-                pixelY = source['ycentroid'],
-                pixelZ = None,    #TODO: Handle multi-extension fits files.
-                mag = source['mag'],
-                peak = source['peak'],
-                flux = source['flux'],
-                fwhm = source['fwhm'],
-                sharpness = source['sharpness'],
-                roundness = source['roundness'],
-                pa = source['pa']
-                )
+        for channelInfo, sources in channelSources:
+            for source in (sources or []):
+                result = models.StarfindResult(
+                    image = image,
+                    pixelX = source['xcentroid'],
+                    pixelY = source['ycentroid'],
+                    pixelZ = channelInfo.index,
+                    mag = source['mag'],
+                    peak = source['peak'],
+                    flux = source['flux'],
+                    fwhm = source['fwhm'],
+                    sharpness = source['sharpness'],
+                    roundness = source['roundness'],
+                    pa = source['pa']
+                    )
 
-            starfindResults.append(result)
+                starfindResults.append(result)
 
-        models.StarfindResult.objects.bulk_create(starfindResults)
+        # Magnitudes are smaller for brighter sources, so they are negated to give bright sources high confidence.
+        #TODO: Incorporate sharpness, roundness, etc, into the calculation.
+        outputText += "Found {} sources.\n".format(len(starfindResults))
+        setConfidences(starfindResults, [-result.mag for result in starfindResults])
 
-        #TODO: Recode this section to calculate its own local average and standard deviation and then modify the confidence on sextractorResults array before doing the bulk_create.
-        records = models.StarfindResult.objects.filter(image=image)
-        meanMag = records.aggregate(Avg('mag'))['mag__avg']
-        stdDevMag = records.aggregate(StdDev('mag'))['mag__stddev']
-
-        outputText += "Found {} sources.\n".format(records.count())
-        for record in records:
-            #TODO: Incorporate sharpness, roundness, etc, into the calculation.
-            record.confidence = sigmoid((meanMag-record.mag)/stdDevMag)
-            record.save()
+        models.StarfindResult.objects.bulk_create(starfindResults)
 
     return constructProcessOutput(outputText, errorText, time.time() - taskStartTime)
 
-@shared_task
+@shared_task(base=LeasedTask)
 def starmatch(filename, processInputId):
     """
     A celery task to loop over every pair of source finding methods, and for every pair,
@@ -2014,12 +1785,17 @@ def starmatch(filename, processInputId):
             nearestResult = None
             x1 = r1.pixelX
             y1 = r1.pixelY
+            z1 = r1.pixelZ or 0
 
             # This inner loop loops over the second result set, but since the result sets
             # are sorted by pixelX, we only loop over the portion of the result set where
             # the pixelX is within the maxAllowedDistance.  Limiting the search like this
             # speeds this function up by several orders of magnitude.
             for r2 in results2.irange_key(r1.pixelX - maxAllowedDistance, r1.pixelX + maxAllowedDistance):
+                # Only match sources found in the same channel, results with no channel are from the first one.
+                if (r2.pixelZ or 0) != z1:
+                    continue
+
                 dx = r2.pixelX - x1
                 dy = r2.pixelY - y1
                 dSq = dx*dx + dy*dy
@@ -2162,7 +1938,7 @@ def starmatch(filename, processInputId):
 
     return constructProcessOutput(outputText, errorText, time.time() - taskStartTime)
 
-@shared_task
+@shared_task(base=LeasedTask)
 def astrometryNet(filename, processInputId):
     """
     A celery task to run the astrometry.net plate solver with a custom list of detected
@@ -2420,7 +2196,7 @@ def astrometryNet(filename, processInputId):
 
     return constructProcessOutput(outputText, errorText, time.time() - taskStartTime)
 
-@shared_task
+@shared_task(base=LeasedTask)
 def parseHeaders(imageId, processInputId):
     outputText = ""
     errorText = ""
@@ -3084,7 +2860,7 @@ def parseHeaders(imageId, processInputId):
 
     return constructProcessOutput(outputText, errorText, time.time() - taskStartTime)
 
-@shared_task
+@shared_task(base=LeasedTask)
 def flagSources(imageIdString, processInputId):
     outputText = ""
     errorText = ""
@@ -3143,7 +2919,7 @@ def flagSources(imageIdString, processInputId):
 
     return constructProcessOutput(outputText, errorText, time.time() - taskStartTime)
 
-@shared_task
+@shared_task(base=LeasedTask)
 def imageCombine(argList, processInputId):
     outputText = ""
     errorText = ""
@@ -3260,8 +3036,6 @@ def imageCombine(argList, processInputId):
         #TODO: Look into using ccdproc.ccd_process() to do the bias, dark, flat, etc, corrections.
         outputText += "\n\n"
         outputText += "Loading image {}: {}\n".format(image.pk, image.fileRecord.originalFileName)
-        hdulist = fits.open(settings.MEDIA_ROOT + image.fileRecord.onDiskFileName)
-
         imageExposure = image.getExposureTime()
         outputText += "   Image exposure time is: {}\n".format(imageExposure)
 
@@ -3278,10 +3052,7 @@ def imageCombine(argList, processInputId):
             if doMatrixTransform:
                 break
 
-        #TODO: Do a better job than just choosing the first frame like we do now.
-        data = hdulist[0].data
-        if len(data.shape) == 3:
-            data = data[0]
+        data = loadFrame(image.fileRecord)
 
         #NOTE: This bias subtraction is done here inside the loop for code cleanliness
         # reasons, and in case of future expansions when it might want to be treated
@@ -3289,12 +3060,7 @@ def imageCombine(argList, processInputId):
         # subtract it once at the end of the loop.
         if masterBiasImage is not None:
             outputText += "Bias correcting image.\n"
-            masterBiasHdulist = fits.open(settings.MEDIA_ROOT + masterBiasImage.fileRecord.onDiskFileName)
-
-            #TODO: Do a better job than just choosing the first frame like we do now.
-            masterBiasData = masterBiasHdulist[0].data
-            if len(masterBiasData.shape) == 3:
-                masterBiasData = masterBiasData[0]
+            masterBiasData = loadFrame(masterBiasImage.fileRecord)
 
             outputText += "  Before subtract: data:{} masterBiasData:{}\n".format(data.dtype.name, masterBiasData.dtype.name)
             #NOTE: Do not switch to -= operator since that precludes datatype upcasting.
@@ -3303,12 +3069,7 @@ def imageCombine(argList, processInputId):
 
         if masterDarkImage is not None:
             outputText += "Dark correcting image.\n"
-            masterDarkHdulist = fits.open(settings.MEDIA_ROOT + masterDarkImage.fileRecord.onDiskFileName)
-
-            #TODO: Do a better job than just choosing the first frame like we do now.
-            masterDarkData = masterDarkHdulist[0].data
-            if len(masterDarkData.shape) == 3:
-                masterDarkData = masterDarkData[0]
+            masterDarkData = loadFrame(masterDarkImage.fileRecord)
 
             if darkExposure is not None and imageExposure is not None and imageExposure != 'unknown':
                 try:
@@ -3327,12 +3088,7 @@ def imageCombine(argList, processInputId):
 
         if masterFlatImage is not None:
             outputText += "Flat correcting image.\n"
-            masterFlatHdulist = fits.open(settings.MEDIA_ROOT + masterFlatImage.fileRecord.onDiskFileName)
-
-            #TODO: Do a better job than just choosing the first frame like we do now.
-            masterFlatData = masterFlatHdulist[0].data
-            if len(masterFlatData.shape) == 3:
-                masterFlatData = masterFlatData[0]
+            masterFlatData = loadFrame(masterFlatImage.fileRecord)
 
             outputText += "  Before divide: data:{} masterFlatData:{}\n".format(data.dtype.name, masterFlatData.dtype.name)
             #NOTE: Do not switch to /= operator since that precludes datatype upcasting.
@@ -3341,7 +3097,6 @@ def imageCombine(argList, processInputId):
 
         if doReproject:
             outputText += 'Reprojecting image.\n'
-            hdulist[0].data = data
             dataToProject = CCDData(data, wcs=image.getBestPlateSolution().wcs(), unit=u.adu)
             data = wcs_project(dataToProject, referenceWCS, target_shape=outputShape)
             dataArray.append(data)
@@ -3463,7 +3218,7 @@ def imageCombine(argList, processInputId):
     # pre-requisite to all of the created tasks so that none of them (for example image
     # stats) can run before the remainder of this function finishes.  An unlikely scenario
     # but still a possible race condition none the less.
-    image = createTasksForNewImage(fileRecord, processInput.requestor)
+    image = createTasksForNewImages([fileRecord], processInput.requestor)[0]
     if doReproject:
         image.addImageProperty('wcsSource', 'cosmic:stack-reproject')
 
@@ -3479,7 +3234,7 @@ def imageCombine(argList, processInputId):
 
     return constructProcessOutput(outputText, errorText, time.time() - taskStartTime)
 
-@shared_task
+@shared_task(base=LeasedTask)
 def calculateUserCostTotals(startTimeString, endTimeString, processInputId):
     outputText = ""
     errorText = ""
@@ -1,3 +1,325 @@
-from django.test import TestCase
+import os
+import numpy
 
-# Create your tests here.
+from django.test import SimpleTestCase, override_settings
+from photutils import DAOStarFinder, IRAFStarFinder
+
+from .framestats import FrameStatistics, ValueCounter, findBathtub, findBlackPoint, findWhitePoint
+from .dispatch import getQueueForProcess, parseProcessLimits, getAvailableQueues, getSaturatedProcesses
+from .thumbnails import resampleAxis, resampleArea, halveImage
+from .background import measureBackgroundGrid, expandBackgroundGrid
+from .parallel import getNumChannelWorkers, mapChannels
+from .sourcefind import thresholdLadder, countPeaksAtThresholds, getSourcefindTiles, getSourcefindTileMargin, \
+    findSourcesInTile
+
+# These tests only cover the pure numpy parts of the image processing and the dispatch policy, none of them touch the
+# database.
+
+class FrameStatisticsTests(SimpleTestCase):
+    def setUp(self):
+        self.random = numpy.random.RandomState(12345)
+
+    def assertMatchesUnique(self, valueFrequency, data):
+        values, counts = numpy.unique(data, return_counts=True)
+        numpy.testing.assert_array_equal(valueFrequency[:, 0], values)
+        numpy.testing.assert_array_equal(valueFrequency[:, 1], counts)
+
+    def testIntegerFrameMatchesUnique(self):
+        frame = self.random.randint(-500, 3000, size=(123, 77)).astype(numpy.int16)
+
+        # A small tile size so the frame is counted across many tiles.
+        stats = FrameStatistics(frame, maxTileBytes=4096).compute()
+
+        self.assertMatchesUnique(stats.valueFrequency, frame)
+        numpy.testing.assert_allclose(stats.rowMeans, frame.mean(axis=1))
+        numpy.testing.assert_allclose(stats.colMeans, frame.mean(axis=0))
+
+    def testScaledIntegerFrameMatchesUnique(self):
+        # Unsigned 16 bit data is stored in fits as signed with a BZERO of 32768.
+        physical = self.random.randint(0, 65536, size=(64, 50))
+        raw = (physical - 32768).astype(numpy.int16)
+
+        stats = FrameStatistics(raw, maxTileBytes=4096, bzero=32768).compute()
+
+        self.assertMatchesUnique(stats.valueFrequency, physical)
+
+    def testWideIntegerFrameMatchesUnique(self):
+        frame = self.random.randint(-10**6, 10**6, size=(40, 30)).astype(numpy.int32)
+
+        stats = FrameStatistics(frame, maxTileBytes=4096).compute()
+
+        self.assertMatchesUnique(stats.valueFrequency, frame)
+
+    def testFloatFrameStatistics(self):
+        frame = self.random.normal(1000.0, 25.0, size=(90, 110))
+        frame[5, 7] = numpy.nan
+        frame[40, :] = 65535.0
+        finite = frame[numpy.isfinite(frame)]
+
+        stats = FrameStatistics(frame, maxTileBytes=4096).compute()
+        values = stats.valueFrequency[:, 0]
+        counts = stats.valueFrequency[:, 1]
+
+        self.assertEqual(counts.sum(), finite.size)
+        self.assertTrue(numpy.all(numpy.diff(values) > 0))
+        self.assertAlmostEqual(numpy.sum(values * counts) / counts.sum(), finite.mean(), places=6)
+        self.assertAlmostEqual(values[0], finite.min())
+        self.assertEqual(values[-1], 65535.0)
+        self.assertEqual(counts[-1], frame.shape[1])
+        numpy.testing.assert_allclose(stats.rowMeans, numpy.nanmean(frame, axis=1))
+        numpy.testing.assert_allclose(stats.colMeans, numpy.nanmean(frame, axis=0))
+
+    def testAllNanFrame(self):
+        frame = numpy.full((10, 10), numpy.nan)
+
+        stats = FrameStatistics(frame).compute()
+
+        self.assertEqual(stats.valueFrequency.shape, (0, 2))
+
+    def testValueCounterBinsFloatValues(self):
+        counter = ValueCounter(0.0, 1.0, False)
+        counter.add(numpy.array([0.0, 0.25, 0.25, 1.0, numpy.inf]))
+
+        numpy.testing.assert_array_equal(counter.getValueFrequency(), [[0.0, 1], [0.25, 2], [1.0, 1]])
+
+class HistogramSearchTests(SimpleTestCase):
+    def makeValueFrequency(self, counts):
+        return numpy.column_stack((numpy.arange(len(counts), dtype=numpy.float64), counts))
+
+    def testBathtubStripsBothEnds(self):
+        valueFrequency = self.makeValueFrequency([1000] + [10]*8 + [500])
+
+        minIndex, maxIndex, remainingPixels, bathtubIndices, bathtubLow, bathtubHigh, bathtubFail = \
+            findBathtub(valueFrequency, 1580, 0.2)
+
+        self.assertEqual((minIndex, maxIndex), (1, 8))
+        self.assertEqual(remainingPixels, 80)
+        self.assertEqual(bathtubIndices, [0, 9])
+        self.assertEqual((bathtubLow, bathtubHigh), (0.0, 9.0))
+        self.assertFalse(bathtubFail)
+
+    def testBathtubStripsRuns(self):
+        valueFrequency = self.makeValueFrequency([1000, 400] + [10]*8)
+
+        minIndex, maxIndex, remainingPixels, bathtubIndices, bathtubLow, bathtubHigh, bathtubFail = \
+            findBathtub(valueFrequency, 1480, 0.2)
+
+        self.assertEqual((minIndex, maxIndex), (2, 9))
+        self.assertEqual(remainingPixels, 80)
+        self.assertEqual(bathtubIndices, [0, 1])
+        self.assertEqual((bathtubLow, bathtubHigh), (1.0, None))
+        self.assertFalse(bathtubFail)
+
+    def testBathtubFlatHistogram(self):
+        valueFrequency = self.makeValueFrequency([10]*20)
+
+        minIndex, maxIndex, remainingPixels, bathtubIndices, bathtubLow, bathtubHigh, bathtubFail = \
+            findBathtub(valueFrequency, 200, 0.2)
+
+        self.assertEqual((minIndex, maxIndex), (0, 19))
+        self.assertEqual(bathtubIndices, [])
+        self.assertFalse(bathtubFail)
+
+    def testBathtubFailsWhenEndsMeet(self):
+        valueFrequency = self.makeValueFrequency([10, 10])
+
+        bathtubFail = findBathtub(valueFrequency, 20, 0.1)[6]
+
+        self.assertTrue(bathtubFail)
+
+    def testBlackPoint(self):
+        valueFrequency = self.makeValueFrequency([10]*5)
+
+        self.assertEqual(findBlackPoint(valueFrequency, 0, 15), (0.5, 1, 20))
+        self.assertEqual(findBlackPoint(valueFrequency, 0, 20), (1.0, 1, 20))
+        self.assertEqual(findBlackPoint(valueFrequency, 2, 0), (2.0, 2, 10))
+
+    def testWhitePoint(self):
+        valueFrequency = self.makeValueFrequency([10]*5)
+
+        self.assertEqual(findWhitePoint(valueFrequency, 4, 15), (3.5, 3, 20))
+        self.assertEqual(findWhitePoint(valueFrequency, 4, 20), (3.0, 3, 20))
+        self.assertEqual(findWhitePoint(valueFrequency, 2, 0), (2.0, 2, 10))
+
+@override_settings(
+    DISPATCH_QUEUES={'io': 4, 'cpu-heavy': 4, 'solver': 1, 'light': 4},
+    DISPATCH_PROCESS_QUEUES={'imagestats': 'io', 'sextractor': 'cpu-heavy', 'astrometryNet': 'solver'},
+    DISPATCH_LIGHT_COST_LIMITS={'cpu': 1, 'io': 10e6},
+    )
+class DispatchTests(SimpleTestCase):
+    def testKnownProcessQueue(self):
+        self.assertEqual(getQueueForProcess('sextractor', 10, 20e6), 'cpu-heavy')
+        self.assertEqual(getQueueForProcess('imagestats', 20, 20e6), 'io')
+        self.assertEqual(getQueueForProcess('sextractor'), 'cpu-heavy')
+
+    def testSmallTasksGoToLight(self):
+        self.assertEqual(getQueueForProcess('sextractor', 0.5, 1e6), 'light')
+        self.assertEqual(getQueueForProcess('imagestats', 0.5), 'light')
+        self.assertEqual(getQueueForProcess('sextractor', 0.5, 20e6), 'cpu-heavy')
+
+    def testSolverIsNeverMoved(self):
+        self.assertEqual(getQueueForProcess('astrometryNet', 0.1, 1000), 'solver')
+
+    def testUnknownProcessQueue(self):
+        self.assertEqual(getQueueForProcess('unknown', 100, 1000), 'cpu-heavy')
+        self.assertEqual(getQueueForProcess('unknown', None, 20e6), 'io')
+        self.assertEqual(getQueueForProcess('unknown'), 'light')
+
+    def testParseProcessLimits(self):
+        limits = parseProcessLimits('astrometryNet:1, sextractor : 4,malformed,daofind:x,')
+
+        self.assertEqual(limits, {'astrometryNet': 1, 'sextractor': 4})
+
+    def testAvailableQueues(self):
+        self.assertEqual(getAvailableQueues({'io': 4, 'cpu-heavy': 3, 'solver': 1}), ['cpu-heavy', 'light'])
+
+    def testSaturatedProcesses(self):
+        saturated = getSaturatedProcesses({'astrometryNet': 1, 'sextractor': 2, 'daofind': 5},
+            {'astrometryNet': 1, 'sextractor': 3, 'starfind': 1})
+
+        self.assertEqual(saturated, ['astrometryNet'])
+
+class ThumbnailTests(SimpleTestCase):
+    def testResampleAxisWholeRatio(self):
+        numpy.testing.assert_allclose(resampleAxis(numpy.arange(6), 3, 0), [0.5, 2.5, 4.5])
+
+    def testResampleAxisFractionalRatio(self):
+        # The middle pixel is split between the two output pixels.
+        numpy.testing.assert_allclose(resampleAxis(numpy.array([0, 3, 6]), 2, 0), [1.0, 5.0])
+
+    def testResampleAxisKeepsOtherAxes(self):
+        data = numpy.array([[0, 2, 4, 6], [10, 12, 14, 16]])
+
+        numpy.testing.assert_allclose(resampleAxis(data, 2, 1), [[1, 5], [11, 15]])
+        numpy.testing.assert_allclose(resampleAxis(data, 1, 0), [[5, 7, 9, 11]])
+
+    def testResampleArea(self):
+        data = numpy.full((40, 60, 3), 200, dtype=numpy.uint8)
+
+        resampled = resampleArea(data, 25, 17)
+
+        self.assertEqual(resampled.shape, (17, 25, 3))
+        self.assertEqual(resampled.dtype, numpy.uint8)
+        self.assertTrue(numpy.all(resampled == 200))
+
+    def testHalveImage(self):
+        data = numpy.array([[0, 2, 10, 20], [4, 6, 30, 40]], dtype=numpy.uint8)
+
+        numpy.testing.assert_array_equal(halveImage(data), [[3, 25]])
+
+    def testHalveImageOddSize(self):
+        data = numpy.array([[0, 2, 8], [4, 6, 8], [100, 100, 50]], dtype=numpy.uint8)
+
+        numpy.testing.assert_array_equal(halveImage(data), [[3, 8], [100, 50]])
+
+class BackgroundTests(SimpleTestCase):
+    def testGradientBackground(self):
+        random = numpy.random.RandomState(54321)
+        boxSize = 32
+        rows, cols = numpy.mgrid[0:256, 0:320]
+        frame = 100 + 0.1*cols + 0.05*rows + random.normal(0, 2, size=rows.shape)
+
+        # A few bright stars which the sigma clipping should reject.
+        for row, col in [(40, 50), (100, 200), (200, 300), (130, 17)]:
+            frame[row-2:row+3, col-2:col+3] += 5000
+
+        background, rms = measureBackgroundGrid(frame, boxSize)
+
+        self.assertEqual(background.shape, (8, 10))
+        centers = numpy.arange(8)[:, numpy.newaxis]*boxSize + boxSize/2 - 0.5, \
+            numpy.arange(10)[numpy.newaxis, :]*boxSize + boxSize/2 - 0.5
+        expected = 100 + 0.1*centers[1] + 0.05*centers[0]
+
+        # The median filter flattens the gradient in the boxes along the edge of the grid, so only the inside is exact.
+        numpy.testing.assert_allclose(background[1:-1, 1:-1], expected[1:-1, 1:-1], atol=0.5)
+        numpy.testing.assert_allclose(rms, 2.0, rtol=0.15)
+
+    def testExpandBackgroundGrid(self):
+        expanded = expandBackgroundGrid([[0, 1, 2]], 2, (2, 6))
+
+        numpy.testing.assert_allclose(expanded, [[0, 0.25, 0.75, 1.25, 1.75, 2]]*2)
+
+def addInWorker(a, b):
+    return a + b, os.getpid()
+
+@override_settings(CHANNEL_WORKERS_PER_TASK=2)
+class ParallelTests(SimpleTestCase):
+    def testNumChannelWorkers(self):
+        self.assertEqual(getNumChannelWorkers(1), 1)
+        self.assertEqual(getNumChannelWorkers(5), 2)
+        self.assertEqual(getNumChannelWorkers(0), 1)
+
+    def testMapChannels(self):
+        results = mapChannels(addInWorker, [(i, 10) for i in range(5)])
+
+        self.assertEqual([total for total, pid in results], [10, 11, 12, 13, 14])
+        self.assertNotIn(os.getpid(), [pid for total, pid in results])
+
+class SourcefindTests(SimpleTestCase):
+    def setUp(self):
+        random = numpy.random.RandomState(2468)
+        self.height, self.width = 150, 200
+        rows, cols = numpy.mgrid[0:self.height, 0:self.width]
+        self.frame = 100 + 0.05*cols + random.normal(0, 5, size=rows.shape)
+
+        # Stars scattered over the frame, and a row of them straddling the seams between the 64 pixel tiles.
+        positions = list(zip(random.uniform(0, self.width, 60), random.uniform(0, self.height, 60)))
+        positions += [(64 + offset, 20 + 10*i) for i, offset in enumerate([-1.5, -0.5, -0.2, 0.3, 0.5, 1.5])]
+        positions += [(100 + 7*i, 128 + offset) for i, offset in enumerate([-1, -0.5, 0, 0.5, 1])]
+        for x, y in positions:
+            self.frame += 300 * numpy.exp(-((cols - x)**2 + (rows - y)**2) / (2 * 1.5**2))
+
+        self.background = 100 + 0.05*cols
+        self.rms = numpy.full(self.frame.shape, 5.0)
+
+    def findSources(self, finderClass, fwhm, tileSize, useMap):
+        """
+        Search the frame in tiles the same way findSourcesInChannels does, returning the sorted centroids of all the
+        sources found and the total peak counts.
+        """
+        margin = getSourcefindTileMargin(fwhm)
+        centroids = []
+        peakCounts = numpy.zeros(len(thresholdLadder), dtype=numpy.int64)
+        for top, bottom, left, right in getSourcefindTiles(self.width, self.height, tileSize):
+            rows = slice(max(0, top - margin), min(self.height, bottom + margin))
+            cols = slice(max(0, left - margin), min(self.width, right + margin))
+            background = self.background[rows, cols] if useMap else None
+            rms = self.rms[rows, cols] if useMap else None
+
+            sources, tilePeakCounts = findSourcesInTile(finderClass, self.frame[rows, cols], background, rms,
+                (rows.start, cols.start), (top, bottom, left, right), fwhm, 5, 5.0, 100.0, 5.0, True)
+
+            peakCounts += tilePeakCounts
+            if sources is not None:
+                centroids.extend(zip(numpy.asarray(sources['xcentroid']), numpy.asarray(sources['ycentroid'])))
+
+        return numpy.array(sorted(centroids)), peakCounts
+
+    def testTiledMatchesWholeFrame(self):
+        wholeTileSize = max(self.width, self.height)
+        for finderClass in [DAOStarFinder, IRAFStarFinder]:
+            for fwhm in [2.5, 4]:
+                for useMap in [False, True]:
+                    with self.subTest(finder=finderClass.__name__, fwhm=fwhm, useMap=useMap):
+                        whole, wholePeakCounts = self.findSources(finderClass, fwhm, wholeTileSize, useMap)
+                        tiled, tiledPeakCounts = self.findSources(finderClass, fwhm, 64, useMap)
+
+                        self.assertGreater(len(whole), 0)
+                        numpy.testing.assert_allclose(tiled, whole)
+                        numpy.testing.assert_array_equal(tiledPeakCounts, wholePeakCounts)
+
+    def testCountPeaksAtThresholds(self):
+        data = numpy.zeros((50, 50))
+        data[10, 10] = 100
+        data[30, 40] = 50
+
+        # The peaks are counted after smoothing by a star sized gaussian, which spreads each single pixel peak out to a
+        # little over a fifth of its height.
+        counts = countPeaksAtThresholds(data, 2.0, numpy.array([1.0, 15.0, 1000.0]))
+
+        numpy.testing.assert_array_equal(counts, [2, 1, 0])
+
+    def testSourcefindTiles(self):
+        self.assertEqual(getSourcefindTiles(100, 70, 64),
+            [(0, 64, 0, 64), (0, 64, 64, 100), (64, 70, 0, 64), (64, 70, 64, 100)])
+        self.assertEqual(getSourcefindTiles(None, 70, 64), [(0, None, 0, None)])
@@ -0,0 +1,132 @@
+"""
+Downsampling of the full size png thumbnail written by imagestats into the smaller standard thumbnail sizes, done in
+process so the full size image only has to be decoded once no matter how many sizes are made from it.
+
+The full size image is also cut into a pyramid of square tiles for the zoomable image viewer, using the same
+/{zoom}/{x}/{y}.png scheme as the sky map.  Zoom level 0 fits the whole image in a single tile and each level after that
+doubles the resolution up to the full size image at getTileMaxZoom().  The generateTiles task only stores each zoom
+level as a .npy file, the individual tiles are cut out of it the first time they are requested and cached on disk.
+"""
+import numpy
+
+from django.conf import settings
+
+# The standard thumbnail sizes, from largest to smallest, as (size string, maximum width, maximum height).  Each one is
+# made from the one before it, so they must stay in decreasing order.
+thumbnailSizes = [
+    ('large', 900, 900),
+    ('medium', 300, 300),
+    ('small', 100, 100)
+    ]
+
+def getFitSize(width, height, maxWidth, maxHeight):
+    """
+    Return the (width, height) of an image scaled to fit inside maxWidth by maxHeight keeping its aspect ratio, the same
+    as the geometry ImageMagick's '-resize WxH' uses.
+    """
+    scale = min(maxWidth / width, maxHeight / height)
+    return max(1, int(round(width * scale))), max(1, int(round(height * scale)))
+
+def resampleAxis(data, newLength, axis):
+    """
+    Resample data along the given axis to newLength entries by area averaging, each new entry is the mean of the part of
+    the old entries it covers (counting partially covered entries by the fraction covered).  This is done through the
+    cumulative sum along the axis, which is exact for pixels treated as constant over their area.
+    """
+    length = data.shape[axis]
+    cumulative = numpy.cumsum(data, axis=axis, dtype=numpy.float64)
+    cumulative = numpy.insert(cumulative, 0, 0, axis=axis)
+
+    boundaries = numpy.linspace(0, length, newLength + 1)
+    lower = numpy.floor(boundaries).astype(numpy.int64).clip(0, length - 1)
+    fraction = boundaries - lower
+    shape = [1] * data.ndim
+    shape[axis] = newLength + 1
+    fraction = fraction.reshape(shape)
+
+    # The cumulative sum at each fractional boundary, interpolated between the whole pixel boundaries either side of it.
+    atLower = numpy.take(cumulative, lower, axis=axis)
+    atUpper = numpy.take(cumulative, lower + 1, axis=axis)
+    atBoundaries = atLower + fraction * (atUpper - atLower)
+
+    return numpy.diff(atBoundaries, axis=axis) / (length / newLength)
+
+def resampleArea(data, width, height):
+    """
+    Resize an image array (rows first, with an optional trailing colour axis) to width by height by area averaging.
+    """
+    resampled = resampleAxis(resampleAxis(data, height, 0), width, 1)
+    return resampled.round().clip(0, 255).astype(numpy.uint8)
+
+def makeThumbnailPyramid(fullImage):
+    """
+    Return a list of (size string, image array) for each of the standard thumbnailSizes, each downsampled from the
+    previous one rather than from the full size image.
+    """
+    thumbnails = []
+    previous = fullImage
+    for sizeString, maxWidth, maxHeight in thumbnailSizes:
+        width, height = getFitSize(fullImage.shape[1], fullImage.shape[0], maxWidth, maxHeight)
+        previous = resampleArea(previous, width, height)
+        thumbnails.append((sizeString, previous))
+
+    return thumbnails
+
+# The width and height in pixels of the tiles of the zoomable image viewer.
+tileSize = 256
+
+def getTileFolder(imageId):
+    return '{}imagetiles/{}/'.format(settings.MEDIA_ROOT, imageId)
+
+def getTileLevelFilename(imageId, zoom):
+    return '{}level{}.npy'.format(getTileFolder(imageId), zoom)
+
+def getTileFilename(imageId, zoom, tileX, tileY):
+    return '{}{}/{}/{}.png'.format(getTileFolder(imageId), zoom, tileX, tileY)
+
+def getTileMaxZoom(width, height):
+    """
+    Return the zoom level at which an image of the given size is shown at full resolution.
+    """
+    zoom = 0
+    while max(width, height) > tileSize * 2**zoom:
+        zoom += 1
+
+    return zoom
+
+def halveImage(data):
+    """
+    Return the image at half the width and height, each pixel the average of a 2x2 block.  Odd sizes are padded by
+    repeating the last row or column so the blocks line up with the tile grid at every zoom level.
+    """
+    padding = [(0, data.shape[0] % 2), (0, data.shape[1] % 2)] + [(0, 0)] * (data.ndim - 2)
+    data = numpy.pad(data, padding, mode='edge')
+    blocks = data.reshape((data.shape[0] // 2, 2, data.shape[1] // 2, 2) + data.shape[2:])
+    return blocks.mean(axis=(1, 3)).round().astype(numpy.uint8)
+
+def makeTileLevels(fullImage):
+    """
+    Yield (zoom, image) for each zoom level of the tile pyramid, starting from the full size image at the maximum zoom
+    and halving it for each level down to zoom 0.
+    """
+    level = fullImage
+    for zoom in range(getTileMaxZoom(fullImage.shape[1], fullImage.shape[0]), -1, -1):
+        yield zoom, level
+
+        if zoom > 0:
+            level = halveImage(level)
+
+def cutTile(level, tileX, tileY):
+    """
+    Return the tile at tileX, tileY of the given zoom level image, padded with black past the edge of the image, or None
+    if the tile is entirely outside the image.
+    """
+    top = tileY * tileSize
+    left = tileX * tileSize
+    if top >= level.shape[0] or left >= level.shape[1]:
+        return None
+
+    region = level[top:top + tileSize, left:left + tileSize]
+    tile = numpy.zeros((tileSize, tileSize) + level.shape[2:], dtype=numpy.uint8)
+    tile[:region.shape[0], :region.shape[1]] = region
+    return tile
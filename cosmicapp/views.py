@@ -21,7 +21,7 @@ from django.core.files.storage import FileSystemStorage
 from django.http import HttpResponseRedirect
 from django.utils import timezone
 from django.conf import settings
-from django.contrib.gis.db.models import Count, F, Q, Max, Min, Avg, StdDev, Sum, ExpressionWrapper, FloatField
+from django.contrib.gis.db.models import Count, Q, Max, Min, Avg, StdDev, Sum, ExpressionWrapper, FloatField
 from django.db import transaction
 from django.views.decorators.http import require_http_methods
 from django.contrib.gis.geos import GEOSGeometry, Point
@@ -41,6 +41,7 @@ from .forms import *
 from .functions import *
 from .tasks import *
 from .db import *
+from .thumbnails import getTileFilename, getTileLevelFilename, cutTile
 
 #TODO: Replace all model.pk references with model.whatever_id as the second version does not fetch the joined model from the db.
 
@@ -58,8 +59,8 @@ def processes(request, process=None):
     if process == None:
         return render(request, "cosmicapp/processes.html", context)
 
-    validPages = ['astrometrynet', 'generatethumbnails', 'imagestats', 'parseheaders', 'sextractor', 'image2xy',
-        'daofind', 'starfind', 'starmatch', 'flagsources', 'imagecombine', 'calculateusercosttotals']
+    validPages = ['astrometrynet', 'backgroundmap', 'generatethumbnails', 'generatetiles', 'imagestats', 'parseheaders',
+        'sextractor', 'image2xy', 'daofind', 'starfind', 'starmatch', 'flagsources', 'imagecombine', 'calculateusercosttotals']
 
     process = process.lower()
     if process in validPages:
@@ -249,29 +250,38 @@ def upload(request):
             record.save()
             records.append(record)
 
+        #TODO: Do a better job of checking the file type here and take appropriate action.
+        imageFileRecords = []
+        for record in records:
             fileBase, fileExtension = os.path.splitext(record.onDiskFileName)
-
-            #TODO: Do a better job of checking the file type here and take appropriate action.
             if fileExtension.lower() in settings.SUPPORTED_IMAGE_TYPES:
-                image = createTasksForNewImage(record, request.user, priorityMod)
-                priorityMod -= 1.0
-
-                for key, value in [('object', objectIdentifier), ('objectRA', objectRA), ('objectDec', objectDec),
-                                   ('overlapsImage', overlapsImage), ('plateScale', plateScale)]:
-                    if value != '':
-                        image.addImageProperty(key, value, False)
-
-                if observatoryID != -1:
-                    observatory = Observatory.objects.filter(pk=int(observatoryID)).first()
-                    if observatory is not None:
-                        image.observatory = observatory
-                        image.save()
-
-                if instrumentID != -1:
-                    instrument = InstrumentConfiguration.objects.filter(pk=int(instrumentID)).first()
-                    if instrument is not None:
-                        image.instrument = instrument
-                        image.save()
+                imageFileRecords.append(record)
+
+        # Create all the images and their processing tasks in one go, each file's tasks get a slightly lower priority
+        # than the one before it so that the files are processed in the order they were uploaded.
+        images = createTasksForNewImages(imageFileRecords, request.user, priorityMod, -1.0)
+
+        # The properties entered on the upload form are the same for every image, so they are all written in one insert.
+        imageProperties = []
+        for image in images:
+            for key, value in [('object', objectIdentifier), ('objectRA', objectRA), ('objectDec', objectDec),
+                               ('overlapsImage', overlapsImage), ('plateScale', plateScale)]:
+                if value != '':
+                    imageProperties.append(ImageProperty(image=image, key=key, value=value))
+
+        ImageProperty.objects.bulk_create(imageProperties)
+
+        imageIds = [image.pk for image in images]
+
+        if observatoryID != -1:
+            observatory = Observatory.objects.filter(pk=int(observatoryID)).first()
+            if observatory is not None:
+                Image.objects.filter(pk__in=imageIds).update(observatory=observatory)
+
+        if instrumentID != -1:
+            instrument = InstrumentConfiguration.objects.filter(pk=int(instrumentID)).first()
+            if instrument is not None:
+                Image.objects.filter(pk__in=imageIds).update(instrument=instrument)
 
         context['upload_successful'] = True
         context['records'] = records
@@ -795,9 +805,11 @@ def processQueue(request):
         for process in processesForImage:
             processIdList.append(process.pk)
 
+    # The queue is ordered by agedPriority() so it can be read from processinput_pending_idx, modifiedPriority is
+    # the same thing shifted by the current time and is only there for display.
     currentEpoch = int(time.time())
     processInputsUncompleted = ProcessInput.objects.filter(completed=None).prefetch_related('images')\
-        .annotate(modifiedPriority=ExpressionWrapper(F('priority')+currentEpoch-Epoch(F('submittedDateTime')), output_field=FloatField()))
+        .annotate(modifiedPriority=ExpressionWrapper(agedPriority()+currentEpoch, output_field=FloatField()))
 
     if imageIdList is not None:
         processInputsUncompleted = processInputsUncompleted\
@@ -805,7 +817,7 @@ def processQueue(request):
 
     processInputsUncompleted = processInputsUncompleted\
         .prefetch_related('processOutput', 'requestor')\
-        .order_by('-modifiedPriority')[:50]
+        .order_by(agedPriority().desc())[:50]
 
     processInputsCompleted = ProcessInput.objects.filter(~Q(completed=None)).prefetch_related('images')
 
@@ -939,6 +951,7 @@ def uploadSession(request, pk):
                     piAstrometryNet.save()
                     piAstrometryNet.addArguments([image.fileRecord.onDiskFileName])
                     piAstrometryNet.images.add(image)
+                    piAstrometryNet.coalesce()
 
     return render(request, "cosmicapp/uploadSession.html", context)
 
@@ -1054,6 +1067,7 @@ def image(request, id):
         return render(request, "cosmicapp/imagenotfound.html", context)
 
     context['image'] = image
+    context['tileMaxZoom'] = image.getImageProperty('tileMaxZoom')
     context['objectRA'] = image.getImageProperty('objectRA')
     context['objectDec'] = image.getImageProperty('objectDec')
 
@@ -2061,6 +2075,51 @@ def mapTile(request, body, zoom, tileX, tileY):
 
     return HttpResponse(imageData, content_type="image/png", status=201)
 
+def imageTile(request, id, zoom, tileX, tileY):
+    """
+    Return a single tile of the zoomable view of an image, cutting it out of the zoom level written by the generateTiles
+    task and caching it on disk the first time it is requested.
+    """
+    try:
+        id = int(id)
+        tileX = int(tileX)
+        tileY = int(tileY)
+        zoom = int(zoom)
+    except:
+        return HttpResponse('Parameters missing', status=400)
+
+    tileFilename = getTileFilename(id, zoom, tileX, tileY)
+
+    # Check to see if there is already a cached version of the tile on disk, and if so, just return it directly.
+    try:
+        imageFile = open(tileFilename, 'rb')
+        return HttpResponse(imageFile, content_type="image/png", status=200)
+    except FileNotFoundError:
+        # If the file does not exist on disk, that is ok, we will generate it and then return the data to the user.
+        pass
+
+    # The zoom level is memory mapped so only the rows of the image the tile covers are read from disk.
+    try:
+        level = numpy.load(getTileLevelFilename(id, zoom), mmap_mode='r')
+    except FileNotFoundError:
+        return HttpResponse('Tile not found', status=404)
+
+    tile = cutTile(level, tileX, tileY)
+    if tile is None:
+        return HttpResponse('Tile not found', status=404)
+
+    imageData = imageio.imwrite(imageio.RETURN_BYTES, tile, format='png', optimize=True, bits=8)
+
+    # Write to a temporary file and rename it into place so a simultaneous request never reads a partial tile.
+    os.makedirs(os.path.dirname(tileFilename), exist_ok=True)
+    tempFilename = '{}.{}.tmp'.format(tileFilename, os.getpid())
+    with open(tempFilename, 'wb') as imageFile:
+        imageFile.write(imageData)
+
+    os.replace(tempFilename, tileFilename)
+
+    return HttpResponse(imageData, content_type="image/png", status=201)
+
 def questions(request):
     context = {"user" : request.user}
 
@@ -2511,8 +2570,8 @@ def saveUserSubmittedSourceResults(request):
 
         userSubmittedHotPixel.save()
 
-    #TODO: Check to see if these processes are already in the queue from a previous upload.  It is possible the user
-    # submits multiple sets of sources before the queue processes the first ones.  These tasks only ultimately need to be run once.
+    # The user may submit several sets of sources before the queue gets to the first ones, so each task is coalesced
+    # with any identical one still waiting in the queue since they only need to be run once.
     with transaction.atomic():
         #TODO: We only need to add a flagSources task if the use submitted new hot pixels in the request.
         piFlagSources = ProcessInput(
@@ -2528,6 +2587,7 @@ def saveUserSubmittedSourceResults(request):
         piFlagSources.save()
         piFlagSources.addArguments([str(image.pk)])
         piFlagSources.images.add(image)
+        piFlagSources = piFlagSources.coalesce()
 
         piStarmatch = ProcessInput(
             process = "starmatch",
@@ -2543,6 +2603,7 @@ def saveUserSubmittedSourceResults(request):
         piStarmatch.addArguments([image.fileRecord.onDiskFileName])
         piStarmatch.prerequisites.add(piFlagSources)
         piStarmatch.images.add(image)
+        piStarmatch = piStarmatch.coalesce()
 
         piAstrometryNet = ProcessInput(
             process = "astrometryNet",
@@ -2558,6 +2619,7 @@ def saveUserSubmittedSourceResults(request):
         piAstrometryNet.addArguments([image.fileRecord.onDiskFileName])
         piAstrometryNet.prerequisites.add(piStarmatch)
         piAstrometryNet.images.add(image)
+        piAstrometryNet = piAstrometryNet.coalesce()
 
     return HttpResponse(json.dumps({'text': 'Response Saved Successfully'}), status=200)
 
@@ -2605,8 +2667,8 @@ def saveUserSubmittedFeedback(request):
     numResults = methodDict[method].objects.filter(image=image).count()
     image.addImageProperty('userNumExpectedResults', str(numResults) + ' ' + feedback, False)
 
-    #TODO: Check to see if these processes are already in the queue from a previous upload.  It is possible the user
-    # submits multiple sets of feedback before the queue processes the first ones.  These tasks only ultimately need to be run once.
+    # The user may submit several sets of feedback before the queue gets to the first ones, so each task is coalesced
+    # with any identical one still waiting in the queue since they only need to be run once.
     with transaction.atomic():
         piSextractor = ProcessInput(
             process = "sextractor",
@@ -2621,6 +2683,7 @@ def saveUserSubmittedFeedback(request):
         piSextractor.save()
         piSextractor.addArguments([image.fileRecord.onDiskFileName])
         piSextractor.images.add(image)
+        piSextractor = piSextractor.coalesce()
 
         piImage2xy = ProcessInput(
             process = "image2xy",
@@ -2635,6 +2698,7 @@ def saveUserSubmittedFeedback(request):
         piImage2xy.save()
         piImage2xy.addArguments([image.fileRecord.onDiskFileName])
         piImage2xy.images.add(image)
+        piImage2xy = piImage2xy.coalesce()
 
         piDaofind = ProcessInput(
             process = "daofind",
@@ -2649,6 +2713,7 @@ def saveUserSubmittedFeedback(request):
         piDaofind.save()
         piDaofind.addArguments([image.fileRecord.onDiskFileName])
         piDaofind.images.add(image)
+        piDaofind = piDaofind.coalesce()
 
         piStarfind = ProcessInput(
             process = "starfind",
@@ -2663,6 +2728,7 @@ def saveUserSubmittedFeedback(request):
         piStarfind.save()
         piStarfind.addArguments([image.fileRecord.onDiskFileName])
         piStarfind.images.add(image)
+        piStarfind = piStarfind.coalesce()
 
         piFlagSources = ProcessInput(
             process = "flagSources",
@@ -2681,6 +2747,7 @@ def saveUserSubmittedFeedback(request):
         piFlagSources.prerequisites.add(piDaofind)
         piFlagSources.prerequisites.add(piStarfind)
         piFlagSources.images.add(image)
+        piFlagSources = piFlagSources.coalesce()
 
         piStarmatch = ProcessInput(
             process = "starmatch",
@@ -2696,6 +2763,7 @@ def saveUserSubmittedFeedback(request):
         piStarmatch.addArguments([image.fileRecord.onDiskFileName])
         piStarmatch.prerequisites.add(piFlagSources)
         piStarmatch.images.add(image)
+        piStarmatch = piStarmatch.coalesce()
 
         # NOTE: This flagSources task is called twice, once to flag the individual source find methods,
         # and then now a second time to also flag the SourceFindMatch results as well.
@@ -2713,6 +2781,7 @@ def saveUserSubmittedFeedback(request):
         piFlagSources.addArguments([image.pk])
         piFlagSources.prerequisites.add(piStarmatch)
         piFlagSources.images.add(image)
+        piFlagSources = piFlagSources.coalesce()
 
         piAstrometryNet = ProcessInput(
             process = "astrometryNet",
@@ -2728,6 +2797,7 @@ def saveUserSubmittedFeedback(request):
         piAstrometryNet.addArguments([image.fileRecord.onDiskFileName])
         piAstrometryNet.prerequisites.add(piFlagSources)
         piAstrometryNet.images.add(image)
+        piAstrometryNet = piAstrometryNet.coalesce()
 
     return HttpResponse(json.dumps({'text': 'Response Saved Successfully'}), status=200)
 
@@ -28,6 +28,18 @@ priority, created = ProcessPriority.objects.get_or_create(
     priorityClass = 'batch'
     )
 
+priority, created = ProcessPriority.objects.get_or_create(
+    name = 'generateTiles',
+    priority = 9000,
+    priorityClass = 'batch'
+    )
+
+priority, created = ProcessPriority.objects.get_or_create(
+    name = 'backgroundMap',
+    priority = 3012,
+    priorityClass = 'batch'
+    )
+
 priority, created = ProcessPriority.objects.get_or_create(
     name = 'sextractor',
     priority = 3010,
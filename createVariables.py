@@ -25,10 +25,16 @@ CosmicVariable.setVariable('histogramRejectionExponent', 'float', '100.0')
 CosmicVariable.setVariable('histogramIgnoreLower', 'float', '.25')
 CosmicVariable.setVariable('histogramIgnoreUpper', 'float', '.25')
 
+CosmicVariable.setVariable('imagestatsMaxTileBytes', 'int', '67108864')
+CosmicVariable.setVariable('backgroundMapBoxSize', 'int', '64')
+CosmicVariable.setVariable('sourcefindTileSize', 'int', '4096')
+
 CosmicVariable.setVariable('asteroidEphemerideTolerance', 'float', '5')
 CosmicVariable.setVariable('asteroidEphemerideTimeTolerance', 'float', '90')
 CosmicVariable.setVariable('asteroidEphemerideMaxAngularDistance', 'float', '20')
 
+CosmicVariable.setVariable('dispatchProcessLimits', 'string', 'astrometryNet:1,generateThumbnails:2,sextractor:2,image2xy:2,daofind:2,starfind:2')
+
 CosmicVariable.setVariable('storageCostPerMonth', 'float', '0.02')
 CosmicVariable.setVariable('cpuCostPerSecond', 'float', '0.00001')
 
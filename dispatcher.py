@@ -1,12 +1,14 @@
 import os
 import sys
 import time
+import uuid
+from datetime import timedelta
 import django
 from django.utils import timezone
-import threading
+from django.db import transaction
 import celery
-from django.db.models import ExpressionWrapper, F, Q
-from django.contrib.gis.db.models import FloatField
+from django.db.models import Q, Count
+from django.conf import settings
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "cosmic.settings")
 django.setup()
@@ -15,254 +17,214 @@ django.setup()
 from cosmicapp.models import *
 from cosmicapp.tasks import *
 from cosmicapp.db import *
+from cosmicapp.dispatch import *
 
 quit = False
-dispatchSemaphore = threading.Semaphore(value=3)
-astrometryNetSemaphore = threading.Semaphore(value=1)
-
-# The time to wait between successive checks to the DB for tasks in the queue.  The first value is the time to wait
-# between tasks when there is more than one in the queue, subsequent values are used for a "backoff timer".
-sleepTimes = [0.3, 0.5, 1.5, 3, 3, 8, 8, 8, 8, 8, 8, 8, 8, 8, 8, 8, 8,
-    10, 10, 10, 10, 10, 10, 10, 10, 10, 10, 10, 10, 10, 10, 10, 10, 10, 10, 10, 15]
-sleepTimeIndex = 0
-
-def getFirstPrerequisite(pi):
-    prerequisites = pi.prerequisites.all().order_by('-priority', 'submittedDateTime')
-    unmet = []
-    for prerequisite in prerequisites:
-        if prerequisite.completed == None:
-            unmet.append(getFirstPrerequisite(prerequisite))
-        elif prerequisite.completed == 'failure':
-            return None, 'failed_prerequisite'
-        elif prerequisite.completed == 'success':
-            continue
-
-    for prereq, status in unmet:
-        if prereq is None:
-            if status == 'failed_prerequisite':
-                return None, 'failed_prerequisite'
-            else:
-                continue
-
-        if prereq.startedDateTime is None:
-            return prereq, 'prereq_found'
-
-    if len(unmet) == 0:
-        return pi, 'no_umnet_ok_to_proceed'
-    else:
-        return None, 'prerequisite_running'
+
+# The number of tasks allowed to be dispatched to each celery queue at once is set by settings.DISPATCH_QUEUES.  Tasks
+# report their own completion through the processInputCompleted/processInputFailed callbacks, so the number currently
+# running on a queue is simply the number of started but uncompleted tasks in the database assigned to that queue.  The
+# number of each process type allowed to run at once is limited separately by getProcessLimits(), so one slow type of
+# task cannot take over every slot on its queue.
+
+# New and completed ProcessInput records send a NOTIFY on this channel, so the dispatcher sleeps until one arrives rather
+# than polling the queue.  The timeout is only a safety net in case a notification is ever missed (for example a row
+# inserted by hand in psql).
+listenConnection = listenOnChannel(settings.DISPATCHER_NOTIFY_CHANNEL)
+safetyNetPollTime = 15
+
+# Each task is sent under a fresh celery task id with a lease long enough for a worker to pick it up.  From then on the
+# celery worker running the task renews the lease itself (see cosmicapp.tasks.LeasedTask), so the lease only runs out if
+# the message was lost, the dispatcher died before sending it, or the worker running it died.  The dispatcher holds no
+# state of its own about running tasks, so any number of them can run at once and be stopped or restarted at any time
+# without tasks being run twice.
+leaseTime = timedelta(seconds=settings.TASK_LEASE_SECONDS)
+reapTime = settings.TASK_HEARTBEAT_SECONDS
+lastReap = 0
+
+def requeueExpiredLeases():
+    """
+    Put any task whose lease has run out back in the queue, since nothing is running it anymore and it would otherwise
+    never be marked as completed.  If the old celery task does turn up later it is ignored, since its id no longer
+    matches the taskId of the ProcessInput.
+    """
+    numExpired = ProcessInput.objects\
+        .filter(completed=None, startedDateTime__isnull=False, leaseExpiry__lt=timezone.now())\
+        .update(startedDateTime=None, taskId=None, workerId=None, leaseExpiry=None)
+
+    if numExpired > 0:
+        print("Requeued {} tasks with expired leases.".format(numExpired))
+        sys.stdout.flush()
 
 def dispatchProcessInput(pi):
+    """
+    Send the given ProcessInput to a celery worker.  The task is linked to callbacks which record its result in the
+    database as soon as it finishes, so this returns immediately and the dispatcher does not need to wait on it.
+    """
     if pi.process == 'imagestats':
         arg = pi.arguments.all()[0].arg
-        celeryResult = imagestats.delay(arg, pi.pk)
+        task, args = imagestats, (arg, pi.pk)
 
     elif pi.process == 'generateThumbnails':
         arg = pi.arguments.all()[0].arg
-        celeryResult = generateThumbnails.delay(arg, pi.pk)
+        task, args = generateThumbnails, (arg, pi.pk)
+
+    elif pi.process == 'generateTiles':
+        arg = pi.arguments.all()[0].arg
+        task, args = generateTiles, (arg, pi.pk)
+
+    elif pi.process == 'backgroundMap':
+        arg = pi.arguments.all()[0].arg
+        task, args = backgroundMap, (arg, pi.pk)
 
     elif pi.process == 'sextractor':
         arg = pi.arguments.all()[0].arg
-        celeryResult = sextractor.delay(arg, pi.pk)
+        task, args = sextractor, (arg, pi.pk)
 
     elif pi.process == 'image2xy':
         arg = pi.arguments.all()[0].arg
-        celeryResult = image2xy.delay(arg, pi.pk)
+        task, args = image2xy, (arg, pi.pk)
 
     elif pi.process == 'daofind':
         arg = pi.arguments.all()[0].arg
-        celeryResult = daofind.delay(arg, pi.pk)
+        task, args = daofind, (arg, pi.pk)
 
     elif pi.process == 'starfind':
         arg = pi.arguments.all()[0].arg
-        celeryResult = starfind.delay(arg, pi.pk)
+        task, args = starfind, (arg, pi.pk)
 
     elif pi.process == 'starmatch':
         arg = pi.arguments.all()[0].arg
-        celeryResult = starmatch.delay(arg, pi.pk)
+        task, args = starmatch, (arg, pi.pk)
 
     elif pi.process == 'astrometryNet':
         arg = pi.arguments.all()[0].arg
-        celeryResult = astrometryNet.delay(arg, pi.pk)
+        task, args = astrometryNet, (arg, pi.pk)
 
     elif pi.process == 'parseHeaders':
         arg = pi.arguments.all()[0].arg
-        celeryResult = parseHeaders.delay(arg, pi.pk)
+        task, args = parseHeaders, (arg, pi.pk)
 
     elif pi.process == 'flagSources':
         arg = pi.arguments.all()[0].arg
-        celeryResult = flagSources.delay(arg, pi.pk)
+        task, args = flagSources, (arg, pi.pk)
 
     elif pi.process == 'imageCombine':
         argList = []
         for arg in pi.arguments.all():
             argList.append(arg.arg)
 
-        celeryResult = imageCombine.delay(argList, pi.pk)
+        task, args = imageCombine, (argList, pi.pk)
 
     elif pi.process == 'calculateUserCostTotals':
         arg0 = pi.arguments.all()[0].arg
         arg1 = pi.arguments.all()[1].arg
 
-        celeryResult = calculateUserCostTotals.delay(arg0, arg1, pi.pk)
+        task, args = calculateUserCostTotals, (arg0, arg1, pi.pk)
 
     else:
         print("Skipping unknown task type: " + pi.process)
         sys.stdout.flush()
+        pi.markCompleted('failure')
         return
 
-    waitTime = 0.25
-    while not celeryResult.ready():
-        print("   Task running, waiting " + str(waitTime) + " seconds.")
-        sys.stdout.flush()
-        time.sleep(waitTime)
-        waitTime = waitTime*1.5 + 0.1
-        waitTime = min(waitTime, 5)
-
-    if pi.process == 'astrometryNet':
-        astrometryNetSemaphore.release()
-
-    # Write the result of the returned value back to the database, either success, failure, or error (early exit).
-    if isinstance(celeryResult.info, dict):
-        cost = celeryResult.info['executionTime'] * CosmicVariable.getVariable('cpuCostPerSecond')
-        processOutput = ProcessOutput(
-            processInput = pi,
-            outputText = celeryResult.info['outputText'],
-            outputErrorText = celeryResult.info['outputErrorText'],
-            actualCostCPU = celeryResult.info['executionTime'],
-            actualCost = cost
-            )
-
-        processOutput.save()
-
-        siteCost = SiteCost(
-            user = pi.requestor,
-            dateTime = timezone.now(),
-            text = 'Process input ' + str(pi.pk),
-            cost = cost
-            )
-
-        siteCost.save()
-
-        pi.completed = 'success.'
-    else:
-        if celeryResult.info == True:
-            pi.completed = 'success'
-        elif celeryResult.info == False:
-            pi.completed = 'failure'
-        else:
-            pi.completed = str(celeryResult.info)
+    task.apply_async(args,
+        queue = pi.queue,
+        task_id = pi.taskId,
+        link = processInputCompleted.s(pi.pk, pi.taskId).set(queue=settings.DISPATCH_CALLBACK_QUEUE),
+        link_error = processInputFailed.s(pi.pk).set(queue=settings.DISPATCH_CALLBACK_QUEUE)
+        )
 
-    pi.save()
+# Begin program exectution.
 
-    print("Task completed with result:  " + pi.completed)
-    sys.stdout.flush()
+print("Starting dispatcher.")
+sys.stdout.flush()
 
-    dispatchSemaphore.release()
+# Tasks dispatched before the lease system existed have no lease at all, give them one so the reaper can requeue them if
+# nobody is running them anymore.
+ProcessInput.objects\
+    .filter(completed=None, startedDateTime__isnull=False, leaseExpiry=None)\
+    .update(leaseExpiry=timezone.now() + leaseTime)
 
-# Begin program exectution.
+# Make sure the unmet prerequisite counts the dispatch query relies on are consistent before we start using them.
+ProcessInput.recomputeUnmetPrerequisites()
 
-# Clear previously dispatched runs that crashed or were killed before they were finished.
-#NOTE: Having this line means it is only safe to run a single instance of the dispatcher, starting up a second
-# dispatcher will kill the startedDateTime entries currently running on the first and they will all get run again.
-ProcessInput.objects.filter(completed=None).update(startedDateTime=None)
+# Assign a queue to any tasks queued before queue routing existed, or to a queue that has since been removed.
+for pi in ProcessInput.objects.filter(completed=None).filter(Q(queue=None) | ~Q(queue__in=list(settings.DISPATCH_QUEUES.keys()))):
+    pi.queue = getQueueForProcessInput(pi)
+    pi.save()
 
 while not quit:
-    dispatchSemaphore.acquire()
+    # Throw away any notifications that arrived while we were busy, the queries below will see everything they announced.
+    waitForNotify(listenConnection, 0)
 
-    astrometryNetTasksAllowed = astrometryNetSemaphore.acquire(False)
+    if time.time() - lastReap > reapTime:
+        requeueExpiredLeases()
+        lastReap = time.time()
 
-    if sleepTimeIndex > len(sleepTimes) - 1:
-        sleepTimeIndex = len(sleepTimes) - 1
+    # Work out which queues still have room for another task.
+    runningTasks = ProcessInput.objects.filter(completed=None, startedDateTime__isnull=False)
+    runningPerQueue = {}
+    for entry in runningTasks.order_by().values('queue').annotate(count=Count('pk')):
+        runningPerQueue[entry['queue']] = entry['count']
 
-    sleepTime = sleepTimes[sleepTimeIndex]
-    print("Sleeping for " + str(sleepTime) + " seconds.")
-    sys.stdout.flush()
-    time.sleep(sleepTime)
-    print("Checking queue.")
-    sys.stdout.flush()
+    availableQueues = getAvailableQueues(runningPerQueue)
 
-    try:
-        currentEpoch = int(time.time())
-        index = random.Random().randint(0, 5)
-        inputQuery = ProcessInput.objects\
-            .filter(completed=None, startedDateTime__isnull=True)\
-            .annotate(modifiedPriority=ExpressionWrapper(F('priority')+currentEpoch-Epoch(F('submittedDateTime')), output_field=FloatField()))\
-            .order_by('-modifiedPriority')
-
-        if not astrometryNetTasksAllowed:
-            print('Not allowing astrometryNet tasks since one is already dispatched.')
-            sys.stdout.flush()
-            inputQuery = inputQuery.filter(~Q(process='astrometryNet'))
-        else:
-            print('Allowing astrometryNet tasks.')
-            sys.stdout.flush()
-
-        pi = inputQuery[index:index+1][0]
-
-    except IndexError:
-        if len(inputQuery) == 0:
-            sleepTimeIndex += 1
-            dispatchSemaphore.release()
-            if astrometryNetTasksAllowed:
-                astrometryNetSemaphore.release()
-            continue
-        else:
-            pi = inputQuery[0]
-    except:
-        print("Unexpected error:", sys.exc_info()[0])
+    if len(availableQueues) == 0:
+        print("All dispatch slots in use, waiting up to " + str(safetyNetPollTime) + " seconds for a task to complete.")
         sys.stdout.flush()
-        dispatchSemaphore.release()
-        if astrometryNetTasksAllowed:
-            astrometryNetSemaphore.release()
-        raise
+        waitForNotify(listenConnection, safetyNetPollTime)
+        continue
 
-    print("checking prerequisistes for:  ", pi.process)
-    sys.stdout.flush()
-    prerequisite, status = getFirstPrerequisite(pi)
+    # Work out which process types are already running as many tasks as they are allowed.  The limits are re-read every
+    # time through so they can be changed while the dispatcher is running.
+    processLimits = getProcessLimits()
+    runningPerProcess = {}
+    for entry in runningTasks.order_by().values('process').annotate(count=Count('pk')):
+        runningPerProcess[entry['process']] = entry['count']
+
+    saturatedProcesses = getSaturatedProcesses(runningPerProcess, processLimits)
 
-    print(status)
+    print("Checking queue.")
     sys.stdout.flush()
 
-    if status == 'failed_prerequisite':
-        pi.startedDateTime = timezone.now()
-        pi.completed = 'failed_prerequisite'
-        pi.save()
-        dispatchSemaphore.release()
-        if astrometryNetTasksAllowed:
-            astrometryNetSemaphore.release()
-        continue
+    # Only tasks with all their prerequisites completed are candidates, so the highest priority one can be
+    # dispatched straight away.  Ordering by agedPriority() lets this be read from the head of processinput_ready_idx.
+    inputQuery = ProcessInput.objects\
+        .filter(completed=None, startedDateTime__isnull=True, unmetPrerequisites=0, queue__in=availableQueues)\
+        .order_by(agedPriority().desc())
 
-    elif status == 'prerequisite_running':
-        print("waiting on already running prerequisite.  Sleeping 2 seconds.")
+    if len(saturatedProcesses) > 0:
+        print('Not allowing tasks at their concurrency limit: ' + ', '.join(saturatedProcesses))
+        sys.stdout.flush()
+        inputQuery = inputQuery.filter(~Q(process__in=saturatedProcesses))
+
+    # Claim the task.  Rows another dispatcher is in the middle of claiming are locked, so we skip past them rather than
+    # waiting for them (and then running the same task a second time).
+    with transaction.atomic():
+        pi = inputQuery.select_for_update(skip_locked=True, of=('self',)).first()
+
+        if pi is not None:
+            pi.startedDateTime = timezone.now()
+            pi.taskId = str(uuid.uuid4())
+            pi.workerId = None
+            pi.leaseExpiry = pi.startedDateTime + leaseTime
+            # Once started the task can no longer be merged with new submissions (see ProcessInput.coalesce()).
+            pi.dedupKey = None
+            pi.save()
+
+    if pi is None:
+        print("No ready tasks, waiting up to " + str(safetyNetPollTime) + " seconds for a notification.")
         sys.stdout.flush()
-        time.sleep(2)
-        dispatchSemaphore.release()
-        if astrometryNetTasksAllowed:
-            astrometryNetSemaphore.release()
+        waitForNotify(listenConnection, safetyNetPollTime)
         continue
 
-    pi = prerequisite
-
-    # If we successfully acquired the astrometryNetSemaphore but then didn't end up using it to dispatch a task we
-    # return it to the pool.  If we did acquire it, but the task is an astrometryNet task, then it will be released
-    # when the task is completed.
-    if astrometryNetTasksAllowed and pi.process != 'astrometryNet':
-        astrometryNetSemaphore.release()
-
     argList = ''
     for arg in pi.arguments.all():
         argList += ' "{}"'.format(arg.arg)
-    print("prerequisiste is:  {} {}".format(pi.process, argList))
+    print("dispatching to queue '{}':  {} {}".format(pi.queue, pi.process, argList))
     sys.stdout.flush()
 
-    pi.startedDateTime = timezone.now()
-    pi.save()
+    dispatchProcessInput(pi)
     print("Task dispatched.")
     sys.stdout.flush()
-
-    t = threading.Thread(target=dispatchProcessInput, args=(pi,))
-    t.start()
-    time.sleep(0.1)
-    sleepTimeIndex = 0
-
@@ -2,7 +2,14 @@
 
 nohup python3 manage.py runserver 0.0.0.0:8080 > runserver.stdout.txt 2> runserver.stderr.txt &
 
-nohup celery -A cosmic worker -l info > celery.stdout.txt 2> celery.stderr.txt &
+# One worker pool per dispatch queue, sized to match settings.DISPATCH_QUEUES.  The light pool also takes the default
+# celery queue for anything not sent by the dispatcher.  The callbacks pool only records the results of finished tasks
+# (settings.DISPATCH_CALLBACK_QUEUE) so they are never stuck waiting behind other work.
+nohup celery -A cosmic worker -l info -Q io -c 4 -n io@%h > celery.io.stdout.txt 2> celery.io.stderr.txt &
+nohup celery -A cosmic worker -l info -Q cpu-heavy -c 4 -n cpu-heavy@%h > celery.cpu-heavy.stdout.txt 2> celery.cpu-heavy.stderr.txt &
+nohup celery -A cosmic worker -l info -Q solver -c 1 -n solver@%h > celery.solver.stdout.txt 2> celery.solver.stderr.txt &
+nohup celery -A cosmic worker -l info -Q light,celery -c 4 -n light@%h > celery.light.stdout.txt 2> celery.light.stderr.txt &
+nohup celery -A cosmic worker -l info -Q callbacks -c 2 -n callbacks@%h > celery.callbacks.stdout.txt 2> celery.callbacks.stderr.txt &
 
 nohup python3 dispatcher.py > dispatcher.py.stdout.txt 2> dispatcher.py.stderr.txt &
 
@@ -0,0 +1,249 @@
+from django.conf import settings
+
+import django
+import os
+import sys
+import heapq
+import random
+import numpy
+import dateparser
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "cosmic.settings")
+django.setup()
+
+from django.db.models import Min
+
+from cosmicapp.models import *
+from cosmicapp.dispatch import *
+
+# Replays a DAG of tasks through the same queue capacities, per process limits, and aged priority ordering the
+# dispatcher uses, with each task taking a time drawn from the recorded CPU times of past tasks of the same type instead
+# of actually being run.  Nothing is sent to celery and nothing in the database is modified, so dispatcher policy changes
+# can be compared offline.
+#
+# Usage:
+#   python3 simulate_dispatcher.py synthetic <numImages> [seed]
+#       Simulate the pipeline created by createTasksForNewImages() for the given number of images all uploaded at once,
+#       each the size of a randomly chosen past upload.
+#
+#   python3 simulate_dispatcher.py recorded <startTime> <endTime> [seed]
+#       Simulate the tasks actually submitted between the given times, arriving at the times they were submitted.
+
+# The duration used for a process type with no recorded run times.
+defaultDuration = 1.0
+
+# The size in bytes used for the synthetic uploads if no files have been uploaded yet.
+defaultUploadSize = 10e6
+
+class SimulatedTask:
+    def __init__(self, pk, process, queue, priority, submitted, duration):
+        self.pk = pk
+        self.process = process
+        self.queue = queue
+        self.priority = priority
+        self.submitted = submitted
+        self.duration = duration
+        self.prerequisites = []
+        self.dependents = []
+        self.unmetPrerequisites = 0
+        self.readyTime = None
+        self.startTime = None
+        self.finishTime = None
+
+    def agedPriority(self):
+        # The same ordering as cosmicapp.db.agedPriority(), the current time is left off since it is the same for every task.
+        return self.priority - self.submitted
+
+def loadDurations():
+    """
+    Return a dict mapping each process type to the list of CPU times recorded for past runs of it.
+    """
+    durations = {}
+    outputs = ProcessOutput.objects.filter(actualCostCPU__isnull=False)\
+        .values_list('processInput__process', 'actualCostCPU')
+
+    for process, cpuTime in outputs.iterator():
+        durations.setdefault(process, []).append(cpuTime)
+
+    return durations
+
+def loadUploadSizes():
+    """
+    Return the list of sizes in bytes of the files uploaded so far.
+    """
+    return list(UploadedFileRecord.objects.values_list('uploadSize', flat=True))
+
+def sampleDuration(durations, process):
+    if process in durations:
+        return random.choice(durations[process])
+
+    return defaultDuration
+
+def linkTasks(task, prerequisite):
+    task.prerequisites.append(prerequisite)
+    prerequisite.dependents.append(task)
+    task.unmetPrerequisites += 1
+
+def buildSyntheticTasks(numImages, durations, uploadSizes):
+    """
+    Build the tasks createTasksForNewImages() would create for numImages uploads, each the size of a randomly chosen past
+    upload, so the cost estimates (and the cost based routing to the 'light' queue) are the same as for real uploads.
+    """
+    priorities = {}
+    for process, prerequisites, argument, estimateCosts in newImagePipeline:
+        priority = ProcessPriority.getPriorityForProcess(process, "batch")
+        priorities[process] = priority if priority is not None else 0
+
+    tasks = []
+    for imageIndex in range(numImages):
+        uploadSize = random.choice(uploadSizes) if len(uploadSizes) > 0 else defaultUploadSize
+
+        imageTasks = {}
+        for process, prerequisites, argument, estimateCosts in newImagePipeline:
+            costs = estimateCosts(uploadSize)
+            task = SimulatedTask(len(tasks), process, getQueueForProcess(process, costs['estCostCPU'], costs['estCostIO']),
+                priorities[process] - imageIndex, 0, sampleDuration(durations, process))
+
+            for prerequisite in prerequisites:
+                linkTasks(task, imageTasks[prerequisite])
+
+            imageTasks[process] = task
+            tasks.append(task)
+
+    return tasks
+
+def buildRecordedTasks(startTime, endTime, durations):
+    processInputs = ProcessInput.objects.filter(submittedDateTime__gte=startTime, submittedDateTime__lt=endTime)
+    firstSubmitted = processInputs.aggregate(Min('submittedDateTime'))['submittedDateTime__min']
+
+    tasks = {}
+    for pi in processInputs.prefetch_related('processOutput'):
+        cpuTimes = [output.actualCostCPU for output in pi.processOutput.all() if output.actualCostCPU is not None]
+        duration = cpuTimes[0] if len(cpuTimes) > 0 else sampleDuration(durations, pi.process)
+        queue = pi.queue if pi.queue is not None else getQueueForProcessInput(pi)
+
+        tasks[pi.pk] = SimulatedTask(pi.pk, pi.process, queue, pi.priority if pi.priority is not None else 0,
+            (pi.submittedDateTime - firstSubmitted).total_seconds(), duration)
+
+    # Prerequisites from outside the time window are treated as already completed.
+    through = ProcessInput.prerequisites.through
+    links = through.objects.filter(from_processinput__in=tasks.keys(), to_processinput__in=tasks.keys())\
+        .values_list('from_processinput', 'to_processinput')
+
+    for dependentId, prerequisiteId in links:
+        linkTasks(tasks[dependentId], tasks[prerequisiteId])
+
+    return list(tasks.values())
+
+def simulate(tasks, processLimits):
+    """
+    Run the tasks through the dispatch policy, filling in the ready, start, and finish times of each task.  Returns the
+    number of busy slot seconds for each queue.
+    """
+    events = []
+    for task in tasks:
+        if task.unmetPrerequisites == 0:
+            heapq.heappush(events, (task.submitted, 0, task.pk, task))
+
+    ready = []
+    runningPerQueue = {}
+    runningPerProcess = {}
+    busyTime = {}
+    currentTime = 0
+
+    while len(events) > 0:
+        # Process every event happening at the current time before dispatching anything, the same as the dispatcher
+        # draining its notifications before looking at the queue.
+        currentTime = events[0][0]
+        while len(events) > 0 and events[0][0] == currentTime:
+            eventTime, isFinish, pk, task = heapq.heappop(events)
+
+            if isFinish:
+                runningPerQueue[task.queue] -= 1
+                runningPerProcess[task.process] -= 1
+                for dependent in task.dependents:
+                    dependent.unmetPrerequisites -= 1
+                    if dependent.unmetPrerequisites == 0:
+                        heapq.heappush(events, (max(currentTime, dependent.submitted), 0, dependent.pk, dependent))
+            else:
+                task.readyTime = currentTime
+                ready.append(task)
+
+        while True:
+            availableQueues = getAvailableQueues(runningPerQueue)
+            saturatedProcesses = getSaturatedProcesses(runningPerProcess, processLimits)
+
+            candidates = [task for task in ready if task.queue in availableQueues and task.process not in saturatedProcesses]
+            if len(candidates) == 0:
+                break
+
+            task = max(candidates, key=lambda t: t.agedPriority())
+            ready.remove(task)
+
+            task.startTime = currentTime
+            task.finishTime = currentTime + task.duration
+            runningPerQueue[task.queue] = runningPerQueue.get(task.queue, 0) + 1
+            runningPerProcess[task.process] = runningPerProcess.get(task.process, 0) + 1
+            busyTime[task.queue] = busyTime.get(task.queue, 0) + task.duration
+            heapq.heappush(events, (task.finishTime, 1, task.pk, task))
+
+    return busyTime
+
+def printReport(tasks, busyTime, processLimits):
+    finishedTasks = [task for task in tasks if task.finishTime is not None]
+    if len(finishedTasks) == 0:
+        print('No tasks were run.')
+        return
+
+    startTime = min(task.submitted for task in tasks)
+    makespan = max(task.finishTime for task in finishedTasks) - startTime
+
+    print('Simulated {} tasks ({} never became runnable).'.format(len(tasks), len(tasks) - len(finishedTasks)))
+    print('Queues: {}'.format(settings.DISPATCH_QUEUES))
+    print('Process limits: {}'.format(processLimits))
+    print('Makespan: {:.1f} seconds'.format(makespan))
+    print()
+
+    print('Queue wait (seconds from ready to started):')
+    print('{:24s} {:>8s} {:>10s} {:>10s} {:>10s} {:>10s}'.format('process', 'count', 'p50', 'p90', 'p99', 'max'))
+    waits = {}
+    for task in finishedTasks:
+        waits.setdefault(task.process, []).append(task.startTime - task.readyTime)
+
+    for process in sorted(waits.keys()):
+        p50, p90, p99 = numpy.percentile(waits[process], [50, 90, 99])
+        print('{:24s} {:8d} {:10.1f} {:10.1f} {:10.1f} {:10.1f}'.format(process, len(waits[process]), p50, p90, p99,
+            max(waits[process])))
+
+    print()
+    print('Worker utilization:')
+    for queue, maxRunning in settings.DISPATCH_QUEUES.items():
+        utilization = busyTime.get(queue, 0) / (maxRunning * makespan) if makespan > 0 else 0
+        print('{:24s} {:6.1f}%'.format(queue, 100 * utilization))
+
+if len(sys.argv) < 3 or sys.argv[1] not in ('synthetic', 'recorded') or (sys.argv[1] == 'recorded' and len(sys.argv) < 4):
+    print('Usage:')
+    print('    python3 simulate_dispatcher.py synthetic <numImages> [seed]')
+    print('    python3 simulate_dispatcher.py recorded <startTime> <endTime> [seed]')
+    sys.exit(1)
+
+seedIndex = 3 if sys.argv[1] == 'synthetic' else 4
+if len(sys.argv) > seedIndex:
+    random.seed(int(sys.argv[seedIndex]))
+
+durations = loadDurations()
+processLimits = getProcessLimits()
+
+if sys.argv[1] == 'synthetic':
+    tasks = buildSyntheticTasks(int(sys.argv[2]), durations, loadUploadSizes())
+else:
+    startTime = dateparser.parse(sys.argv[2], settings={'TIMEZONE': 'UTC', 'RETURN_AS_TIMEZONE_AWARE': True})
+    endTime = dateparser.parse(sys.argv[3], settings={'TIMEZONE': 'UTC', 'RETURN_AS_TIMEZONE_AWARE': True})
+    if startTime is None or endTime is None:
+        print('Could not parse the start or end time, use a date and time like "2020-01-01 12:00".')
+        sys.exit(1)
+
+    tasks = buildRecordedTasks(startTime, endTime, durations)
+
+busyTime = simulate(tasks, processLimits)
+printReport(tasks, busyTime, processLimits)